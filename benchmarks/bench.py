@@ -0,0 +1,187 @@
+# Times nbhelper commands on a synthetic course from mkcourse.py, see README.md
+# python benchmarks/bench.py --students 200 --notebooks 2 --cells 20
+# python benchmarks/bench.py --compare benchmarks/results/old.json benchmarks/results/new.json
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+
+import mkcourse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+NBHELPER = os.path.join(os.path.dirname(BENCH_DIR), "nbhelper.py")
+A = mkcourse.ASSIGNMENT
+NB = "nb1.ipynb"
+
+# name: (setup commands run untimed on the same course copy, timed command, notebooks processed per student)
+# every command reads stdin "n" so prompts (eg. --moss) are answered without running anything external
+BENCHMARKS = {
+    "ckdir":              ([], ["--ckdir", A, "nb1.html"], 0),
+    "info":               ([], ["--info", A, "--no-cache"], "all"),
+    "dist":               ([], ["--dist", A, "--no-cache"], "all"),
+    "dist-cached":        ([["--dist", A]], ["--dist", A], "all"),
+    "fdist":              ([], ["--fdist", A, "--no-cache"], "all"),
+    "ckgrades":           ([["--dist", A], ["--fdist", A]], ["--ckgrades", A], "all"),
+    "add":                ([], ["--add", A, NB], 1),
+    "fix":                ([], ["--fix", A, NB], 1),
+    "meta":               ([], ["--meta", A, NB], 1),
+    "sortcells":          ([], ["--sortcells", A, NB], 1),
+    "pipeline":           ([], ["--pipeline", "add,fix,meta,sortcells", A, NB], 1),
+    "zip":                ([], ["--zip", A], "all"),
+    "zip-rerun":          ([["--zip", A]], ["--zip", A], "all"),
+    "moss":               ([], ["--moss", A, "--no-cache"], "all"),
+    "simcheck":           ([], ["--simcheck", A, "--no-cache"], "all"),
+    "backup":             ([], ["--backup", "submitted"], "all"),
+    "backup-incremental": ([["--backup", "submitted"]], ["--backup", "submitted"], "all"),
+    "verify":             ([["--backup", "submitted"]], ["--verify"], "all"),
+}
+# --email and --forcegrade need an smtp server or jupyter and are not benchmarked
+
+def runCommand(nbhelper: str, course_dir: str, command: list, jobs: int, profile: bool = False) -> dict:
+    # wall time and peak RSS of one nbhelper run (and its worker processes)
+    argv = [sys.executable, nbhelper, "--cdir", course_dir, "--jobs", str(jobs)] + command + (["--profile"] if profile else [])
+    start = time.perf_counter()
+    with open(os.path.join(course_dir, "bench.log"), "ab") as log:
+        process = subprocess.Popen(argv, cwd=course_dir, stdin=subprocess.PIPE, stdout=log, stderr=subprocess.STDOUT)
+        process.stdin.write(b"n\n")
+        process.stdin.close()
+        if hasattr(os, "wait4"):
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, "waitstatus_to_exitcode") else status
+            # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+            peak_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+        else:
+            process.wait()
+            peak_rss = None
+    wall = time.perf_counter() - start
+    if process.returncode != 0:
+        print("WARNING: %s exited with %s, see %s" %(" ".join(command), process.returncode, os.path.join(course_dir, "bench.log")))
+    result = {"wall": wall, "peak_rss": peak_rss, "returncode": process.returncode}
+    if profile:
+        result["profile"] = readProfile(course_dir, command)
+    return result
+
+def readProfile(course_dir: str, command: list) -> typing.Union[dict, None]:
+    # nbhelper --profile writes <course_dir>/reports/[<AssignName>/]profile-<command>.json
+    name = "profile-%s.json" %(command[0].lstrip("-").replace("-", "_"))
+    for root, _, files in os.walk(os.path.join(course_dir, "reports")):
+        if name in files:
+            with open(os.path.join(root, name), "r") as f:
+                return json.load(f)
+    return None
+
+def runBenchmark(name: str, pristine_dir: str, work_dir: str, args, notebooks: int) -> dict:
+    setup, command, per_student = BENCHMARKS[name]
+    processed = args.students * (notebooks if per_student == "all" else per_student)
+    runs = []
+    for _ in range(args.repeat):
+        # fresh copy every run since fixes and zips change the course
+        course_dir = os.path.join(work_dir, name)
+        shutil.rmtree(course_dir, ignore_errors=True)
+        shutil.copytree(pristine_dir, course_dir)
+        for setup_command in setup:
+            runCommand(args.nbhelper, course_dir, setup_command, args.jobs)
+        runs.append(runCommand(args.nbhelper, course_dir, command, args.jobs, args.profile))
+    walls = sorted(run["wall"] for run in runs)
+    rss = [run["peak_rss"] for run in runs if run["peak_rss"] is not None]
+    result = {"command": command, "runs": runs, "wall": walls[len(walls) // 2], "wall_min": walls[0],
+              "peak_rss": max(rss) if len(rss) > 0 else None, "notebooks": processed,
+              "throughput": processed / walls[len(walls) // 2] if processed > 0 and walls[len(walls) // 2] > 0 else None}
+    profiles = [run["profile"] for run in runs if run.get("profile") is not None]
+    if len(profiles) > 0:
+        # self time of each phase and per student latency from the median run
+        profile = sorted(profiles, key=lambda profile: profile["wall"])[len(profiles) // 2]
+        result["phases"] = {name: phase["self"] for name, phase in profile["phases"].items()}
+        result["students"] = {key: profile["students"][key] for key in ["p50", "p95", "max"]}
+    return result
+
+def nbhelperVersion(nbhelper: str) -> str:
+    with open(nbhelper, "r", encoding="utf8") as f:
+        match = re.search(r'^VERSION\s*=\s*["\']([^"\']+)["\']', f.read(), re.M)
+    return match.group(1) if match else "unknown"
+
+def formatBytes(size) -> str:
+    return "" if size is None else "%.1f MB" %(size / 1024 / 1024)
+
+def printResults(results: dict) -> None:
+    print("%-20s %10s %12s %14s" %("benchmark", "wall (s)", "peak RSS", "notebooks/s"))
+    for name, result in results["benchmarks"].items():
+        throughput = "" if result["throughput"] is None else "%.1f" %(result["throughput"])
+        print("%-20s %10.3f %12s %14s" %(name, result["wall"], formatBytes(result["peak_rss"]), throughput))
+        if "phases" in result:
+            print("    " + ", ".join("%s %.3fs" %(phase, seconds) for phase, seconds in list(result["phases"].items())[:4]))
+            if result["students"]["max"] is not None:
+                print("    per student p50 %.4fs, p95 %.4fs, max %.4fs" %(result["students"]["p50"], result["students"]["p95"], result["students"]["max"]))
+
+def compareResults(old_path: str, new_path: str) -> None:
+    with open(old_path, "r") as f:
+        old = json.load(f)
+    with open(new_path, "r") as f:
+        new = json.load(f)
+    if old["course"] != new["course"]:
+        print("WARNING: courses differ %s vs %s" %(old["course"], new["course"]))
+    print("%-20s %10s %10s %8s %12s %12s" %("benchmark", "old (s)", "new (s)", "ratio", "old RSS", "new RSS"))
+    for name in old["benchmarks"]:
+        if name not in new["benchmarks"]:
+            continue
+        o, n = old["benchmarks"][name], new["benchmarks"][name]
+        print("%-20s %10.3f %10.3f %7.2fx %12s %12s" %(name, o["wall"], n["wall"], n["wall"] / o["wall"] if o["wall"] > 0 else 0,
+                                                      formatBytes(o["peak_rss"]), formatBytes(n["peak_rss"])))
+        for phase in o.get("phases", {}):
+            if phase in n.get("phases", {}):
+                print("  %-18s %10.3f %10.3f" %(phase, o["phases"][phase], n["phases"][phase]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark nbhelper commands on a synthetic course, results are saved to benchmarks/results/<VERSION>-<time>.json")
+    parser.add_argument("--students", type=int, default=100)
+    parser.add_argument("--notebooks", type=int, default=2)
+    parser.add_argument("--cells", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark, the median is reported")
+    parser.add_argument("--jobs", type=int, default=1, help="Passed to nbhelper --jobs")
+    parser.add_argument("--only", type=str, nargs="+", default=None, choices=list(BENCHMARKS), metavar="name", help="Run only these benchmarks")
+    parser.add_argument("--profile", action="store_true", help="Run nbhelper with --profile and record the self time of each phase")
+    parser.add_argument("--nbhelper", type=str, default=NBHELPER, help="nbhelper.py to benchmark (eg. an older checkout)")
+    parser.add_argument("--work", type=str, default=None, help="Directory for the generated courses (default: a temporary directory)")
+    parser.add_argument("--output", type=str, default=None, help="Results file (default: benchmarks/results/<VERSION>-<time>.json)")
+    parser.add_argument("--compare", type=str, nargs=2, default=None, metavar=("old.json", "new.json"), help="Print the ratio of two saved results and exit")
+    args = parser.parse_args()
+    if args.compare is not None:
+        compareResults(*args.compare)
+        return
+    args.nbhelper = os.path.abspath(args.nbhelper)
+    work_dir = tempfile.mkdtemp(prefix="nbhelper-bench-") if args.work is None else os.path.abspath(args.work)
+    pristine_dir = os.path.join(work_dir, "pristine")
+    # generate the course once with mkcourse defaults for the pathology rates
+    course_args = mkcourse.makeParser().parse_args([pristine_dir, "--students", str(args.students), "--notebooks", str(args.notebooks),
+                                                    "--cells", str(args.cells), "--seed", str(args.seed)])
+    print("Generating course in " + pristine_dir)
+    course = mkcourse.makeCourse(pristine_dir, course_args)
+    results = {"version": nbhelperVersion(args.nbhelper), "nbhelper": args.nbhelper, "time": datetime.datetime.now().isoformat(timespec="seconds"),
+               "python": platform.python_version(), "platform": platform.platform(), "jobs": args.jobs, "repeat": args.repeat,
+               "course": course, "benchmarks": {}}
+    for name in BENCHMARKS if args.only is None else args.only:
+        print("Running " + name)
+        results["benchmarks"][name] = runBenchmark(name, pristine_dir, work_dir, args, args.notebooks)
+    printResults(results)
+    output = args.output
+    if output is None:
+        output = os.path.join(BENCH_DIR, "results", "%s-%s.json" %(results["version"], datetime.datetime.now().strftime("%m-%d-%H-%M")))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=1)
+    print("Results written to " + output)
+    if args.work is None:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
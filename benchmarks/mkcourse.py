@@ -0,0 +1,258 @@
+# Generates a synthetic <course_dir> for benchmarking nbhelper, see README.md
+# python benchmarks/mkcourse.py <course_dir> --students 200 --notebooks 2 --cells 20
+
+import argparse
+import base64
+import datetime
+import json
+import os
+import random
+import shutil
+import sqlite3
+import uuid
+
+ASSIGNMENT = "a1"
+
+def newCell(cell_type: str, source: list, nbgrader = None, outputs = None) -> dict:
+    cell = {"cell_type": cell_type, "metadata": {}, "source": source}
+    if nbgrader is not None:
+        cell["metadata"]["nbgrader"] = nbgrader
+    if cell_type == "code":
+        cell["execution_count"] = None
+        cell["outputs"] = [] if outputs is None else outputs
+    return cell
+
+def makeTemplate(nb_index: int, questions: int) -> dict:
+    cells = [newCell("markdown", ["# Notebook %s\n" %(nb_index), "Answer every question below.\n"])]
+    for q in range(questions):
+        cells.append(newCell("markdown", ["## Question %s\n" %(q + 1)]))
+        cells.append(newCell("code", ["def q%s(x, y):\n" %(q), "    result = 0\n", "    ### BEGIN SOLUTION\n", "    result = x + y\n", "    ### END SOLUTION\n", "    return result\n"],
+                             {"grade": False, "grade_id": "answer%s" %(q), "locked": False, "schema_version": 3, "solution": True, "task": False}))
+        cells.append(newCell("code", ["assert q%s(1, 2) is not None\n" %(q), "### BEGIN HIDDEN TESTS\n", "assert q%s(2, 2) == 4\n" %(q), "### END HIDDEN TESTS\n"],
+                             {"grade": True, "grade_id": "test%s" %(q), "locked": True, "points": 1 + q % 3, "schema_version": 3, "solution": False, "task": False}))
+    return {"cells": cells,
+            "metadata": {"kernelspec": {"display_name": "Python 3", "language": "python", "name": "python3"},
+                         "language_info": {"name": "python", "version": "3.8.0"}},
+            "nbformat": 4, "nbformat_minor": 2}
+
+def makeAnswer(rng: random.Random, q: int) -> list:
+    # a few lines of plausible student code, different for every seed
+    names = ["total", "value", "count", "result", "temp", "acc", "n", "i", "j", "item", "data", "out"]
+    lines = ["def q%s(x, y):\n" %(q), "    result = 0\n"]
+    for _ in range(rng.randint(3, 12)):
+        kind = rng.random()
+        a, b = rng.choice(names), rng.choice(names + ["x", "y"])
+        if kind < 0.3:
+            lines.append("    %s = %s %s %s\n" %(a, b, rng.choice(["+", "-", "*", "//", "%"]), rng.randint(1, 99)))
+        elif kind < 0.55:
+            lines += ["    for %s in range(%s):\n" %(rng.choice(["i", "j", "k"]), rng.randint(2, 20)), "        result += %s\n" %(b)]
+        elif kind < 0.75:
+            lines += ["    if %s %s %s:\n" %(b, rng.choice(["<", ">", "=="]), rng.randint(0, 50)), "        result = %s\n" %(a)]
+        elif kind < 0.9:
+            lines.append("    %s = [%s for v in range(%s)]\n" %(a, rng.choice(["v", "v * v", "v + x"]), rng.randint(2, 9)))
+        else:
+            lines.append("    # %s\n" %(rng.choice(["todo", "not sure about this", "works for the examples", "fix later"])))
+    lines.append("    return result\n")
+    return lines
+
+def renameAnswer(lines: list) -> list:
+    # a copied answer with the variable names changed
+    renames = {"total": "s", "value": "v2", "count": "c", "temp": "tmp", "acc": "a", "item": "elem", "data": "d", "out": "o"}
+    copied = []
+    for line in lines:
+        for old, new in renames.items():
+            line = line.replace(old, new)
+        copied.append(line)
+    return copied
+
+def hugeOutput(rng: random.Random, megabytes: float) -> list:
+    # an endless print loop and an inlined plot, both common in real submissions
+    text = "".join(rng.choice("0123456789 \n") for _ in range(1000)) * max(int(megabytes * 1024 * 0.5), 1)
+    image = base64.b64encode(os.urandom(int(megabytes * 1024 * 1024 * 0.375))).decode()
+    return [{"name": "stdout", "output_type": "stream", "text": [text]},
+            {"data": {"image/png": image, "text/plain": ["<Figure size 432x288 with 1 Axes>"]}, "metadata": {}, "output_type": "display_data"}]
+
+def makeSubmission(template: dict, rng: random.Random, answers: dict, args) -> tuple:
+    nb = json.loads(json.dumps(template))
+    pathologies = []
+    for cell in nb["cells"]:
+        grade_id = cell["metadata"].get("nbgrader", {}).get("grade_id", "")
+        if grade_id in answers:
+            cell["source"] = answers[grade_id]
+            cell["execution_count"] = rng.randint(1, 40)
+    if rng.random() < args.huge_outputs:
+        cell = nb["cells"][2]
+        cell["outputs"] = hugeOutput(rng, args.output_mb)
+        pathologies.append("huge_output")
+    if rng.random() < args.duplicates:
+        i = rng.randrange(2, len(nb["cells"]), 3) if len(nb["cells"]) > 2 else 0
+        nb["cells"].insert(i + 1, json.loads(json.dumps(nb["cells"][i])))
+        pathologies.append("duplicate_grade_id")
+    if rng.random() < args.missing_metadata:
+        graded = [cell for cell in nb["cells"] if "nbgrader" in cell["metadata"]]
+        if len(graded) > 0:
+            del rng.choice(graded)["metadata"]["nbgrader"]
+        if rng.random() < 0.5:
+            del nb["metadata"]["kernelspec"]
+        pathologies.append("missing_metadata")
+    if rng.random() < args.shuffled:
+        body = nb["cells"][1:]
+        rng.shuffle(body)
+        nb["cells"] = nb["cells"][:1] + body
+        pathologies.append("shuffled")
+    if rng.random() < args.scratch_cells:
+        nb["cells"].append(newCell("code", ["print(q0(1, 2))\n"], outputs=[{"name": "stdout", "output_type": "stream", "text": ["3\n"]}]))
+        pathologies.append("scratch_cell")
+    return nb, pathologies
+
+def autograde(nb: dict, rng: random.Random, pass_rate: float) -> list:
+    # marks each test cell as passed or failed, returns [(grade_id, score, points)]
+    scores = []
+    for cell in nb["cells"]:
+        nbgrader = cell["metadata"].get("nbgrader", {})
+        if "points" in nbgrader:
+            passed = rng.random() < pass_rate
+            if not passed:
+                cell["outputs"] = [{"ename": rng.choice(["AssertionError", "NameError", "TypeError"]), "evalue": "", "output_type": "error",
+                                    "traceback": ["Traceback (most recent call last)", "AssertionError"]}]
+            scores.append((nbgrader["grade_id"], float(nbgrader["points"]) if passed else 0.0, float(nbgrader["points"])))
+    return scores
+
+def feedbackHtml(nb_name: str, scores: list, image_kb: int) -> str:
+    # same score summary layout as nbgrader's feedback template, followed by the notebook with an inlined image
+    total = sum(score for _, score, _ in scores)
+    maximum = sum(points for _, _, points in scores)
+    html = ["<!DOCTYPE html>\n<html>\n<head><meta charset=\"utf-8\" /><title>%s</title></head>\n<body>\n" %(nb_name),
+            "<div class=\"panel-body\">\n<div id=\"toc\">\n",
+            "<h1>%s (Score: %.1f / %.1f)</h1>\n<ol>\n" %(nb_name, total, maximum)]
+    for grade_id, score, points in scores:
+        html.append("<li><a href=\"#%s\">Test cell</a> (Score: %.1f / %.1f)</li>\n" %(grade_id, score, points))
+    html.append("</ol>\n</div>\n</div>\n")
+    for grade_id, score, points in scores:
+        html.append("<div class=\"cell\" id=\"%s\"><div class=\"panel-heading\">Score: %.1f / %.1f</div><pre>assert ...</pre></div>\n" %(grade_id, score, points))
+    html.append("<img src=\"data:image/png;base64,%s\" />\n</body>\n</html>\n" %(base64.b64encode(os.urandom(image_kb * 768)).decode()))
+    return "".join(html)
+
+def writeGradebook(course_dir: str, nb_names: list, templates: list, grades: dict) -> None:
+    # nbgrader >= 0.6 schema, only the tables and columns nbhelper reads
+    # no late penalties, --ckgrades compares them against per-cell feedback scores which never include them
+    path = os.path.join(course_dir, "gradebook.db")
+    connection = sqlite3.connect(path)
+    connection.executescript("""
+        CREATE TABLE assignment (id VARCHAR(32) PRIMARY KEY, name VARCHAR(128) UNIQUE, duedate DATETIME, course_id VARCHAR(128));
+        CREATE TABLE notebook (id VARCHAR(32) PRIMARY KEY, name VARCHAR(128), assignment_id VARCHAR(32), UNIQUE (name, assignment_id));
+        CREATE TABLE base_cells (id VARCHAR(32) PRIMARY KEY, name VARCHAR(128), notebook_id VARCHAR(32), type VARCHAR(50), UNIQUE (name, notebook_id));
+        CREATE TABLE grade_cells (id VARCHAR(32) PRIMARY KEY, max_score FLOAT, cell_type VARCHAR(8));
+        CREATE TABLE student (id VARCHAR(128) PRIMARY KEY, first_name VARCHAR(128), last_name VARCHAR(128), email VARCHAR(128), lms_user_id VARCHAR(128));
+        CREATE TABLE submitted_assignment (id VARCHAR(32) PRIMARY KEY, assignment_id VARCHAR(32), student_id VARCHAR(128), timestamp DATETIME, extension FLOAT, UNIQUE (assignment_id, student_id));
+        CREATE TABLE submitted_notebook (id VARCHAR(32) PRIMARY KEY, assignment_id VARCHAR(32), notebook_id VARCHAR(32), flagged BOOLEAN, late_submission_penalty FLOAT, UNIQUE (assignment_id, notebook_id));
+        CREATE TABLE grade (id VARCHAR(32) PRIMARY KEY, cell_id VARCHAR(32), notebook_id VARCHAR(32), auto_score FLOAT, manual_score FLOAT, extra_credit FLOAT, needs_manual_grade BOOLEAN, UNIQUE (cell_id, notebook_id));
+    """)
+    assignment_id = uuid.uuid4().hex
+    connection.execute("INSERT INTO assignment VALUES (?, ?, NULL, 'course')", (assignment_id, ASSIGNMENT))
+    cell_ids = {}
+    for nb_name, template in zip(nb_names, templates):
+        notebook_id = uuid.uuid4().hex
+        connection.execute("INSERT INTO notebook VALUES (?, ?, ?)", (notebook_id, os.path.splitext(nb_name)[0], assignment_id))
+        for cell in template["cells"]:
+            nbgrader = cell["metadata"].get("nbgrader", {})
+            if "points" in nbgrader:
+                cell_ids[(nb_name, nbgrader["grade_id"])] = uuid.uuid4().hex
+                connection.execute("INSERT INTO base_cells VALUES (?, ?, ?, 'GradeCell')", (cell_ids[(nb_name, nbgrader["grade_id"])], nbgrader["grade_id"], notebook_id))
+                connection.execute("INSERT INTO grade_cells VALUES (?, ?, 'code')", (cell_ids[(nb_name, nbgrader["grade_id"])], float(nbgrader["points"])))
+        cell_ids[nb_name] = notebook_id
+    for student_id, (timestamp, notebooks) in sorted(grades.items()):
+        submission_id = uuid.uuid4().hex
+        connection.execute("INSERT INTO student VALUES (?, NULL, NULL, NULL, NULL)", (student_id,))
+        connection.execute("INSERT INTO submitted_assignment VALUES (?, ?, ?, ?, NULL)", (submission_id, assignment_id, student_id, timestamp))
+        for nb_name, scores in notebooks.items():
+            submitted_id = uuid.uuid4().hex
+            connection.execute("INSERT INTO submitted_notebook VALUES (?, ?, ?, 0, 0.0)", (submitted_id, submission_id, cell_ids[nb_name]))
+            for grade_id, score, _ in scores:
+                if (nb_name, grade_id) in cell_ids:
+                    connection.execute("INSERT INTO grade VALUES (?, ?, ?, ?, NULL, NULL, 0)", (uuid.uuid4().hex, cell_ids[(nb_name, grade_id)], submitted_id, score))
+    connection.commit()
+    connection.close()
+
+def writeJson(fname: str, data: dict) -> None:
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    with open(fname, "w", encoding="utf8") as f:
+        json.dump(data, f, sort_keys=True, indent=1, separators=(',', ': '), ensure_ascii=False)
+        f.write("\n")
+
+def makeCourse(course_dir: str, args) -> dict:
+    rng = random.Random(args.seed)
+    shutil.rmtree(course_dir, ignore_errors=True)
+    questions = max(args.cells // 2, 1)
+    nb_names = ["nb%s.ipynb" %(m + 1) for m in range(args.notebooks)]
+    templates = [makeTemplate(m + 1, questions) for m in range(args.notebooks)]
+    for nb_name, template in zip(nb_names, templates):
+        writeJson(os.path.join(course_dir, "source", ASSIGNMENT, nb_name), template)
+        writeJson(os.path.join(course_dir, "release", ASSIGNMENT, nb_name), template)
+    student_ids = ["%08d" %(10000000 + s) for s in range(args.students)]
+    # every copier shares answers with another student, renamed half of the time
+    copied_from = {}
+    for s in range(1, args.students):
+        if rng.random() < args.copies:
+            copied_from[student_ids[s]] = student_ids[rng.randrange(s)]
+    answers = {}
+    summary = {"students": args.students, "notebooks": args.notebooks, "cells": questions * 2, "pathologies": {}, "copies": len(copied_from)}
+    grades = {}
+    due = datetime.datetime(2020, 10, 1, 23, 59)
+    for student_id in student_ids:
+        student_rng = random.Random("%s-%s" %(args.seed, student_id))
+        timestamp = str(due - datetime.timedelta(minutes=student_rng.randint(-60, 60 * 24 * 5), microseconds=student_rng.randint(0, 999999)))
+        grades[student_id] = (timestamp, {})
+        for nb_name, template in zip(nb_names, templates):
+            if student_id in copied_from:
+                answers[(student_id, nb_name)] = {grade_id: renameAnswer(lines) if student_rng.random() < 0.5 else list(lines)
+                                                  for grade_id, lines in answers[(copied_from[student_id], nb_name)].items()}
+            else:
+                answers[(student_id, nb_name)] = {"answer%s" %(q): makeAnswer(student_rng, q) for q in range(questions)}
+            nb, pathologies = makeSubmission(template, student_rng, answers[(student_id, nb_name)], args)
+            for pathology in pathologies:
+                summary["pathologies"][pathology] = summary["pathologies"].get(pathology, 0) + 1
+            writeJson(os.path.join(course_dir, "submitted", student_id, ASSIGNMENT, nb_name), nb)
+            # autograded and feedback come from the clean template so dist/fdist/ckgrades agree
+            graded = json.loads(json.dumps(template))
+            scores = autograde(graded, student_rng, args.pass_rate)
+            grades[student_id][1][nb_name] = scores
+            writeJson(os.path.join(course_dir, "autograded", student_id, ASSIGNMENT, nb_name), graded)
+            html_path = os.path.join(course_dir, "feedback", student_id, ASSIGNMENT, os.path.splitext(nb_name)[0] + ".html")
+            os.makedirs(os.path.dirname(html_path), exist_ok=True)
+            with open(html_path, "w", encoding="utf8") as f:
+                f.write(feedbackHtml(os.path.splitext(nb_name)[0], scores, args.image_kb))
+        with open(os.path.join(course_dir, "submitted", student_id, ASSIGNMENT, "timestamp.txt"), "w") as f:
+            f.write(timestamp + " UTC")
+    writeGradebook(course_dir, nb_names, templates, grades)
+    with open(os.path.join(course_dir, "classlist.csv"), "w") as f:
+        f.write("OrgDefinedId,Last Name,First Name,Email\n")
+        for i, student_id in enumerate(student_ids):
+            f.write("#%s,Last%s,First%s,%s@example.com\n" %(student_id, i, i, student_id))
+    return summary
+
+def makeParser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Generate a synthetic nbgrader course directory with N students x M notebooks x K nbgrader cells")
+    parser.add_argument("course_dir", type=str, help="Where to create the course (deleted first if it exists)")
+    parser.add_argument("--students", type=int, default=100)
+    parser.add_argument("--notebooks", type=int, default=2)
+    parser.add_argument("--cells", type=int, default=20, help="nbgrader cells per notebook (half answer cells, half test cells)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--huge-outputs", type=float, default=0.05, dest="huge_outputs", help="Fraction of notebooks with a huge output")
+    parser.add_argument("--output-mb", type=float, default=2, dest="output_mb", help="Size of each huge output in MB")
+    parser.add_argument("--duplicates", type=float, default=0.05, help="Fraction of notebooks with a duplicated grade_id")
+    parser.add_argument("--shuffled", type=float, default=0.05, help="Fraction of notebooks with shuffled cells")
+    parser.add_argument("--missing-metadata", type=float, default=0.05, dest="missing_metadata", help="Fraction of notebooks missing nbgrader or kernel metadata")
+    parser.add_argument("--scratch-cells", type=float, default=0.2, dest="scratch_cells", help="Fraction of notebooks with an extra student cell")
+    parser.add_argument("--copies", type=float, default=0.05, help="Fraction of students who copy another student's answers")
+    parser.add_argument("--pass-rate", type=float, default=0.7, dest="pass_rate")
+    parser.add_argument("--image-kb", type=int, default=200, dest="image_kb", help="Size of the image inlined in each feedback html")
+    return parser
+
+def main():
+    args = makeParser().parse_args()
+    summary = makeCourse(args.course_dir, args)
+    print(json.dumps(summary, indent=1))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# Startup cost of each nbhelper command on a small synthetic course, see README.md
+# python benchmarks/startup.py --repeat 5
+# python benchmarks/startup.py --nbhelper path/to/old/nbhelper.py
+
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import bench
+import mkcourse
+
+IMPORT_TIME = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+def importTimes(stderr: str) -> dict:
+    # module: self time in microseconds for every module python imported (python -X importtime)
+    modules = {}
+    for line in stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match:
+            modules[match.group(4)] = int(match.group(1))
+    return modules
+
+def runStartup(nbhelper: str, course_dir: str, command: list) -> dict:
+    argv = [sys.executable, "-X", "importtime", nbhelper, "--cdir", course_dir] + command
+    start = time.perf_counter()
+    process = subprocess.run(argv, cwd=course_dir, input=b"n\n", stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    wall = time.perf_counter() - start
+    modules = importTimes(process.stderr.decode(errors="replace"))
+    return {"wall": wall, "imports": sum(modules.values()) / 1e6, "modules": modules}
+
+def main():
+    parser = argparse.ArgumentParser(description="Time interpreter startup and imports for each nbhelper command (python -X importtime) on a small course, results are saved to benchmarks/results/startup-<VERSION>-<time>.json")
+    parser.add_argument("--students", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per command, the fastest is reported")
+    parser.add_argument("--only", type=str, nargs="+", default=None, choices=list(bench.BENCHMARKS), metavar="name", help="Run only these commands")
+    parser.add_argument("--nbhelper", type=str, default=bench.NBHELPER, help="nbhelper.py to time (eg. an older checkout)")
+    parser.add_argument("--output", type=str, default=None, help="Results file (default: benchmarks/results/startup-<VERSION>-<time>.json)")
+    args = parser.parse_args()
+    args.nbhelper = os.path.abspath(args.nbhelper)
+    work_dir = tempfile.mkdtemp(prefix="nbhelper-startup-")
+    pristine_dir = os.path.join(work_dir, "pristine")
+    mkcourse.makeCourse(pristine_dir, mkcourse.makeParser().parse_args([pristine_dir, "--students", str(args.students), "--huge-outputs", "0", "--image-kb", "1"]))
+    # the interpreter alone and nbhelper without a command are the floor for every command
+    commands = {"python": None, "help": ["-h"]}
+    commands.update({name: command for name, (_, command, _) in bench.BENCHMARKS.items() if args.only is None or name in args.only})
+    results = {"version": bench.nbhelperVersion(args.nbhelper), "nbhelper": args.nbhelper, "python": sys.version.split()[0], "commands": {}}
+    for name, command in commands.items():
+        runs = []
+        for _ in range(args.repeat):
+            if command is None:
+                start = time.perf_counter()
+                subprocess.run([sys.executable, "-c", "pass"], check=True)
+                runs.append({"wall": time.perf_counter() - start, "imports": 0.0, "modules": {}})
+                continue
+            # commands that change the course get a fresh copy, setup commands are not needed to measure imports
+            course_dir = os.path.join(work_dir, name)
+            shutil.rmtree(course_dir, ignore_errors=True)
+            shutil.copytree(pristine_dir, course_dir)
+            runs.append(runStartup(args.nbhelper, course_dir, command))
+        fastest = min(runs, key=lambda run: run["wall"])
+        heaviest = sorted(fastest["modules"].items(), key=lambda item: -item[1])[:5]
+        results["commands"][name] = {"command": command, "wall": fastest["wall"], "imports": fastest["imports"],
+                                     "module_count": len(fastest["modules"]), "heaviest": heaviest}
+    print("%-20s %10s %12s %8s  %s" %("command", "wall (ms)", "imports (ms)", "modules", "heaviest imports (ms)"))
+    for name, result in results["commands"].items():
+        print("%-20s %10.1f %12.1f %8s  %s" %(name, result["wall"] * 1000, result["imports"] * 1000, result["module_count"],
+                                            ", ".join("%s %.1f" %(module, self_time / 1000) for module, self_time in result["heaviest"])))
+    output = args.output
+    if output is None:
+        output = os.path.join(bench.BENCH_DIR, "results", "startup-%s-%s.json" %(results["version"], time.strftime("%m-%d-%H-%M")))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=1)
+    print("Results written to " + output)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
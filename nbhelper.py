@@ -28,23 +28,29 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+from __future__ import annotations
+
 import json
 import os
 import csv
 import sys
 import argparse
 import collections
-import smtplib
-import email
 import time
 import datetime
-import mimetypes
-import zipfile
-import shutil
-import urllib.request
 import typing
-import glob
 import re
+import io
+import contextlib
+import threading
+import bisect
+import hashlib
+import functools
+import queue
+import itertools
+import keyword
+import array
+import math
 
 ####### Config #######
 
@@ -52,7 +58,7 @@ VERSION = "0.3.4"
 
 EMAIL_CONFIG = {
     "CC_ADDRESS": None, # "ccemail@domain.com" or SELF to cc MY_EMAIL_ADDRESS
-    "EMAIL_DELAY": None, # time delay between sending each email in seconds
+    "EMAIL_DELAY": None, # average time between sending each email in seconds (rate limit across all connections)
     "EMAIL_SUBJECT": None, # "email subject"
     "EMAIL_MESSAGE": None, # "email message text"
     "EMAIL_HTML": None, # "email message html" or FEEDBACK
@@ -60,13 +66,55 @@ EMAIL_CONFIG = {
     "MY_EMAIL_ADDRESS": None, # "myemail@domain.com"
     "MY_SMTP_SERVER": None, # "smtp.domain.com", script uses TLS on port 587
     "MY_SMTP_USERNAME": None, # "myusername"
-    "MY_SMTP_PASSWORD": None # leave as None for prompt each time
+    "MY_SMTP_PASSWORD": None, # leave as None for prompt each time
+    "SMTP_PORT": 587, # 587 for TLS, or the port of a local test server (eg. 8025 for python -m aiosmtpd -n -l localhost:8025, see README)
+    "SMTP_STARTTLS": True, # set to False for a local test server
+    "SMTP_CONNECTIONS": 2 # number of connections to send over at once
+}
+
+# bump a parser's version whenever its output changes so stale results in <course_dir>/.nbhelper-cache are ignored
+CACHE_VERSIONS = {
+    "getAutogradedScore": 1,
+    "getFeedbackScore": 2,
+    "getQuestionAnswers": 2,
+    "quickInfo": 1
+}
+
+KERNEL_CONFIG = {
+    "KERNEL_NAME": "python3", # kernel used by --forcegrade --warmkernels
+    "PRELOAD": ["numpy", "pandas", "matplotlib"], # modules imported once when each kernel starts (skipped if missing)
+    "CELL_TIMEOUT": 60, # seconds per cell before interrupting, same as the nbconvert command
+    "STARTUP_TIMEOUT": 60 # seconds to wait for preloading, namespace resets, and interrupts
+}
+
+# runs silently before each notebook, clears the previous student's variables and any modules imported from their directory
+KERNEL_RESET_CODE = """%%reset -f
+def __nbhelper_reset(notebook_dir):
+    import sys, os
+    previous_dir = getattr(sys, "_nbhelper_dir", None)
+    if previous_dir is not None:
+        for name, module in list(sys.modules.items()):
+            if os.path.abspath(str(getattr(module, "__file__", None))).startswith(previous_dir + os.sep):
+                del sys.modules[name]
+    sys._nbhelper_dir = notebook_dir
+    os.chdir(notebook_dir)
+__nbhelper_reset(%r)
+del __nbhelper_reset
+"""
+
+SIMCHECK_CONFIG = {
+    "KGRAM": 12, # tokens per fingerprinted k-gram (after normalizing variable names, strings, and numbers)
+    "WINDOW": 8, # winnowing window, any match at least KGRAM + WINDOW - 1 tokens long is always found
+    "MAX_STUDENTS": 10, # fingerprints shared by more students are treated as common code and ignored (like moss -m)
+    "MIN_SHARED": 3, # pairs sharing fewer fingerprints are left out of the report
+    "MAX_HISTORY": 20, # fingerprints found in more past submissions are treated as common code when checking history
+    "DATABASE": None # fingerprint database path, None for <course_dir>/moss/fingerprints.db (point every course at one file to check across terms)
 }
 
 NB_HELP = """
 REMEMBER TO BACKUP THE SUBMITTED NOTEBOOKS REGULARLY
 most of the course can be regenerated from these along with your source notebooks
-you may also want to backup gradebook.db to save any manual grading (I think it's saved there, this script never touches it)
+you may also want to backup gradebook.db to save any manual grading (I think it's saved there, this script only ever opens it read-only for --ckgrades)
 this script is designed to be as nondestructive as possible, most functions just read course files but some do make modifications to the submitted notebooks, trying for minimal modifications and only when necessary
 
 --Quick reference for nbgrader usage--
@@ -117,7 +165,7 @@ hint for installation: you can run python nbhelper.py directly, but if you want
 this script does not use any external libraries, however it depends on the JSON metadata format used by jupyter and nbgrader (below)
 https://nbformat.readthedocs.io/en/latest/format_description.html
 https://nbgrader.readthedocs.io/en/stable/contributor_guide/metadata.html
-all functions work on the ipynb/html files directly, it never touches the nbgrader database (gradebook.db) or use the nbgrader api
+all functions work on the ipynb/html files directly, it never writes to the nbgrader database (gradebook.db, only read by --ckgrades) or uses the nbgrader api
 this allows for more flexibility to repair notebooks nbgrader does not know how to handle and provides robustness in the event of mismatched versions or weird configuration changes by others
 
 --Test Case Templates--
@@ -148,25 +196,356 @@ def readCsv(fName: str, delimiter = ",") -> list:
             data.append(row)
     return data
 
+def iterTextLines(fname: str, chunk_size: int = 1 << 16, max_line: int = 1 << 16) -> typing.Iterator[str]:
+    # reads in chunks and skips lines longer than max_line (eg. inlined base64 images) without holding them in memory
+    with open(fname, "r", encoding="utf8", errors="ignore") as f:
+        partial = ""
+        skipping = False
+        for chunk in iter(lambda: f.read(chunk_size), ""):
+            lines = (partial + chunk).split("\n")
+            partial = lines.pop()
+            for line in lines:
+                if skipping:
+                    skipping = False
+                else:
+                    yield line + "\n"
+            if len(partial) > max_line:
+                partial = ""
+                skipping = True
+        if partial != "" and not skipping:
+            yield partial
+
 def readJson(fname: str) -> dict:
-    with open(fname, "r", errors="ignore") as json_file:  
+    with profilePhase("readJson"), open(fname, "r", encoding="utf8", errors="ignore") as json_file:
         data = json.load(json_file)
     return data
 
-def writeJson(fname: str, data: dict) -> None:
-    if not os.path.isdir(os.path.dirname(fname)):
+class JsonStreamScanner:
+    # minimal incremental JSON scanner, only buffers the value currently being captured
+    CHUNK_SIZE = 1 << 16
+    NON_WHITESPACE = re.compile(r'[^ \t\r\n]')
+    STRING_SPECIAL = re.compile(r'["\\]')
+    CONTAINER_SPECIAL = re.compile(r'["{}\[\]]')
+    SCALAR_END = re.compile(r'[ \t\r\n,}\]]')
+
+    def __init__(self, f: typing.TextIO):
+        self.f = f
+        self.buf = ""
+        self.pos = 0
+        self.mark = None
+
+    def fill(self) -> None:
+        # discard everything before the current position (or capture mark) and read another chunk
+        keep = self.pos if self.mark is None else self.mark
+        chunk = self.f.read(self.CHUNK_SIZE)
+        if not chunk:
+            raise ValueError("Unexpected end of JSON data")
+        self.buf = self.buf[keep:] + chunk
+        self.pos -= keep
+        if self.mark is not None:
+            self.mark = 0
+
+    def peek(self) -> str:
+        while True:
+            match = self.NON_WHITESPACE.search(self.buf, self.pos)
+            if match:
+                self.pos = match.start()
+                return self.buf[self.pos]
+            self.pos = len(self.buf)
+            self.fill()
+
+    def next(self) -> str:
+        char = self.peek()
+        self.pos += 1
+        return char
+
+    def expect(self, char: str) -> None:
+        if self.next() != char:
+            raise ValueError("Expected '%s' at position %s" %(char, self.pos))
+
+    def skipString(self) -> None:
+        self.pos += 1
+        while True:
+            match = self.STRING_SPECIAL.search(self.buf, self.pos)
+            if match is None:
+                self.pos = len(self.buf)
+                self.fill()
+            elif match.group() == "\\":
+                self.pos = match.start()
+                while len(self.buf) < self.pos + 2:
+                    self.fill()
+                self.pos += 2
+            else:
+                self.pos = match.end()
+                return
+
+    def skipValue(self) -> None:
+        char = self.peek()
+        if char == '"':
+            self.skipString()
+        elif char in "{[":
+            depth = 0
+            while True:
+                match = self.CONTAINER_SPECIAL.search(self.buf, self.pos)
+                if match is None:
+                    self.pos = len(self.buf)
+                    self.fill()
+                    continue
+                self.pos = match.start()
+                if match.group() == '"':
+                    self.skipString()
+                    continue
+                self.pos += 1
+                depth += 1 if match.group() in "{[" else -1
+                if depth == 0:
+                    return
+        else:
+            while True:
+                match = self.SCALAR_END.search(self.buf, self.pos)
+                if match:
+                    self.pos = match.start()
+                    return
+                self.pos = len(self.buf)
+                self.fill()
+
+    def readValue(self):
+        self.peek()
+        self.mark = self.pos
+        try:
+            self.skipValue()
+            return json.loads(self.buf[self.mark:self.pos])
+        finally:
+            self.mark = None
+
+def hasPoints(cell: dict) -> bool:
+    try:
+        return "points" in cell["metadata"]["nbgrader"]
+    except:
+        return False
+
+def iterNotebookCells(fname: str, keep_outputs = hasPoints) -> typing.Iterator[dict]:
+    # yields cells one at a time without loading the whole notebook
+    # outputs of cells failing keep_outputs(cell) are skipped without being buffered when metadata precedes outputs (as jupyter writes it), otherwise discarded after parsing
+    with open(fname, "r", encoding="utf8", errors="ignore") as json_file:
+        scanner = JsonStreamScanner(json_file)
+        scanner.expect("{")
+        if scanner.peek() == "}":
+            return
+        while True:
+            key = scanner.readValue()
+            scanner.expect(":")
+            if key == "cells":
+                scanner.expect("[")
+                if scanner.peek() == "]":
+                    scanner.next()
+                else:
+                    while True:
+                        yield readStreamedCell(scanner, keep_outputs)
+                        if scanner.next() == "]":
+                            break
+            else:
+                scanner.skipValue()
+            if scanner.next() == "}":
+                return
+
+def readStreamedCell(scanner: JsonStreamScanner, keep_outputs) -> dict:
+    if scanner.peek() != "{":
+        return scanner.readValue()
+    scanner.next()
+    cell = {}
+    if scanner.peek() == "}":
+        scanner.next()
+        return cell
+    while True:
+        key = scanner.readValue()
+        scanner.expect(":")
+        if key == "outputs" and "metadata" in cell and not keep_outputs(cell):
+            scanner.skipValue()
+            cell[key] = []
+        else:
+            cell[key] = scanner.readValue()
+        if scanner.next() == "}":
+            break
+    if "outputs" in cell and not keep_outputs(cell):
+        cell["outputs"] = []
+    return cell
+
+def writeJson(fname: str, data: dict) -> bool:
+    with profilePhase("writeJson"):
+        return writeJsonBytes(fname, data)
+
+def writeJsonBytes(fname: str, data: dict) -> bool:
+    # serialize the same way as nbformat so unchanged regions stay byte identical, and skip the write if nothing changed
+    new_bytes = (json.dumps(data, sort_keys=True, indent=1, separators=(',', ': '), ensure_ascii=False) + "\n").encode("utf8", errors="backslashreplace")
+    try:
+        if os.path.getsize(fname) == len(new_bytes):
+            with open(fname, "rb") as json_file:
+                if json_file.read() == new_bytes:
+                    return False
+    except OSError:
+        pass
+    writeFileAtomic(fname, new_bytes)
+    return True
+
+def writeFileAtomic(fname: str, data: bytes) -> None:
+    import shutil
+    # write to a temporary file in the same directory then rename over the original, keeping its permissions
+    if os.path.dirname(fname) != "" and not os.path.isdir(os.path.dirname(fname)):
         os.makedirs(os.path.dirname(fname))
-    with open(fname, "w", errors="ignore") as json_file:  
-        json.dump(data, json_file, indent=1, separators=(',', ': '))
+    tmp_path = "%s.%s-%s.tmp" %(fname, os.getpid(), threading.get_ident())
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(fname):
+            shutil.copymode(fname, tmp_path)
+        os.replace(tmp_path, fname)
+    except:
+        os.remove(tmp_path)
+        raise
 
-def sendEmail(smtp_server: typing.Union[str, smtplib.SMTP],
-              smtp_user: str, smtp_pwd: str,
-              sender: str, recipient: str,
-              subject: str, 
-              cc: typing.Union[str, None] = None,
-              body: typing.Union[str, None] = None,
-              html: typing.Union[str, None] = None,
-              attachment_path: typing.Union[str, None] = None):
+def readResultCache(course_dir: str, name: str) -> dict:
+    cache_path = os.path.join(course_dir, ".nbhelper-cache", name + ".json")
+    try:
+        with open(cache_path, "r", encoding="utf8") as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        cache = {}
+    return cache
+
+def writeResultCache(course_dir: str, name: str, cache: dict) -> None:
+    # evict entries for files that no longer exist
+    for path in [path for path in cache if not os.path.isfile(path)]:
+        del cache[path]
+    cache_path = os.path.join(course_dir, ".nbhelper-cache", name + ".json")
+    writeFileAtomic(cache_path, json.dumps(cache, separators=(',', ':')).encode("utf8"))
+
+def cacheResults(func, cache: dict, version: int, by_hash: bool = False):
+    # wraps func(fullPath, studentID) so results are only recomputed when the file's mtime or size (or content with by_hash) changes
+    def cachedFunc(fullPath: str, studentID: str, *args, **kwargs):
+        key = os.path.abspath(fullPath)
+        if by_hash:
+            stamp = [hashFile(fullPath), version]
+        else:
+            stat = os.stat(fullPath)
+            stamp = [stat.st_mtime_ns, stat.st_size, version]
+        if key in cache and cache[key]["stamp"] == stamp:
+            return cache[key]["result"]
+        result = func(fullPath, studentID, *args, **kwargs)
+        cache[key] = {"stamp": stamp, "result": result}
+        return result
+    return functools.wraps(func)(cachedFunc)
+
+PROFILER = None
+
+class PhaseProfiler:
+    # wall time per phase and per student for --profile, phases nest so self time excludes time spent in nested phases
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.phases = {} # name: [calls, total seconds, self seconds]
+        self.students = {} # student_id: [seconds, files, bytes]
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        stack = self.local.__dict__.setdefault("stack", [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            if len(stack) > 0:
+                stack[-1] += elapsed
+            with self.lock:
+                entry = self.phases.setdefault(name, [0, 0.0, 0.0])
+                entry[0] += 1
+                entry[1] += elapsed
+                entry[2] += elapsed - nested
+
+    @contextlib.contextmanager
+    def student(self, studentID: str, paths: list):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            size = sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+            with self.lock:
+                entry = self.students.setdefault(studentID, [0.0, 0, 0])
+                entry[0] += elapsed
+                entry[1] += len(paths)
+                entry[2] += size
+
+    def drain(self) -> dict:
+        # records since the last drain, used to send a worker process' timings back to the parent
+        with self.lock:
+            records = {"phases": self.phases, "students": self.students}
+            self.phases, self.students = {}, {}
+        return records
+
+    def merge(self, records: dict) -> None:
+        with self.lock:
+            for name, (calls, total, self_time) in records["phases"].items():
+                entry = self.phases.setdefault(name, [0, 0.0, 0.0])
+                entry[0] += calls
+                entry[1] += total
+                entry[2] += self_time
+            for studentID, (seconds, files, size) in records["students"].items():
+                entry = self.students.setdefault(studentID, [0.0, 0, 0])
+                entry[0] += seconds
+                entry[1] += files
+                entry[2] += size
+
+    def summary(self, commands: list, slowest: int = 10, bins: int = 10) -> dict:
+        seconds = sorted(entry[0] for entry in self.students.values())
+        def percentile(p):
+            # nearest rank
+            return seconds[max(math.ceil(p / 100 * len(seconds)) - 1, 0)] if len(seconds) > 0 else None
+        maximum = seconds[-1] if len(seconds) > 0 else 0.0
+        counts = [0] * bins
+        for value in seconds:
+            counts[min(int(value / maximum * bins), bins - 1) if maximum > 0 else 0] += 1
+        return {"commands": commands, "version": VERSION, "wall": time.perf_counter() - self.start,
+                "phases": {name: {"calls": calls, "total": total, "self": self_time}
+                           for name, (calls, total, self_time) in sorted(self.phases.items(), key=lambda item: -item[1][2])},
+                "students": {"count": len(seconds), "total": math.fsum(seconds), "p50": percentile(50), "p95": percentile(95), "max": percentile(100),
+                             "histogram": [[maximum * i / bins, maximum * (i + 1) / bins, counts[i]] for i in range(bins)]},
+                "slowest": [{"student_id": studentID, "seconds": entry[0], "files": entry[1], "bytes": entry[2]}
+                            for studentID, entry in sorted(self.students.items(), key=lambda item: -item[1][0])[:slowest]]}
+
+def profilePhase(name: str):
+    # no-op unless --profile was given
+    return PROFILER.phase(name) if PROFILER is not None else contextlib.nullcontext()
+
+def profileStudent(studentID: str, *paths: str):
+    return PROFILER.student(studentID, paths) if PROFILER is not None else contextlib.nullcontext()
+
+def printProfile(summary: dict) -> None:
+    print("%-24s %8s %12s %12s" %("Phase", "Calls", "Total (s)", "Self (s)"))
+    for name, phase in summary["phases"].items():
+        print("%-24s %8s %12.3f %12.3f" %(name, phase["calls"], phase["total"], phase["self"]))
+    students = summary["students"]
+    if students["count"] > 0:
+        print("Per student (%s): p50 %.4fs, p95 %.4fs, max %.4fs" %(students["count"], students["p50"], students["p95"], students["max"]))
+        for low, high, count in students["histogram"]:
+            print("%8.4f - %8.4f s | %s" %(low, high, "#" * math.ceil(count / max(students["count"], 1) * 50)))
+        for student in summary["slowest"]:
+            print("%s: %.4fs, %s files, %.1f KB" %(student["student_id"], student["seconds"], student["files"], student["bytes"] / 1024))
+    print("Total: %.3fs" %(summary["wall"]))
+
+def buildEmailMessage(sender: str, recipient: str,
+                      subject: str,
+                      cc: typing.Union[str, None] = None,
+                      body: typing.Union[str, None] = None,
+                      html: typing.Union[str, None] = None,
+                      attachment_path: typing.Union[str, None] = None) -> email.message.EmailMessage:
+    import email.message
+    import mimetypes
     message = email.message.EmailMessage()
     message["From"] = sender
     message["To"] = recipient
@@ -190,18 +569,160 @@ def sendEmail(smtp_server: typing.Union[str, smtplib.SMTP],
                                    maintype=maintype,
                                    subtype=subtype,
                                    filename=filename)
+    return message
+
+def openSmtpConnection(smtp_server: str, smtp_user: typing.Union[str, None], smtp_pwd: typing.Union[str, None], port: int = 587, starttls: bool = True) -> smtplib.SMTP:
+    import smtplib
+    class TrackedSMTP(smtplib.SMTP):
+        # once DATA was sent a dropped connection may still have delivered the message
+        data_sent = False
+        def data(self, msg):
+            self.data_sent = True
+            return super().data(msg)
+    smtp_server_instance = TrackedSMTP(smtp_server, port=port)
+    try:
+        smtp_server_instance.ehlo()
+        if starttls:
+            smtp_server_instance.starttls()
+            smtp_server_instance.ehlo()
+        if smtp_user is not None:
+            smtp_server_instance.login(smtp_user, smtp_pwd)
+    except:
+        smtp_server_instance.close()
+        raise
+    return smtp_server_instance
+
+class SmtpPool:
+    # up to size authenticated connections shared between threads, opened on first use and reopened if dropped
+    def __init__(self, smtp_server: str, smtp_user: typing.Union[str, None], smtp_pwd: typing.Union[str, None], size: int = 1, port: int = 587, starttls: bool = True):
+        self.connect_args = (smtp_server, smtp_user, smtp_pwd, port, starttls)
+        self.connections = queue.Queue()
+        # None is a free slot that hasn't been connected yet
+        for i in range(max(size, 1)):
+            self.connections.put(None)
+
+    def send_message(self, message: email.message.EmailMessage) -> None:
+        import smtplib
+        import socket
+        connection = self.connections.get()
+        try:
+            if connection is None:
+                connection = openSmtpConnection(*self.connect_args)
+            try:
+                connection.data_sent = False
+                connection.send_message(message)
+            except (smtplib.SMTPServerDisconnected, ConnectionError, socket.timeout) as e:
+                # connection dropped (idle timeout, server limit, etc.), reconnect once and retry unless the message may already be delivered
+                data_sent = connection.data_sent
+                self.close(connection)
+                connection = None
+                if data_sent:
+                    raise smtplib.SMTPServerDisconnected("Connection dropped after the message was sent, it may have been delivered (not retried): " + repr(e))
+                connection = openSmtpConnection(*self.connect_args)
+                connection.send_message(message)
+        finally:
+            self.connections.put(connection)
+
+    def close(self, connection: smtplib.SMTP) -> None:
+        try:
+            connection.quit()
+        except:
+            connection.close()
+
+    def quit(self) -> None:
+        while not self.connections.empty():
+            connection = self.connections.get()
+            if connection is not None:
+                self.close(connection)
+
+class TokenBucket:
+    # allows bursts of up to capacity, then rate tokens per second, shared between threads
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class EmailJournal:
+    # append-only (and fsync'd) record of each delivery attempt, keyed by student and a hash of what was sent
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.isfile(path):
+            with open(path, "r", encoding="utf8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.entries[entry["student_id"]] = entry
+                    except (ValueError, KeyError, TypeError):
+                        # partial line from an interrupted run
+                        pass
+
+    def delivered(self, student_id: str, file_hash: str) -> bool:
+        entry = self.entries.get(student_id)
+        return entry is not None and entry["sent"] and entry["sha256"] == file_hash
+
+    def record(self, student_id: str, file_hash: str, sent: bool) -> None:
+        entry = {"student_id": student_id, "sha256": file_hash, "sent": sent, "time": datetime.datetime.now().isoformat()}
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "a", encoding="utf8") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.entries[student_id] = entry
+
+def hashFile(fname: str) -> str:
+    sha256 = hashlib.sha256()
+    with profilePhase("hashFile"), open(fname, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def sendEmail(smtp_server: typing.Union[str, smtplib.SMTP, SmtpPool],
+              smtp_user: str, smtp_pwd: str,
+              sender: str, recipient: str,
+              subject: str, 
+              cc: typing.Union[str, None] = None,
+              body: typing.Union[str, None] = None,
+              html: typing.Union[str, None] = None,
+              attachment_path: typing.Union[str, None] = None,
+              port: int = 587,
+              starttls: bool = True):
+    message = buildEmailMessage(sender, recipient, subject, cc = cc, body = body, html = html, attachment_path = attachment_path)
     if type(smtp_server) == str:
         try:
-            with smtplib.SMTP(smtp_server, port=587) as smtp_server_instance:
-                smtp_server_instance.ehlo()
-                smtp_server_instance.starttls()
-                smtp_server_instance.login(smtp_user, smtp_pwd)
+            with openSmtpConnection(smtp_server, smtp_user, smtp_pwd, port, starttls) as smtp_server_instance:
                 smtp_server_instance.send_message(message)
             return True
         except Exception as e:
             print ("Failed to send mail %s to %s" %(subject, recipient))
             print (e)
             return False
+    elif isinstance(smtp_server, SmtpPool):
+        try:
+            smtp_server.send_message(message)
+            return True
+        except Exception as e:
+            print ("Failed to send mail %s to %s" %(subject, recipient))
+            print (e)
+            return False
     else:
         try:
             smtp_server.send_message(message)
@@ -218,60 +739,145 @@ def sendEmail(smtp_server: typing.Union[str, smtplib.SMTP],
 
 ####### Functions for applying functions #######
 
-def applyTemplateSubmissions(func, template_path: str, submit_dir: str, file_name: str, assignment_name = None, delete = "n", **kwargs) -> None:
+DIRECTORY_INDEX = {}
+
+def getDirectoryIndex(directory: str) -> dict:
+    # one os.scandir pass per directory, every walker below is served from this index
+    # files are listed in the same order as os.walk with sorted subdirectories and files
+    # rescanned when the mtime of any scanned directory changes (files or folders added, removed or renamed, eg. by nbgrader in a long running session)
+    if directory not in DIRECTORY_INDEX or not directoryIndexCurrent(DIRECTORY_INDEX[directory]):
+        index = {"files": [], "folders": {}, "names": {}, "mtimes": {}}
+        with profilePhase("scanDirectory"):
+            scanDirectory(directory, index)
+        DIRECTORY_INDEX[directory] = index
+    return DIRECTORY_INDEX[directory]
+
+def directoryIndexCurrent(index: dict) -> bool:
+    for dirName, mtime in index["mtimes"].items():
+        try:
+            if os.stat(dirName).st_mtime_ns != mtime:
+                return False
+        except OSError:
+            return False
+    return True
+
+def scanDirectory(dirName: str, index: dict) -> None:
+    fileList = []
+    subdirList = []
+    try:
+        # before listing, so a change during the scan triggers a rescan next time
+        index["mtimes"][dirName] = os.stat(dirName).st_mtime_ns
+        with os.scandir(dirName) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if not is_dir:
+                    fileList.append(entry.name)
+                elif not entry.is_symlink():
+                    subdirList.append(entry.name)
+    except OSError:
+        return
+    folder = os.path.basename(dirName)
+    for f in sorted(fileList):
+        fullPath = os.path.join(dirName, f)
+        index["files"].append(fullPath)
+        index["folders"].setdefault(folder, []).append(fullPath)
+        index["names"].setdefault(f, []).append(fullPath)
+    for subdir in sorted(subdirList):
+        scanDirectory(os.path.join(dirName, subdir), index)
+
+def clearDirectoryIndex() -> None:
+    # call after creating, moving, or deleting files in an indexed directory
+    DIRECTORY_INDEX.clear()
+
+def applyTemplateSubmissions(func, template_path: str, submit_dir: str, file_name: str, assignment_name = None, delete = "n", jobs: int = 1, **kwargs) -> None:
     template = readJson(template_path)
-    if os.path.isdir(submit_dir):
-        for dirName, subdirList, fileList in os.walk(submit_dir):
-            subdirList.sort()
-            for f in sorted(fileList):
-                fullPath = os.path.join(dirName, f)
-                folder = os.path.basename(dirName)
-                if (folder == assignment_name or assignment_name is None) and f == file_name:
-                    studentID = os.path.split(os.path.split(os.path.split(fullPath)[0])[0])[1]
-                    try:
-                        studentNB = readJson(fullPath)
-                        studentNB = func(template, studentNB, studentID, **kwargs)
-                        if studentNB is not None:
-                            writeJson(fullPath, studentNB)
-                    except Exception as e:
-                        print("ERROR: Something is wrong with: " + str(studentID))
-                        print(repr(e), file=sys.stderr)
-                elif delete.lower() == "y":
-                    os.remove(fullPath)
+    index = getDirectoryIndex(submit_dir)
+    if delete.lower() == "y":
+        candidates = index["files"]
+    elif assignment_name is None:
+        candidates = index["names"].get(file_name, [])
+    else:
+        candidates = index["folders"].get(assignment_name, [])
+    submissions = []
+    for fullPath in candidates:
+        dirName, f = os.path.split(fullPath)
+        folder = os.path.basename(dirName)
+        if (folder == assignment_name or assignment_name is None) and f == file_name:
+            studentID = os.path.split(os.path.split(dirName)[0])[1]
+            submissions.append((fullPath, studentID))
+        elif delete.lower() == "y":
+            os.remove(fullPath)
+    if delete.lower() == "y":
+        clearDirectoryIndex()
+    if jobs > 1 and len(submissions) > 1:
+        import multiprocessing
+        # the template is sent to each worker once, output is buffered per student and printed in sorted order
+        with multiprocessing.Pool(min(jobs, len(submissions)), initializer=initTemplateWorker, initargs=(func, template, kwargs, PROFILER is not None)) as pool:
+            for stdout, stderr, profile in pool.imap(applyTemplateWorker, submissions):
+                sys.stdout.write(stdout)
+                sys.stderr.write(stderr)
+                if profile is not None:
+                    PROFILER.merge(profile)
+    else:
+        for fullPath, studentID in submissions:
+            applyTemplate(func, template, fullPath, studentID, **kwargs)
+
+def applyTemplate(func, template: dict, fullPath: str, studentID: str, **kwargs) -> None:
+    try:
+        with profileStudent(studentID, fullPath):
+            studentNB = readJson(fullPath)
+            with profilePhase(func.__name__):
+                studentNB = func(template, studentNB, studentID, **kwargs)
+            if studentNB is not None:
+                writeJson(fullPath, studentNB)
+    except Exception as e:
+        print("ERROR: Something is wrong with: " + str(studentID))
+        print(repr(e), file=sys.stderr)
+
+TEMPLATE_WORKER = {}
+
+def initTemplateWorker(func, template: dict, kwargs: dict, profile: bool = False) -> None:
+    global PROFILER
+    if profile:
+        PROFILER = PhaseProfiler()
+    TEMPLATE_WORKER["func"] = func
+    TEMPLATE_WORKER["template"] = template
+    TEMPLATE_WORKER["kwargs"] = kwargs
+
+def applyTemplateWorker(submission: tuple) -> tuple:
+    stdout, stderr = io.StringIO(), io.StringIO()
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        applyTemplate(TEMPLATE_WORKER["func"], TEMPLATE_WORKER["template"], *submission, **TEMPLATE_WORKER["kwargs"])
+    return stdout.getvalue(), stderr.getvalue(), PROFILER.drain() if PROFILER is not None else None
 
 def applyFuncFiles(func, directory: str, file_name: str, *args) -> list:
     output = []
-    if os.path.isdir(directory):
-        for dirName, subdirList, fileList in os.walk(directory):
-            subdirList.sort()
-            for f in sorted(fileList):
-                fullPath = os.path.join(dirName, f)
-                if f == file_name:
-                    studentID = os.path.split(os.path.split(os.path.split(fullPath)[0])[0])[1]
-                    try:
-                        output.append(func(fullPath, studentID, *args))
-                    except Exception as e:
-                        print("ERROR: Something is wrong with: " + str(studentID))
-                        print(repr(e), file=sys.stderr)
+    for fullPath in getDirectoryIndex(directory)["names"].get(file_name, []):
+        studentID = os.path.split(os.path.split(os.path.split(fullPath)[0])[0])[1]
+        try:
+            with profileStudent(studentID, fullPath), profilePhase(func.__name__):
+                output.append(func(fullPath, studentID, *args))
+        except Exception as e:
+            print("ERROR: Something is wrong with: " + str(studentID))
+            print(repr(e), file=sys.stderr)
     return output
 
 def applyFuncDirectory(func, directory: str, assignment_name: str, file_name: typing.Union[str, None], file_extension: typing.Union[str, None], *args, **kwargs) -> list:
     output = []
-    if os.path.isdir(directory):
-        for dirName, subdirList, fileList in os.walk(directory):
-            subdirList.sort()
-            for f in sorted(fileList):
-                fullPath = os.path.join(dirName, f)
-                folder = os.path.basename(dirName)
-                if folder == assignment_name:
-                    if file_name is None or f == file_name:
-                        if file_extension is None or f.split(".")[-1] == file_extension:
-                            studentID = os.path.split(os.path.split(os.path.split(fullPath)[0])[0])[1]
-                            try:
-                                output.append(func(fullPath, studentID, *args, **kwargs))
-                            except Exception as e:
-                                print("ERROR: Something is wrong with: " + str(studentID))
-                                print(repr(e), file=sys.stderr)
+    for fullPath in getDirectoryIndex(directory)["folders"].get(assignment_name, []):
+        f = os.path.basename(fullPath)
+        if file_name is None or f == file_name:
+            if file_extension is None or f.split(".")[-1] == file_extension:
+                studentID = os.path.split(os.path.split(os.path.split(fullPath)[0])[0])[1]
+                try:
+                    with profileStudent(studentID, fullPath), profilePhase(func.__name__):
+                        output.append(func(fullPath, studentID, *args, **kwargs))
+                except Exception as e:
+                    print("ERROR: Something is wrong with: " + str(studentID))
+                    print(repr(e), file=sys.stderr)
     return output
 
 
@@ -287,47 +893,59 @@ def getFunctionNames(source: list) -> list:
             function_names.append(function_name)
     return function_names
 
+def getGradeId(cell: dict):
+    try:
+        grade_id = cell["metadata"]["nbgrader"]["grade_id"]
+        hash(grade_id)
+        return grade_id
+    except:
+        return None
+
+def indexGradeIds(cells: list) -> dict:
+    # grade_id -> sorted list of cell positions, built once per notebook and kept up to date by the fixers
+    index = {}
+    for i, cell in enumerate(cells):
+        grade_id = getGradeId(cell)
+        if grade_id is not None:
+            index.setdefault(grade_id, []).append(i)
+    return index
+
+def shiftIndex(index: dict, position: int, offset: int = 1) -> None:
+    for positions in index.values():
+        for j in range(len(positions)):
+            if positions[j] >= position:
+                positions[j] += offset
+
+def addIndexPosition(index: dict, key, position: int) -> None:
+    bisect.insort(index.setdefault(key, []), position)
+
+def removeIndexPosition(index: dict, key, position: int) -> None:
+    index[key].remove(position)
+    if not index[key]:
+        del index[key]
+
+def insertIndexedCell(cells: list, index: dict, position: int, cell: dict) -> None:
+    cells.insert(position, cell)
+    shiftIndex(index, position)
+    grade_id = getGradeId(cell)
+    if grade_id is not None:
+        addIndexPosition(index, grade_id, position)
+
 def returnPath(fullPath: str, studentID: str) -> dict:
     return {"student_id": studentID, "path": fullPath}
 
 def printFileNames(fullPath: str, studentID: str) -> None:
     print("%s - %s" %(studentID, os.path.basename(fullPath)))
 
-def getAnswerCells(fullPath: str, studentID: str) -> dict:
-    source_json = readJson(fullPath)
-    output_string_list = []
-    for cell in source_json["cells"]:
-        try:
-            if "nbgrader" not in cell["metadata"] or "locked" not in cell["metadata"]["nbgrader"] or cell["metadata"]["nbgrader"]["locked"] == False:
-                output_string_list += cell["source"]
-        except:
-            pass
-    return {"student_id": studentID, "answers": output_string_list}
-
-def concatNotebookAnswerCells(list_of_list_of_answer_dicts) -> dict:
-    answer_dict = {}
-    for notebook_list in list_of_list_of_answer_dicts:
-        for student_notebook in notebook_list:
-            if student_notebook["student_id"] not in answer_dict:
-                answer_dict[student_notebook["student_id"]] = student_notebook["answers"]
-            else:
-                answer_dict[student_notebook["student_id"]] += [""]
-                answer_dict[student_notebook["student_id"]] += student_notebook["answers"]
-    return answer_dict
-
-def writeAnswerCells(answer_dict, codeDir):
-    for student_id in answer_dict:
-        codePath = os.path.join(codeDir, student_id + ".py")
-        with open(codePath, "w", encoding="utf8", errors="backslashreplace") as f:
-            f.writelines(answer_dict[student_id])
-
 def getStudentFileDir(course_dir: str, odir: str, nbgrader_step: str) -> str:
-    if odir is None:
+    if odir is None and course_dir is None:
+        raise NotADirectoryError("Invalid course directory, use --odir for the %s directory" %(nbgrader_step))
+    elif odir is None:
         student_dir = os.path.join(course_dir, nbgrader_step)
     else:
         student_dir = os.path.normpath(odir)
     if not os.path.isdir(student_dir):
-        sys.exit("Invalid directory: " + str(student_dir))
+        raise NotADirectoryError("Invalid directory: " + str(student_dir))
     return student_dir
 
 def getAssignmentFiles(source_dir, assignment_name, file_extension, replace_file_extension = None):
@@ -343,12 +961,115 @@ def sortStudentGradeIds(student_dict, sorted_grade_id_list, grade_id_key = "grad
     other_keys = sorted([key for key in student_dict if type(student_dict[key]) != list])
     student_by_grade_id = dict(zip(student_dict[grade_id_key],zip(*[student_dict[key] for key in sort_keys])))
     new_student_dict = {}
-    for key in sort_keys:
-        new_student_dict[key] = [student_by_grade_id[grade_id][sort_keys.index(key)] for grade_id in sorted_grade_id_list]
+    for i, key in enumerate(sort_keys):
+        new_student_dict[key] = [student_by_grade_id[grade_id][i] for grade_id in sorted_grade_id_list]
     for key in other_keys:
         new_student_dict[key] = student_dict[key]
     return new_student_dict
 
+class ScoreMatrix:
+    # students x test cells, stored row major in a flat array of doubles (viewed as a numpy array for the statistics when numpy is installed)
+    def __init__(self, grade_id_list: list, max_scores: list):
+        self.grade_id_list = list(grade_id_list)
+        self.max_scores = [float(max_score) for max_score in max_scores]
+        self.student_ids = []
+        self.scores = array.array("d")
+
+    def add(self, student_id: str, score_list: list) -> None:
+        if len(score_list) != len(self.grade_id_list):
+            raise ValueError("Expected %s scores for %s, got %s" %(len(self.grade_id_list), student_id, len(score_list)))
+        self.student_ids.append(student_id)
+        self.scores.extend(float(score) for score in score_list)
+
+    def column(self, i: int) -> array.array:
+        return self.scores[i::len(self.grade_id_list)]
+
+    def sums(self) -> list:
+        return [math.fsum(self.column(i)) for i in range(len(self.grade_id_list))]
+
+    def totals(self) -> list:
+        k = len(self.grade_id_list)
+        return [math.fsum(self.scores[j:j + k]) for j in range(0, len(self.scores), k)]
+
+    def itemAnalysis(self) -> list:
+        # mean, variance, difficulty (mean / max score), and discrimination (point-biserial correlation of the item with the rest of the score)
+        n, k = len(self.student_ids), len(self.grade_id_list)
+        if n == 0 or k == 0:
+            return [{"grade_id": grade_id, "max_score": max_score, "mean": None, "variance": None, "difficulty": None, "discrimination": None}
+                    for grade_id, max_score in zip(self.grade_id_list, self.max_scores)]
+        try:
+            import numpy
+            matrix = numpy.frombuffer(self.scores, dtype=numpy.float64).reshape(n, k)
+            means = matrix.mean(axis=0).tolist()
+            variances = matrix.var(axis=0).tolist()
+            rest = matrix.sum(axis=1)[:, None] - matrix
+            rest_centered = rest - rest.mean(axis=0)
+            item_centered = matrix - matrix.mean(axis=0)
+            covariances = (item_centered * rest_centered).mean(axis=0).tolist()
+            rest_variances = rest.var(axis=0).tolist()
+        except ImportError:
+            totals = self.totals()
+            means, variances, covariances, rest_variances = [], [], [], []
+            for i in range(k):
+                item = self.column(i)
+                rest = [total - score for total, score in zip(totals, item)]
+                item_mean, rest_mean = math.fsum(item) / n, math.fsum(rest) / n
+                means.append(item_mean)
+                variances.append(math.fsum((score - item_mean) ** 2 for score in item) / n)
+                covariances.append(math.fsum((score - item_mean) * (other - rest_mean) for score, other in zip(item, rest)) / n)
+                rest_variances.append(math.fsum((other - rest_mean) ** 2 for other in rest) / n)
+        items = []
+        for i in range(k):
+            denominator = math.sqrt(variances[i] * rest_variances[i])
+            items.append({"grade_id": self.grade_id_list[i], "max_score": self.max_scores[i], "mean": means[i], "variance": variances[i],
+                          "difficulty": means[i] / self.max_scores[i] if self.max_scores[i] > 0 else None,
+                          "discrimination": covariances[i] / denominator if denominator > 1e-12 else None})
+        return items
+
+    def histogram(self, bins: int = 10) -> list:
+        # [low, high, count] of total scores in equal width bins from 0 to the maximum total, the last bin includes the maximum
+        maximum = math.fsum(self.max_scores)
+        if maximum.is_integer() and maximum < bins and all(total.is_integer() for total in self.totals()):
+            # one bin per possible score
+            counts = collections.Counter(self.totals())
+            return [[float(score), float(score), counts[score]] for score in range(int(maximum) + 1)]
+        counts = [0] * bins
+        for total in self.totals():
+            i = int(total / maximum * bins) if maximum > 0 else 0
+            counts[min(max(i, 0), bins - 1)] += 1
+        return [[maximum * i / bins, maximum * (i + 1) / bins, counts[i]] for i in range(bins)]
+
+def roundOrBlank(value: typing.Union[float, None], digits: int = 3):
+    return "" if value is None else round(value, digits)
+
+def writeItemAnalysis(fName: str, matrix: ScoreMatrix) -> None:
+    header = [["Test Cell", "Cell ID", "Max Score", "Mean", "Variance", "Difficulty", "Discrimination"]]
+    data = [[i + 1, item["grade_id"], item["max_score"], roundOrBlank(item["mean"]), roundOrBlank(item["variance"]), roundOrBlank(item["difficulty"]), roundOrBlank(item["discrimination"])]
+            for i, item in enumerate(matrix.itemAnalysis())]
+    data += [[], ["Total Score From", "To", "Students"]] + [[roundOrBlank(low, 2), roundOrBlank(high, 2), count] for low, high, count in matrix.histogram()]
+    writeCsv(fName, header + data)
+
+def printHistogram(matrix: ScoreMatrix) -> None:
+    histogram = matrix.histogram()
+    width = max([count for _, _, count in histogram] + [1])
+    for low, high, count in histogram:
+        scores = "%6.2f" %(low) + " " * 9 if low == high else "%6.2f - %-6.2f" %(low, high)
+        print("%s %-4s %s" %(scores, count, "#" * round(40 * count / width)))
+
+def exportScoreMatrix(course_dir: str, report: str, assign_name: str, nb_name: str, matrix: ScoreMatrix) -> None:
+    # <course_dir>/reports/scores.csv keeps one row per student and test cell for every assignment, rows from the same report are replaced
+    fName = os.path.join(course_dir, "reports", "scores.csv")
+    header = ["Report", "AssignName", "NbName", "Student ID", "Cell ID", "Score", "Max Score"]
+    try:
+        rows = [row for row in readCsv(fName)[1:] if row[:3] != [report, assign_name, nb_name]]
+    except (OSError, IndexError):
+        rows = []
+    k = len(matrix.grade_id_list)
+    for j, student_id in enumerate(matrix.student_ids):
+        for i in range(k):
+            rows.append([report, assign_name, nb_name, student_id, matrix.grade_id_list[i], matrix.scores[j * k + i], matrix.max_scores[i]])
+    writeCsv(fName, [header] + rows)
+
 def list2dict(list_of_dicts: list, unique_key: str):
     new_dict = {}
     for d in list_of_dicts:
@@ -365,54 +1086,67 @@ def sortedJson(json: typing.Union[dict, list]):
         return json
 
 
+def fingerprintJson(data) -> bytes:
+    return hashlib.blake2b(json.dumps(data, sort_keys=True, separators=(',', ':')).encode("utf8", errors="backslashreplace"), digest_size=16).digest()
+
+COMPILED_TEMPLATES = {}
+
+def compileTemplate(template: dict) -> dict:
+    # grade_id -> fingerprint of every key of the template cell, computed once per template instead of once per student
+    # the compiled template keeps a reference to the template so its id can't be reused while cached
+    if id(template) in COMPILED_TEMPLATES and COMPILED_TEMPLATES[id(template)]["template"] is template:
+        return COMPILED_TEMPLATES[id(template)]
+    compiled = {"template": template, "cells": {}}
+    for cell in template["cells"]:
+        grade_id = getGradeId(cell)
+        if grade_id is not None and grade_id not in compiled["cells"]:
+            compiled["cells"][grade_id] = {
+                "cell": cell,
+                "keys": sorted(cell.keys()),
+                "fingerprints": {key: fingerprintJson(cell[key]) for key in cell},
+                "canonical": {}
+            }
+    if len(COMPILED_TEMPLATES) >= 16:
+        COMPILED_TEMPLATES.clear()
+    COMPILED_TEMPLATES[id(template)] = compiled
+    return compiled
+
+def matchesCompiledCell(compiled_cell: dict, key: str, data) -> bool:
+    if fingerprintJson(data) == compiled_cell["fingerprints"][key]:
+        return True
+    # fingerprints differ, compare canonical forms (also ignores list order), the template side is only canonicalized once
+    if key not in compiled_cell["canonical"]:
+        compiled_cell["canonical"][key] = sortedJson(compiled_cell["cell"][key])
+    return compiled_cell["canonical"][key] == sortedJson(data)
+
+
 ####### Main functions #######
 
 def sortStudentCells(template: dict, student: dict, student_id: str = "") -> typing.Union[dict, None]:
     # get template grade_id order
-    template_grade_ids = []
-    for cell in template["cells"]:
-        try:
-            grade_id = cell["metadata"]["nbgrader"]["grade_id"]
-            template_grade_ids.append(grade_id)
-        except:
-            pass
+    template_grade_ids = [grade_id for grade_id in map(getGradeId, template["cells"]) if grade_id is not None]
     # get student grade_id order
-    student_grade_ids = []
-    for cell in student["cells"]:
-        try:
-            grade_id = cell["metadata"]["nbgrader"]["grade_id"]
-            student_grade_ids.append(grade_id)
-        except:
-            pass
+    student_grade_ids = [grade_id for grade_id in map(getGradeId, student["cells"]) if grade_id is not None]
     # are changes necessary?
     if template_grade_ids == student_grade_ids:
         print("No changes made for:     " + student_id)
         return None
     else:
+        student_index = indexGradeIds(student["cells"])
+        # each grade_id cell keeps the non grade_id cells that follow it (until the next grade_id cell)
+        grade_id_positions = sorted(i for positions in student_index.values() for i in positions)
+        next_grade_id_position = dict(zip(grade_id_positions, grade_id_positions[1:] + [len(student["cells"])]))
         new_student_cells = []
-        add_next_cells = True
+        # non grade_id cells before the first grade_id cell stay at the top
+        if len(template_grade_ids) > 0:
+            new_student_cells += student["cells"][:grade_id_positions[0] if grade_id_positions else len(student["cells"])]
         # add all grade_id cells in order (keeping non grade_id cells in between)
         for grade_id in template_grade_ids:
-            found_student_cell = False
-            for cell in student["cells"]:
-                # add non grade_id cells in current order (until next grade_id cell is found)
-                if add_next_cells:
-                    try:
-                        if cell["metadata"]["nbgrader"]["grade_id"] != grade_id:
-                            add_next_cells = False
-                    except:
-                        new_student_cells.append(cell)
-                # add matching grade_id cells
-                try:
-                    if cell["metadata"]["nbgrader"]["grade_id"] == grade_id:
-                        found_student_cell = True
-                        new_student_cells.append(cell)
-                        add_next_cells = True
-                except:
-                    pass
-            add_next_cells = False
-            if not found_student_cell:
+            if grade_id not in student_index:
                 print("Student: %s is missing test cell: %s" %(student_id, grade_id))
+                continue
+            for i in student_index[grade_id]:
+                new_student_cells += student["cells"][i:next_grade_id_position[i]]
         # return updated notebook (probably still the same object but who cares)
         print("Updated cell order for:  " + student_id)
         student["cells"] = new_student_cells
@@ -420,27 +1154,15 @@ def sortStudentCells(template: dict, student: dict, student_id: str = "") -> typ
 
 def removeNonEssentialCells(template: dict, student: dict, student_id: str = "") -> typing.Union[dict, None]:
     # get template grade_ids
-    template_grade_ids = []
-    for cell in template["cells"]:
-        try:
-            grade_id = cell["metadata"]["nbgrader"]["grade_id"]
-            template_grade_ids.append(grade_id)
-        except:
-            pass
+    template_grade_ids = [grade_id for grade_id in map(getGradeId, template["cells"]) if grade_id is not None]
+    student_index = indexGradeIds(student["cells"])
     # start fresh, always modifies the notebook cells
     new_student_cells = []
     # add all grade_id cells in order
     for grade_id in template_grade_ids:
-        found_student_cell = False
-        for cell in student["cells"]:
-            try:
-                if cell["metadata"]["nbgrader"]["grade_id"] == grade_id:
-                    found_student_cell = True
-                    new_student_cells.append(cell)
-                    break
-            except:
-                pass
-        if not found_student_cell:
+        if grade_id in student_index:
+            new_student_cells.append(student["cells"][student_index[grade_id][0]])
+        else:
             print("Student: %s is missing test cell: %s" %(student_id, grade_id))
     print("Updated notebook for:  " + student_id)
     # fresh notebook too (careful not to modify template, it is not re-read between students)
@@ -454,6 +1176,15 @@ def addNbgraderCell(template: dict, student: dict, student_id: str = "") -> typi
     last_answer_cell_index = 0
     found_student_cell = False
     modified = False
+    student_index = indexGradeIds(student["cells"])
+    # function name -> positions of student cells defining it
+    function_index = {}
+    for i in range(len(student["cells"])):
+        try:
+            for function_student in getFunctionNames(student["cells"][i]["source"]):
+                addIndexPosition(function_index, function_student, i)
+        except:
+            pass
     for cell in template["cells"]:
         try:
             # answer cell
@@ -465,28 +1196,23 @@ def addNbgraderCell(template: dict, student: dict, student_id: str = "") -> typi
                     continue
                 # find student cell with matching grade_id first, then check functions
                 found_student_cell = False
-                for i in range(len(student["cells"])):
-                    try:
-                        if student["cells"][i]["metadata"]["nbgrader"]["grade_id"] == grade_id:
-                            last_answer_cell_index = i
-                            found_student_cell = True
-                            break
-                    except:
-                        pass
+                if grade_id in student_index:
+                    last_answer_cell_index = student_index[grade_id][0]
+                    found_student_cell = True
                 # no matching grade_id, now check functions
                 if found_student_cell == False:
-                    for i in range(len(student["cells"])):
-                        try:
-                            function_student = getFunctionNames(student["cells"][i]["source"])
-                            # replace cell metadata if match
-                            if any(f in function_student for f in function_name):
-                                student["cells"][i]["metadata"] = cell["metadata"]
-                                last_answer_cell_index = i
-                                found_student_cell = True
-                                modified = True
-                                break
-                        except:
-                            pass
+                    matches = [function_index[f][0] for f in function_name if f in function_index]
+                    if len(matches) > 0:
+                        # replace cell metadata of first match
+                        i = min(matches)
+                        old_grade_id = getGradeId(student["cells"][i])
+                        if old_grade_id is not None:
+                            removeIndexPosition(student_index, old_grade_id, i)
+                        student["cells"][i]["metadata"] = cell["metadata"]
+                        addIndexPosition(student_index, grade_id, i)
+                        last_answer_cell_index = i
+                        found_student_cell = True
+                        modified = True
                 # check student didn't mess up
                 if found_student_cell == False:
                     print("Student function not found for: %s - %s" %(student_id, str(function_name)))
@@ -494,17 +1220,15 @@ def addNbgraderCell(template: dict, student: dict, student_id: str = "") -> typi
             elif cell["metadata"]["nbgrader"]["locked"] == True or ("grade" in cell["metadata"]["nbgrader"] and cell["metadata"]["nbgrader"]["grade"] == True):
                 # check if test cell already exists
                 grade_id = cell["metadata"]["nbgrader"]["grade_id"]
-                found_test_cell = False
-                for i in range(len(student["cells"])):
+                if grade_id not in student_index:
+                    # insert test cells after most recent answer cell
+                    insertIndexedCell(student["cells"], student_index, last_answer_cell_index + 1, cell)
+                    shiftIndex(function_index, last_answer_cell_index + 1)
                     try:
-                        if student["cells"][i]["metadata"]["nbgrader"]["grade_id"] == grade_id:
-                            found_test_cell = True
-                            break
+                        for function_student in getFunctionNames(cell["source"]):
+                            addIndexPosition(function_index, function_student, last_answer_cell_index + 1)
                     except:
                         pass
-                if found_test_cell == False:
-                    # insert test cells after most recent answer cell
-                    student["cells"].insert(last_answer_cell_index + 1, cell)
                     last_answer_cell_index += 1
                     modified = True
         except:
@@ -518,19 +1242,18 @@ def addNbgraderCell(template: dict, student: dict, student_id: str = "") -> typi
 
 def updateTestCells(template: dict, student: dict, student_id: str = "") -> typing.Union[dict, None]:
     modified = False
+    student_index = indexGradeIds(student["cells"])
     # update points in test cases
     for cell in template["cells"]:
         try:
             points = cell["metadata"]["nbgrader"]["points"]
             grade_id = cell["metadata"]["nbgrader"]["grade_id"]
-            found_student_cell = False
-            for i in range(len(student["cells"])):
+            found_student_cell = grade_id in student_index
+            for i in student_index.get(grade_id, []):
                 try:
-                    if student["cells"][i]["metadata"]["nbgrader"]["grade_id"] == grade_id:
-                        found_student_cell = True
-                        if student["cells"][i]["metadata"]["nbgrader"]["points"] != points:
-                            student["cells"][i]["metadata"]["nbgrader"]["points"] = points
-                            modified = True
+                    if student["cells"][i]["metadata"]["nbgrader"]["points"] != points:
+                        student["cells"][i]["metadata"]["nbgrader"]["points"] = points
+                        modified = True
                 except:
                     pass
             if not found_student_cell:
@@ -542,15 +1265,13 @@ def updateTestCells(template: dict, student: dict, student_id: str = "") -> typi
         try:
             grade_id = cell["metadata"]["nbgrader"]["grade_id"]
             if cell["metadata"]["nbgrader"]["grade"] == False and "points" not in cell["metadata"]["nbgrader"]:
-                found_student_cell = False
-                for i in range(len(student["cells"])):
+                found_student_cell = grade_id in student_index
+                for i in student_index.get(grade_id, []):
                     try:
-                        if student["cells"][i]["metadata"]["nbgrader"]["grade_id"] == grade_id:
-                            found_student_cell = True
-                            if student["cells"][i]["metadata"]["nbgrader"]["grade"] == True or "points" in student["cells"][i]["metadata"]["nbgrader"]:
-                                student["cells"][i]["metadata"]["nbgrader"]["grade"] = False
-                                _ = student["cells"][i]["metadata"]["nbgrader"].pop("points", None)
-                                modified = True
+                        if student["cells"][i]["metadata"]["nbgrader"]["grade"] == True or "points" in student["cells"][i]["metadata"]["nbgrader"]:
+                            student["cells"][i]["metadata"]["nbgrader"]["grade"] = False
+                            _ = student["cells"][i]["metadata"]["nbgrader"].pop("points", None)
+                            modified = True
                     except:
                         pass
                 if not found_student_cell:
@@ -558,20 +1279,17 @@ def updateTestCells(template: dict, student: dict, student_id: str = "") -> typi
         except:
             pass
     # check for duplicate grade_ids, keep first one and concatenate contents of subsequent ones then remove them
-    student_cells = {}
     remove_cells = []
     for i in range(len(student["cells"])):
-        try:
-            grade_id = student["cells"][i]["metadata"]["nbgrader"]["grade_id"]
-            if grade_id in student_cells:
-                student["cells"][student_cells[grade_id]]["source"] += student["cells"][i]["source"]
+        grade_id = getGradeId(student["cells"][i])
+        if grade_id is not None and student_index[grade_id][0] != i:
+            try:
+                student["cells"][student_index[grade_id][0]]["source"] += student["cells"][i]["source"]
                 remove_cells.append(i)
                 modified = True
                 print("Student: %s has duplicate answer cell: %s" %(student_id, grade_id))
-            else:
-                student_cells[grade_id] = i
-        except:
-            pass
+            except:
+                pass
     if len(remove_cells) > 0:
         for i in reversed(remove_cells):
             _ = student["cells"].pop(i)
@@ -585,48 +1303,51 @@ def updateTestCells(template: dict, student: dict, student_id: str = "") -> typi
 
 def updateCellsMeta(template: dict, student: dict, student_id: str = "") -> typing.Union[dict, None]:
     modified = False
-    valid_grade_ids = []
+    valid_grade_ids = set()
+    student_index = indexGradeIds(student["cells"])
+    compiled_cells = compileTemplate(template)["cells"]
     # check cells of student submission against source to match metadata using grade_id
     for cell in template["cells"]:
         try:
             grade_id = cell["metadata"]["nbgrader"]["grade_id"]
-            valid_grade_ids.append(grade_id)
+            valid_grade_ids.add(grade_id)
             found_student_cell = False
-            for i in range(len(student["cells"])):
+            for i in student_index.get(grade_id, []):
+                found_student_cell = True
                 try:
-                    if student["cells"][i]["metadata"]["nbgrader"]["grade_id"] == grade_id:
-                        found_student_cell = True
-                        try:
-                            # compare student metadata with source
-                            if sorted(cell.keys()) != sorted(student["cells"][i].keys()):
+                    # compare student metadata with source (precompiled unless the template repeats a grade_id)
+                    if grade_id in compiled_cells and compiled_cells[grade_id]["cell"] is cell:
+                        compiled_cell = compiled_cells[grade_id]
+                    else:
+                        compiled_cell = {"cell": cell, "keys": sorted(cell.keys()), "fingerprints": {key: fingerprintJson(cell[key]) for key in cell}, "canonical": {}}
+                    if compiled_cell["keys"] != sorted(student["cells"][i].keys()):
+                        raise Exception("Fix metadata")
+                    for key in cell:
+                        if key == "outputs" and type(student["cells"][i]["outputs"]) not in [list, str]:
+                            student["cells"][i]["outputs"] = []
+                            modified = True
+                        elif key == "execution_count" and type(student["cells"][i]["execution_count"]) not in [int, type(None)]:
+                            student["cells"][i]["execution_count"] = 0
+                            modified = True
+                        elif key != "source":
+                            if not matchesCompiledCell(compiled_cell, key, student["cells"][i][key]):
                                 raise Exception("Fix metadata")
-                            for key in cell:
-                                if key == "outputs" and type(student["cells"][i]["outputs"]) not in [list, str]:
-                                    student["cells"][i]["outputs"] = []
-                                    modified = True
-                                elif key == "execution_count" and type(student["cells"][i]["execution_count"]) not in [int, type(None)]:
-                                    student["cells"][i]["execution_count"] = 0
-                                    modified = True
-                                elif key != "source":
-                                    if sortedJson(cell[key]) != sortedJson(student["cells"][i][key]):
-                                        raise Exception("Fix metadata")
-                        except:
-                            # create a new cell and preserve source (just run this for every cell if metadata mistakes aren't being caught)
-                            try:
-                                new_cell = cell.copy()
-                                new_cell["source"] = student["cells"][i]["source"]
-                                student["cells"][i] = new_cell
-                                modified = True
-                            except:
-                                print("ERROR: Could not fix metadata for student: %s grade_id: %s" %(student_id, grade_id))
                 except:
-                    pass
+                    # create a new cell and preserve source (just run this for every cell if metadata mistakes aren't being caught)
+                    try:
+                        new_cell = cell.copy()
+                        new_cell["source"] = student["cells"][i]["source"]
+                        student["cells"][i] = new_cell
+                        modified = True
+                    except:
+                        print("ERROR: Could not fix metadata for student: %s grade_id: %s" %(student_id, grade_id))
             if not found_student_cell:
                 print("Student: %s was missing nbgrader cell (added): %s" %(student_id, grade_id))
                 # copy cell to the end without source
                 new_cell = cell.copy()
                 new_cell["source"] = [""]
                 student["cells"].append(new_cell)
+                addIndexPosition(student_index, grade_id, len(student["cells"]) - 1)
                 modified = True
         except:
             pass
@@ -655,6 +1376,35 @@ def updateCellsMeta(template: dict, student: dict, student_id: str = "") -> typi
         print("No changes made for:     " + student_id)
         return None
 
+PIPELINE_STEPS = {
+    "add": addNbgraderCell,
+    "fix": updateTestCells,
+    "meta": updateCellsMeta,
+    "sortcells": sortStudentCells,
+    "rmcells": removeNonEssentialCells
+}
+
+def parsePipelineSteps(steps: str) -> list:
+    # "add,fix" -> ["add", "fix"], raises ValueError for unknown steps
+    steps = [step.strip().lower() for step in steps.split(",") if step.strip() != ""]
+    for step in steps:
+        if step not in PIPELINE_STEPS:
+            raise ValueError("Invalid pipeline step: %s (choose from %s)" %(step, ", ".join(PIPELINE_STEPS)))
+    return steps
+
+def applyPipeline(template: dict, student: dict, student_id: str = "", steps: typing.Union[list, None] = None) -> typing.Union[dict, None]:
+    # chain fixers in memory so each notebook is read once and written at most once
+    modified = False
+    for step in steps or []:
+        new_student = PIPELINE_STEPS[step](template, student, student_id)
+        if new_student is not None:
+            student = new_student
+            modified = True
+    if modified:
+        return student
+    else:
+        return None
+
 def makeNotebook(fullPath: str, student_id: str, source_notebook: str):
     with open(fullPath, "r") as f:
         student_code = f.readlines()
@@ -685,34 +1435,274 @@ def makeNotebook(fullPath: str, student_id: str, source_notebook: str):
     print("Created notebook for:  " + student_id)
     return [student_id, 1]
 
-def forceAutograde(template: dict, student: dict, student_id: str = "", course_dir = None, AssignName = None, NbNameipynb = None) -> typing.Union[dict, None]:
+def forceAutograde(template: dict, student: dict, student_id: str = "", course_dir = None, AssignName = None, NbNameipynb = None, execute = True) -> typing.Union[dict, None]:
+    student_index = indexGradeIds(student["cells"])
     for cell in template["cells"]:
         try:
             # test cell
             if cell["metadata"]["nbgrader"]["locked"] == True:
-                found_test_cell = False
-                for i in range(len(student["cells"])):
-                    try:
-                        if student["cells"][i]["metadata"]["nbgrader"]["grade_id"] == cell["metadata"]["nbgrader"]["grade_id"]:
-                            found_test_cell = True
-                            student["cells"][i] = cell
-                            break
-                    except:
-                        pass
-                if found_test_cell == False:
+                grade_id = cell["metadata"]["nbgrader"]["grade_id"]
+                if grade_id in student_index:
+                    student["cells"][student_index[grade_id][0]] = cell
+                else:
                     print("Missing test cells (fix with --add) for " + student_id)
         except:
             pass
     new_path = os.path.join(course_dir, "nbhelper-autograde", student_id, AssignName, NbNameipynb)
     writeJson(new_path, student)
-    # https://nbconvert.readthedocs.io/en/latest/execute_api.html
-    # https://nbconvert.readthedocs.io/en/latest/config_options.html
-    # this is mostly just a quick hack for some rare edgecases, there's probably a more proper solution but most of the code to do this was already here for other reasons
-    # using some of these flags with nbgrader might be enough to fix your issue
-    command = "jupyter nbconvert --execute --ExecutePreprocessor.timeout=60 --ExecutePreprocessor.interrupt_on_timeout=True --ExecutePreprocessor.allow_errors=True --to notebook --inplace "
-    os.system(command + new_path)
+    if execute:
+        runExecutionJobs([{"student_id": student_id, "path": new_path}])
     return None
 
+# https://nbconvert.readthedocs.io/en/latest/execute_api.html
+# https://nbconvert.readthedocs.io/en/latest/config_options.html
+# this is mostly just a quick hack for some rare edgecases, there's probably a more proper solution but most of the code to do this was already here for other reasons
+# using some of these flags with nbgrader might be enough to fix your issue
+EXECUTE_COMMAND = ["jupyter", "nbconvert", "--execute", "--ExecutePreprocessor.timeout=60", "--ExecutePreprocessor.interrupt_on_timeout=True", "--ExecutePreprocessor.allow_errors=True", "--to", "notebook", "--inplace"]
+
+def limitMemory(memory_limit: int) -> None:
+    # runs in the child before exec, the limit is inherited by the kernel nbconvert starts
+    import resource
+    resource.setrlimit(resource.RLIMIT_AS, (memory_limit * 1024 * 1024, memory_limit * 1024 * 1024))
+
+def failTestCells(notebook_path: str, ename: str, evalue: str) -> None:
+    # a notebook that was never written back still has the template's empty test outputs, which getAutogradedScore counts as passed
+    notebook = readJson(notebook_path)
+    for cell in notebook["cells"]:
+        if hasPoints(cell):
+            cell["outputs"] = [errorOutput(ename, evalue)]
+    writeJson(notebook_path, notebook)
+
+def killProcessTree(process) -> None:
+    import signal
+    import subprocess
+    if os.name != "nt":
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            # the whole group already exited
+            pass
+    else:
+        # process.kill() would only stop nbconvert and leave its kernel running
+        subprocess.run(["taskkill", "/F", "/T", "/PID", str(process.pid)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if process.poll() is None:
+            process.kill()
+    process.wait()
+
+def failUnfinishedNotebook(job: dict, ename: str, evalue: str) -> None:
+    try:
+        failTestCells(job["path"], ename, evalue)
+    except Exception as e:
+        # never leave a notebook that would be graded as passed
+        print("Could not mark test cells, removing %s: %s" %(job["path"], repr(e)))
+        try:
+            os.remove(job["path"])
+        except OSError:
+            pass
+
+def executionResult(job: dict, status: str, returncode, seconds: float) -> dict:
+    return {"student_id": job["student_id"], "status": status, "returncode": returncode, "seconds": round(seconds, 2),
+            "size": os.path.getsize(job["path"]) if os.path.isfile(job["path"]) else None}
+
+def runExecutionJobs(jobs: list, workers: int = 1, timeout: typing.Union[float, None] = None, memory_limit: typing.Union[int, None] = None) -> list:
+    import subprocess
+    # runs up to workers notebooks at once, largest first, each in its own process group so a timeout kills its kernel too
+    # output of each job is written to <notebook>.log next to the notebook, test cells of notebooks that did not finish are marked as errors
+    pending = sorted(jobs, key=lambda job: os.path.getsize(job["path"]))
+    running = []
+    results = []
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < max(workers, 1):
+                job = pending.pop()
+                kwargs = {}
+                if os.name != "nt":
+                    kwargs["start_new_session"] = True
+                    if memory_limit is not None:
+                        kwargs["preexec_fn"] = functools.partial(limitMemory, memory_limit)
+                log = None
+                try:
+                    log = open(job["path"] + ".log", "wb")
+                    process = subprocess.Popen(EXECUTE_COMMAND + [job["path"]], stdout=log, stderr=subprocess.STDOUT, **kwargs)
+                except OSError as e:
+                    if log is not None:
+                        log.close()
+                    print("Could not execute notebook for %s: %s" %(job["student_id"], repr(e)))
+                    failUnfinishedNotebook(job, "ExecutionError", "Could not execute notebook: " + repr(e))
+                    results.append(executionResult(job, "failed", None, 0.0))
+                    continue
+                running.append((job, process, log, time.time()))
+            time.sleep(0.05)
+            for entry in list(running):
+                job, process, log, start_time = entry
+                if process.poll() is not None:
+                    status = "ok" if process.returncode == 0 else "failed"
+                elif timeout is not None and time.time() - start_time > timeout:
+                    killProcessTree(process)
+                    status = "timeout"
+                else:
+                    continue
+                log.close()
+                running.remove(entry)
+                if status == "timeout":
+                    failUnfinishedNotebook(job, "TimeoutError", "Notebook exceeded %s seconds" %(timeout))
+                elif status == "failed":
+                    failUnfinishedNotebook(job, "ExecutionError", "jupyter nbconvert exited with %s" %(process.returncode))
+                result = executionResult(job, status, process.returncode, time.time() - start_time)
+                results.append(result)
+                print("Executed notebook for: %s (%s in %ss)" %(result["student_id"], status, result["seconds"]))
+    finally:
+        # interrupted (eg. Ctrl+C) or an unexpected error, don't leave nbconvert and its kernels running
+        for job, process, log, start_time in running:
+            try:
+                killProcessTree(process)
+            except OSError as e:
+                print("Could not stop execution for %s: %s" %(job["student_id"], repr(e)))
+            log.close()
+            failUnfinishedNotebook(job, "ExecutionError", "Execution was interrupted")
+    return sorted(results, key=lambda result: result["student_id"])
+
+def startWarmKernel() -> tuple:
+    from jupyter_client.manager import start_new_kernel
+    kernel_manager, kernel_client = start_new_kernel(kernel_name=KERNEL_CONFIG["KERNEL_NAME"])
+    for module in KERNEL_CONFIG["PRELOAD"]:
+        runKernelCode(kernel_manager, kernel_client, "try:\n    import %s\nexcept Exception:\n    pass" %(module), KERNEL_CONFIG["STARTUP_TIMEOUT"], silent=True)
+    return kernel_manager, kernel_client
+
+def stopWarmKernel(kernel: tuple) -> None:
+    kernel_manager, kernel_client = kernel
+    try:
+        kernel_client.stop_channels()
+        kernel_manager.shutdown_kernel(now=True)
+    except Exception as e:
+        print(repr(e), file=sys.stderr)
+
+def errorOutput(ename: str, evalue: str) -> dict:
+    return {"output_type": "error", "ename": ename, "evalue": evalue, "traceback": []}
+
+def runKernelCode(kernel_manager, kernel_client, code: str, timeout: float, execution_count = None, silent = False) -> list:
+    # collects outputs in nbformat 4 form, interrupts the kernel if the cell runs past timeout (like nbconvert's interrupt_on_timeout)
+    msg_id = kernel_client.execute(code, silent=silent, store_history=not silent, allow_stdin=False)
+    outputs = []
+    deadline = time.time() + timeout
+    interrupted = False
+    while True:
+        if time.time() > deadline:
+            if interrupted:
+                raise TimeoutError("Kernel did not respond to interrupt")
+            kernel_manager.interrupt_kernel()
+            interrupted = True
+            deadline = time.time() + KERNEL_CONFIG["STARTUP_TIMEOUT"]
+        try:
+            msg = kernel_client.get_iopub_msg(timeout=1)
+        except queue.Empty:
+            if not kernel_manager.is_alive():
+                outputs.append(errorOutput("DeadKernelError", "Kernel died while executing cell"))
+                return outputs
+            continue
+        if msg["parent_header"].get("msg_id") != msg_id:
+            continue
+        msg_type, content = msg["msg_type"], msg["content"]
+        if msg_type == "status" and content["execution_state"] == "idle":
+            break
+        elif msg_type == "stream":
+            if len(outputs) > 0 and outputs[-1]["output_type"] == "stream" and outputs[-1]["name"] == content["name"]:
+                outputs[-1]["text"] += content["text"]
+            else:
+                outputs.append({"output_type": "stream", "name": content["name"], "text": content["text"]})
+        elif msg_type == "display_data":
+            outputs.append({"output_type": "display_data", "data": content["data"], "metadata": content["metadata"]})
+        elif msg_type == "execute_result":
+            outputs.append({"output_type": "execute_result", "data": content["data"], "metadata": content["metadata"], "execution_count": execution_count})
+        elif msg_type == "error":
+            outputs.append(errorOutput(content["ename"], content["evalue"]))
+            outputs[-1]["traceback"] = content["traceback"]
+        elif msg_type == "clear_output":
+            outputs = []
+    # consume the execute reply so the shell channel doesn't back up
+    while True:
+        try:
+            reply = kernel_client.get_shell_msg(timeout=KERNEL_CONFIG["STARTUP_TIMEOUT"])
+        except queue.Empty:
+            break
+        if reply["parent_header"].get("msg_id") == msg_id:
+            break
+    return outputs
+
+def executeNotebookInKernel(kernel: tuple, notebook_path: str, timeout: typing.Union[float, None] = None) -> str:
+    # runs every code cell of the notebook in a warm kernel and writes the outputs back in place, same as nbconvert --inplace
+    kernel_manager, kernel_client = kernel
+    notebook = readJson(notebook_path)
+    runKernelCode(kernel_manager, kernel_client, KERNEL_RESET_CODE %(os.path.dirname(os.path.abspath(notebook_path))), KERNEL_CONFIG["STARTUP_TIMEOUT"], silent=True)
+    deadline = None if timeout is None else time.time() + timeout
+    status = "ok"
+    execution_count = 0
+    for cell in notebook["cells"]:
+        if cell.get("cell_type") != "code":
+            continue
+        source = "".join(cell["source"]) if type(cell["source"]) == list else cell["source"]
+        cell["outputs"] = []
+        cell["execution_count"] = None
+        if status == "failed":
+            cell["outputs"] = [errorOutput("DeadKernelError", "Kernel died before executing cell")]
+        elif deadline is not None and time.time() > deadline:
+            status = "timeout"
+            cell["outputs"] = [errorOutput("TimeoutError", "Notebook exceeded %s seconds" %(timeout))]
+        elif source.strip() != "":
+            execution_count += 1
+            cell_timeout = KERNEL_CONFIG["CELL_TIMEOUT"] if deadline is None else min(KERNEL_CONFIG["CELL_TIMEOUT"], max(deadline - time.time(), 0))
+            cell["outputs"] = runKernelCode(kernel_manager, kernel_client, source, cell_timeout, execution_count)
+            cell["execution_count"] = execution_count
+            if not kernel_manager.is_alive():
+                status = "failed"
+    writeJson(notebook_path, notebook)
+    return status
+
+def kernelWorker(job_queue: queue.Queue, results: list, lock: threading.Lock, timeout: typing.Union[float, None]) -> None:
+    kernel = None
+    try:
+        while True:
+            try:
+                job = job_queue.get_nowait()
+            except queue.Empty:
+                return
+            start_time = time.time()
+            try:
+                if kernel is None or not kernel[0].is_alive():
+                    if kernel is not None:
+                        stopWarmKernel(kernel)
+                    kernel = startWarmKernel()
+                status = executeNotebookInKernel(kernel, job["path"], timeout)
+            except Exception as e:
+                # stuck or broken kernel, replace it for the next student
+                status = "timeout" if type(e) == TimeoutError else "failed"
+                print("ERROR: Something is wrong with: %s %s" %(job["student_id"], repr(e)))
+                failUnfinishedNotebook(job, "TimeoutError" if status == "timeout" else "ExecutionError", str(e))
+                if kernel is not None:
+                    stopWarmKernel(kernel)
+                    kernel = None
+            with lock:
+                results.append(executionResult(job, status, None, time.time() - start_time))
+                print("Executed notebook for: %s (%s in %ss)" %(job["student_id"], status, results[-1]["seconds"]))
+    finally:
+        if kernel is not None:
+            stopWarmKernel(kernel)
+
+def runKernelJobs(jobs: list, workers: int = 1, timeout: typing.Union[float, None] = None) -> list:
+    # same as runExecutionJobs but each worker keeps a warm kernel (heavy imports preloaded) and resets its namespace between students
+    import jupyter_client
+    job_queue = queue.Queue()
+    for job in sorted(jobs, key=lambda job: os.path.getsize(job["path"]), reverse=True):
+        job_queue.put(job)
+    results = []
+    lock = threading.Lock()
+    threads = [threading.Thread(target=kernelWorker, args=(job_queue, results, lock, timeout)) for i in range(max(min(workers, len(jobs)), 1))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(results, key=lambda result: result["student_id"])
+
 def quickInfo(fullPath: str, studentID: str):
     studentNB = readJson(fullPath)
     studentSize = os.path.getsize(fullPath)
@@ -736,12 +1726,11 @@ def checkDuplicates(fullPath: str, studentID: str):
         print("%s - %s" %(studentID, fName))
 
 def getAutogradedScore(fullPath: str, studentID: str) -> dict:
-    source_json = readJson(fullPath)
     pass_list = []
     points_list = []
     error_list = []
     grade_id_list = []
-    for cell in source_json["cells"]:
+    for cell in iterNotebookCells(fullPath):
         try:
             if cell["metadata"]["nbgrader"]["points"] >= 0:
                 if (cell["outputs"] == [] or (
@@ -778,37 +1767,33 @@ def getAutogradedScore(fullPath: str, studentID: str) -> dict:
             pass
     return {"student_id": studentID, "pass_list": pass_list, "points_list": points_list, "error_list": error_list, "grade_id_list": grade_id_list}
 
+FEEDBACK_SCORE = re.compile(r'\(Score: ?(\d+\.\d+) ?/ ?(\d+\.\d+)\)')
+FEEDBACK_TEST_CELL = re.compile(r'<li><a href="#(.+?)">.+?</a> ?\(Score: ?(\d+\.\d+) ?/ ?(\d+\.\d+)\)</li>')
+FEEDBACK_SUMMARY_END = re.compile(r'</[ou]l>')
+
 def getFeedbackScore(fullPath: str, studentID: str) -> dict:
-    with open(fullPath, 'r', errors='ignore') as f:
-        source_html = f.readlines()
+    # the score summary (total then one list item per test cell) is at the top, stop reading once its list closes
+    total_score = None
     score_list = []
     score_totals = []
     grade_id_list = []
-    for line in source_html:
-        match_score = re.search(r'\(Score: ?(\d+\.\d+) ?/ ?(\d+\.\d+)\)', line)
+    for line in iterTextLines(fullPath):
+        match_score = FEEDBACK_SCORE.search(line)
         if match_score:
-            match_test_cell = re.search(r'<li><a href="#(.+?)">.+?</a> ?\(Score: ?(\d+\.\d+) ?/ ?(\d+\.\d+)\)</li>', line)
+            match_test_cell = FEEDBACK_TEST_CELL.search(line)
             if match_test_cell:
                 grade_id_list.append(match_test_cell.groups()[0])
                 score_list.append(float(match_test_cell.groups()[1]))
                 score_totals.append(float(match_test_cell.groups()[2]))
             else:
                 total_score = float(match_score.groups()[0])
-        # try:
-        #     if "Test cell</a> (Score" in line:
-        #         space_split = line.split(" ")
-        #         score_list.append(float(space_split[-3]))
-        #         score_totals.append(float(space_split[-1].split(")")[0]))
-        #         quote_split = line.split("\"")
-        #         grade_id_list.append(quote_split[1][1:])
-        #     elif " (Score: " in line:
-        #         line = line.split(" ")
-        #         total_score = float(line[line.index("(Score:")+1])
-        # except:
-        #     print("Error for student: %s on line: %s" %(studentID, str(line)))
+        if len(grade_id_list) > 0 and FEEDBACK_SUMMARY_END.search(line):
+            break
+    if total_score is None:
+        print("Missing total score for: " + studentID)
     return {"student_id": studentID, "total_score": total_score, "score_list": score_list, "score_totals": score_totals, "grade_id_list": grade_id_list}
 
-def emailFeedback(feedback_html_path: str, student_email_id: str) -> list:
+def emailFeedback(feedback_html_path: str, student_email_id: str, smtp_server: typing.Union[str, smtplib.SMTP, SmtpPool, None] = None, rate_limiter: typing.Union[TokenBucket, None] = None) -> list:
     if EMAIL_CONFIG["EMAIL_HTML"] == "FEEDBACK":
         with open(feedback_html_path, "r", encoding="utf8", errors="replace") as f:
             email_html = f.read()
@@ -816,29 +1801,354 @@ def emailFeedback(feedback_html_path: str, student_email_id: str) -> list:
     else:
         email_html = EMAIL_CONFIG["EMAIL_HTML"]
         attachment_path = feedback_html_path
-    success = sendEmail(EMAIL_CONFIG["MY_SMTP_SERVER"],
-                        EMAIL_CONFIG["MY_SMTP_USERNAME"],
-                        EMAIL_CONFIG["MY_SMTP_PASSWORD"],
-                        EMAIL_CONFIG["MY_EMAIL_ADDRESS"],
-                        student_email_id + EMAIL_CONFIG["STUDENT_MAIL_DOMAIN"],
-                        EMAIL_CONFIG["EMAIL_SUBJECT"],
-                        cc = EMAIL_CONFIG["CC_ADDRESS"],
-                        attachment_path = attachment_path,
-                        body = EMAIL_CONFIG["EMAIL_MESSAGE"],
-                        html = email_html)
-    time.sleep(float(EMAIL_CONFIG["EMAIL_DELAY"]))
+    if smtp_server is None:
+        smtp_server = EMAIL_CONFIG["MY_SMTP_SERVER"]
+    if rate_limiter is not None:
+        with profilePhase("rateLimit"):
+            rate_limiter.acquire()
+    with profilePhase("sendEmail"):
+        success = sendEmail(smtp_server,
+                            EMAIL_CONFIG["MY_SMTP_USERNAME"],
+                            EMAIL_CONFIG["MY_SMTP_PASSWORD"],
+                            EMAIL_CONFIG["MY_EMAIL_ADDRESS"],
+                            student_email_id + EMAIL_CONFIG["STUDENT_MAIL_DOMAIN"],
+                            EMAIL_CONFIG["EMAIL_SUBJECT"],
+                            cc = EMAIL_CONFIG["CC_ADDRESS"],
+                            attachment_path = attachment_path,
+                            body = EMAIL_CONFIG["EMAIL_MESSAGE"],
+                            html = email_html,
+                            port = int(EMAIL_CONFIG["SMTP_PORT"]),
+                            starttls = EMAIL_CONFIG["SMTP_STARTTLS"])
+    if rate_limiter is None:
+        time.sleep(float(EMAIL_CONFIG["EMAIL_DELAY"] or 0))
     if success:
         print("Sent email to: " + student_email_id + EMAIL_CONFIG["STUDENT_MAIL_DOMAIN"])
         return [student_email_id, "1"]
     else:
         return [student_email_id, "0"]
 
+def emailSubmission(submission: dict, smtp_server: SmtpPool, rate_limiter: TokenBucket, journal: EmailJournal) -> list:
+    try:
+        with profileStudent(submission["student_id"], submission["path"]):
+            result = emailFeedback(submission["path"], submission["student_id"], smtp_server, rate_limiter)
+    except Exception as e:
+        print("ERROR: Something is wrong with: " + str(submission["student_id"]))
+        print(repr(e), file=sys.stderr)
+        result = [submission["student_id"], "0"]
+    journal.record(submission["student_id"], submission["sha256"], result[1] == "1")
+    return result
+
+def getQuestionAnswers(fullPath: str, studentID: str) -> dict:
+    # unlocked cells by grade_id, cells without nbgrader metadata belong to the question before them
+    source_json = readJson(fullPath)
+    answers = {}
+    grade_id = None
+    for cell in source_json["cells"]:
+        try:
+            source = cell["source"].splitlines(True) if type(cell["source"]) == str else cell["source"]
+            if "nbgrader" in cell["metadata"] and cell["metadata"]["nbgrader"].get("locked", False) == False and "grade_id" in cell["metadata"]["nbgrader"]:
+                # str so keys match after a round trip through the json result cache
+                grade_id = str(cell["metadata"]["nbgrader"]["grade_id"])
+                answers.setdefault(grade_id, []).extend(source)
+            elif "nbgrader" not in cell["metadata"] and grade_id is not None:
+                answers[grade_id] += [""] + source
+        except:
+            pass
+    return {"student_id": studentID, "answers": answers}
+
+def writeMossFiles(source_dir: str, student_dir: str, assign_name: str, moss_dir: str, getAnswers = getQuestionAnswers) -> list:
+    import shutil
+    # one directory per question <moss_dir>/<assignment>/<NbName-grade_id>/<student_id>.py and its starter code in <moss_dir>/<assignment>-base/<NbName-grade_id>.py
+    nb_names = getAssignmentFiles(source_dir, assign_name, "ipynb")
+    assignment = assign_name.replace(" ", "_")
+    codeDir = os.path.join(moss_dir, assignment)
+    baseDir = os.path.join(moss_dir, assignment + "-base")
+    shutil.rmtree(codeDir, ignore_errors=True)
+    shutil.rmtree(baseDir, ignore_errors=True)
+    questions = []
+    used_questions = set()
+    for nb_name in nb_names:
+        # starter code is every line of the template's answer cells outside of solution blocks
+        try:
+            template_answers = getQuestionAnswers(os.path.join(source_dir, assign_name, nb_name), "instructor")["answers"]
+        except:
+            print("Failed to construct base file for " + nb_name)
+            template_answers = {}
+        starter = {}
+        for grade_id, lines in template_answers.items():
+            starter[grade_id] = []
+            nonSolution = True
+            for line in lines:
+                if "### BEGIN SOLUTION" in line:
+                    nonSolution = False
+                elif "### END SOLUTION" in line:
+                    nonSolution = True
+                elif nonSolution:
+                    starter[grade_id].append(line)
+        student_answers = applyFuncDirectory(getAnswers, student_dir, assign_name, nb_name, None)
+        grade_ids = list(template_answers) + sorted(set(grade_id for student in student_answers for grade_id in student["answers"]) - set(template_answers))
+        for grade_id in grade_ids:
+            question = re.sub(r"[^\w\-]", "_", os.path.splitext(nb_name)[0] + "-" + grade_id)
+            # grade_ids like "q 1" and "q_1" would otherwise share a directory
+            name, suffix = question, 2
+            while question in used_questions:
+                question = "%s_%s" %(name, suffix)
+                suffix += 1
+            used_questions.add(question)
+            questionDir = os.path.join(codeDir, question)
+            os.makedirs(questionDir, exist_ok=True)
+            starter_lines = [line.strip() for line in starter.get(grade_id, []) if line.strip() != ""]
+            for student in student_answers:
+                # starter code is left in and removed by the base file (moss -b, simcheck), answers identical to it are skipped
+                answer = student["answers"].get(grade_id, [])
+                if [line.strip() for line in answer if line.strip() != ""] not in [[], starter_lines]:
+                    with open(os.path.join(questionDir, student["student_id"] + ".py"), "w", encoding="utf8", errors="backslashreplace") as f:
+                        f.writelines(line if line.endswith("\n") else line + "\n" for line in answer)
+            baseFile = None
+            if len(starter_lines) > 0:
+                os.makedirs(baseDir, exist_ok=True)
+                baseFile = os.path.join(baseDir, question + ".py")
+                with open(baseFile, "w", encoding="utf8", errors="backslashreplace") as f:
+                    f.writelines(line if line.endswith("\n") else line + "\n" for line in starter[grade_id])
+            questions.append((question, questionDir, baseFile))
+    return questions
+
+PYTHON_TOKEN = re.compile(r'''(?P<comment>#[^\n]*)'''
+                          r'''|(?P<string>[rRbBuUfF]{0,2}(?:"""[\s\S]*?"""|\'\'\'[\s\S]*?\'\'\'|"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'))'''
+                          r'''|(?P<name>[A-Za-z_]\w*)'''
+                          r'''|(?P<number>\.?\d[\w.]*)'''
+                          r'''|(?P<op>\*\*=?|//=?|>>=?|<<=?|->|:=|[-+*/%@&|^=<>!]=|\S)''')
+
+def tokenizeCode(code: str) -> tuple:
+    # regex based so broken student code still tokenizes, variable names, strings and numbers are normalized like moss
+    newlines = [i for i, c in enumerate(code) if c == "\n"]
+    tokens = []
+    lines = []
+    for match in PYTHON_TOKEN.finditer(code):
+        kind = match.lastgroup
+        if kind == "comment":
+            continue
+        elif kind == "string":
+            tokens.append("S")
+        elif kind == "number":
+            tokens.append("N")
+        elif kind == "name":
+            tokens.append(match.group() if keyword.iskeyword(match.group()) else "V")
+        else:
+            tokens.append(match.group())
+        lines.append(bisect.bisect_right(newlines, match.start()) + 1)
+    return tokens, lines
+
+def fingerprintCode(code: str, kgram: int, window: int) -> dict:
+    # winnowed Karp-Rabin k-gram hashes -> [first line, last line] of their first occurrence
+    tokens, lines = tokenizeCode(code)
+    if len(tokens) < kgram:
+        return {}
+    # stable token values so fingerprints can be compared between runs
+    values = {token: int.from_bytes(hashlib.blake2b(token.encode("utf8"), digest_size=8).digest(), "big") for token in set(tokens)}
+    modulus = (1 << 61) - 1
+    base = 1000003
+    top = pow(base, kgram - 1, modulus)
+    h = 0
+    for token in tokens[:kgram]:
+        h = (h * base + values[token]) % modulus
+    hashes = [h]
+    for i in range(kgram, len(tokens)):
+        h = ((h - values[tokens[i - kgram]] * top) * base + values[tokens[i]]) % modulus
+        hashes.append(h)
+    # keep the rightmost minimum of each window, recorded once per position
+    fingerprints = {}
+    last = -1
+    for i in range(max(len(hashes) - window + 1, 1)):
+        window_hashes = hashes[i:i + window]
+        lowest = min(window_hashes)
+        j = i + len(window_hashes) - 1 - window_hashes[::-1].index(lowest)
+        if j != last:
+            last = j
+            if hashes[j] not in fingerprints:
+                fingerprints[hashes[j]] = [lines[j], lines[j + kgram - 1]]
+    return fingerprints
+
+def fingerprintFile(fullPath: str, kgram: int, window: int) -> dict:
+    with open(fullPath, "r", encoding="utf8", errors="replace") as f:
+        return fingerprintCode(f.read(), kgram, window)
+
+def formatLineRanges(ranges: list) -> str:
+    merged = []
+    for start, end in sorted(ranges):
+        if len(merged) > 0 and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return " ".join(str(start) if start == end else "%s-%s" %(start, end) for start, end in merged)
+
+def rankSimilarPairs(fingerprints: dict, base_fingerprints: dict, max_students: int, min_shared: int) -> list:
+    # inverted index of fingerprint -> students, only students sharing a fingerprint are ever paired
+    index = {}
+    for student_id in sorted(fingerprints):
+        for h in fingerprints[student_id]:
+            if h not in base_fingerprints:
+                index.setdefault(h, []).append(student_id)
+    sizes = collections.Counter(student_id for students in index.values() for student_id in students)
+    shared = {}
+    for h, students in index.items():
+        if 1 < len(students) <= max_students:
+            for pair in itertools.combinations(students, 2):
+                shared.setdefault(pair, []).append(h)
+    pairs = []
+    for (student_a, student_b), hashes in shared.items():
+        if len(hashes) >= min_shared:
+            pairs.append({"student_a": student_a, "student_b": student_b, "shared": len(hashes),
+                          "percent_a": round(100 * len(hashes) / sizes[student_a], 1),
+                          "percent_b": round(100 * len(hashes) / sizes[student_b], 1),
+                          "lines_a": formatLineRanges([fingerprints[student_a][h] for h in hashes]),
+                          "lines_b": formatLineRanges([fingerprints[student_b][h] for h in hashes])})
+    pairs.sort(key=lambda pair: (-max(pair["percent_a"], pair["percent_b"]), -pair["shared"], pair["student_a"], pair["student_b"]))
+    return pairs
+
+def fingerprintMossFiles(questions: list, jobs: int = 1, database = None, term: typing.Union[str, None] = None, assignment: typing.Union[str, None] = None) -> dict:
+    # question -> (student fingerprints, base fingerprints), files already in the fingerprint database with the same hash are not fingerprinted again
+    fingerprint = functools.partial(fingerprintFile, kgram=SIMCHECK_CONFIG["KGRAM"], window=SIMCHECK_CONFIG["WINDOW"])
+    fingerprints = {}
+    changed = []
+    for question, questionDir, baseFile in questions:
+        fingerprints[question] = {}
+        for f in sorted(f for f in os.listdir(questionDir) if f.endswith(".py")):
+            student_id = os.path.splitext(f)[0]
+            fullPath = os.path.join(questionDir, f)
+            if database is None:
+                changed.append((question, student_id, fullPath, None))
+                continue
+            file_hash = hashFile(fullPath)
+            stored = database.stored(term, assignment, question, student_id, file_hash)
+            if stored is None:
+                changed.append((question, student_id, fullPath, file_hash))
+            else:
+                fingerprints[question][student_id] = stored
+    paths = [fullPath for _, _, fullPath, _ in changed] + [baseFile for _, _, baseFile in questions if baseFile is not None]
+    with profilePhase("fingerprintFile"):
+        if jobs > 1 and len(paths) > 1:
+            import multiprocessing
+            with multiprocessing.Pool(min(jobs, len(paths))) as pool:
+                results = pool.map(fingerprint, paths, chunksize=8)
+        else:
+            results = list(map(fingerprint, paths))
+    for (question, student_id, _, file_hash), result in zip(changed, results):
+        fingerprints[question][student_id] = result
+        if database is not None:
+            database.store(term, assignment, question, student_id, file_hash, result)
+    base_results = iter(results[len(changed):])
+    output = {}
+    for question, _, baseFile in questions:
+        output[question] = (dict(sorted(fingerprints[question].items())), next(base_results) if baseFile is not None else {})
+    if database is not None:
+        print("Fingerprinted %s of %s files (others unchanged in database)" %(len(changed), sum(len(students) for students in fingerprints.values())))
+    return output
+
+def rankQuestionPairs(question_fingerprints: tuple) -> list:
+    question, (fingerprints, base_fingerprints) = question_fingerprints
+    pairs = rankSimilarPairs(fingerprints, base_fingerprints, SIMCHECK_CONFIG["MAX_STUDENTS"], SIMCHECK_CONFIG["MIN_SHARED"])
+    for pair in pairs:
+        pair["question"] = question
+    return pairs
+
+def checkSimilarity(fingerprints: dict, jobs: int = 1) -> list:
+    # questions are ranked in parallel, then all pairs are sorted together
+    with profilePhase("rankSimilarPairs"):
+        if jobs > 1 and len(fingerprints) > 1:
+            import multiprocessing
+            with multiprocessing.Pool(min(jobs, len(fingerprints))) as pool:
+                results = pool.map(rankQuestionPairs, fingerprints.items())
+        else:
+            results = list(map(rankQuestionPairs, fingerprints.items()))
+    pairs = [pair for question_pairs in results for pair in question_pairs]
+    pairs.sort(key=lambda pair: (-max(pair["percent_a"], pair["percent_b"]), -pair["shared"], pair["question"], pair["student_a"], pair["student_b"]))
+    return pairs
+
+class FingerprintDatabase:
+    # sqlite store of every ingested submission's fingerprints, shared across assignments (and terms if SIMCHECK_CONFIG["DATABASE"] is shared)
+    SCHEMA = 2
+
+    def __init__(self, path: str, kgram: int, window: int):
+        import sqlite3
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value INTEGER)")
+            settings = dict(self.connection.execute("SELECT name, value FROM settings"))
+            if settings != {"kgram": kgram, "window": window, "schema": self.SCHEMA}:
+                # fingerprints from other settings can never match, start over
+                if len(settings) > 0:
+                    print("Fingerprint settings changed, clearing " + path)
+                self.connection.execute("DROP TABLE IF EXISTS fingerprints")
+                self.connection.execute("DROP TABLE IF EXISTS submissions")
+                self.connection.execute("DELETE FROM settings")
+                self.connection.executemany("INSERT INTO settings VALUES (?, ?)", [("kgram", kgram), ("window", window), ("schema", self.SCHEMA)])
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS submissions (id INTEGER PRIMARY KEY, term TEXT, assignment TEXT, question TEXT, student_id TEXT, sha256 TEXT, UNIQUE (term, assignment, question, student_id));
+                CREATE TABLE IF NOT EXISTS fingerprints (hash INTEGER, submission INTEGER, first_line INTEGER, last_line INTEGER, PRIMARY KEY (hash, submission)) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS fingerprints_submission ON fingerprints (submission);
+            """)
+
+    def stored(self, term: str, assignment: str, question: str, student_id: str, file_hash: str) -> typing.Union[dict, None]:
+        row = self.connection.execute("SELECT id FROM submissions WHERE term = ? AND assignment = ? AND question = ? AND student_id = ? AND sha256 = ?", (term, assignment, question, student_id, file_hash)).fetchone()
+        if row is None:
+            return None
+        return {h: [first_line, last_line] for h, first_line, last_line in self.connection.execute("SELECT hash, first_line, last_line FROM fingerprints WHERE submission = ?", row)}
+
+    def store(self, term: str, assignment: str, question: str, student_id: str, file_hash: str, fingerprints: dict) -> None:
+        with self.connection:
+            row = self.connection.execute("SELECT id FROM submissions WHERE term = ? AND assignment = ? AND question = ? AND student_id = ?", (term, assignment, question, student_id)).fetchone()
+            if row is not None:
+                self.connection.execute("DELETE FROM fingerprints WHERE submission = ?", row)
+                self.connection.execute("UPDATE submissions SET sha256 = ? WHERE id = ?", (file_hash, row[0]))
+                submission = row[0]
+            else:
+                submission = self.connection.execute("INSERT INTO submissions (term, assignment, question, student_id, sha256) VALUES (?, ?, ?, ?, ?)", (term, assignment, question, student_id, file_hash)).lastrowid
+            self.connection.executemany("INSERT INTO fingerprints VALUES (?, ?, ?, ?)", ((h, submission, lines[0], lines[1]) for h, lines in fingerprints.items()))
+
+    def matches(self, term: str, assignment: str, hashes: list) -> list:
+        # index lookups only, cost grows with the number of matching fingerprints rather than the size of the database
+        rows = []
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i:i + 500]
+            rows += self.connection.execute("SELECT f.hash, s.term, s.assignment, s.question, s.student_id, f.first_line, f.last_line FROM fingerprints f JOIN submissions s ON s.id = f.submission "
+                                            "WHERE f.hash IN (%s) AND NOT (s.term = ? AND s.assignment = ?)" %(",".join("?" * len(chunk))), chunk + [term, assignment]).fetchall()
+        return rows
+
+    def close(self) -> None:
+        self.connection.close()
+
+def rankHistoryMatches(database: FingerprintDatabase, term: str, assignment: str, fingerprints: dict, max_matches: int, min_shared: int) -> list:
+    matches = []
+    for question, (question_fingerprints, base_fingerprints) in fingerprints.items():
+        for student_id, student_fingerprints in question_fingerprints.items():
+            hashes = [h for h in student_fingerprints if h not in base_fingerprints]
+            postings = {}
+            for h, match_term, match_assignment, match_question, match_student_id, first_line, last_line in database.matches(term, assignment, hashes):
+                postings.setdefault(h, []).append(((match_term, match_assignment, match_question, match_student_id), [first_line, last_line]))
+            shared = {}
+            for h, posting in postings.items():
+                # common code found in too many past submissions
+                if len(posting) <= max_matches:
+                    for match, lines in posting:
+                        shared.setdefault(match, []).append((student_fingerprints[h], lines))
+            for (match_term, match_assignment, match_question, match_student_id), lines in shared.items():
+                if len(lines) >= min_shared:
+                    matches.append({"question": question, "student_id": student_id, "term": match_term, "assignment": match_assignment, "match_question": match_question, "match_student_id": match_student_id,
+                                    "shared": len(lines), "percent": round(100 * len(lines) / len(hashes), 1),
+                                    "lines": formatLineRanges([student_lines for student_lines, _ in lines]),
+                                    "match_lines": formatLineRanges([match_lines for _, match_lines in lines])})
+    matches.sort(key=lambda match: (-match["percent"], -match["shared"], match["question"], match["student_id"], match["term"], match["assignment"], match["match_question"], match["match_student_id"]))
+    return matches
+
 def removeZips(fullPath: str, studentID: str) -> None:
     if os.path.isfile(fullPath):
         if os.path.split(fullPath)[1] == "feedback.zip":
             os.remove(fullPath)
 
-def zipFeedback(student_dir: str, data: list) -> None:
+def zipFeedback(student_dir: str, data: list, compress_level: int = 6, workers: int = 1) -> None:
+    import concurrent.futures
     # convert to dict
     studentDict = {}
     for sub_list in data:
@@ -846,13 +2156,47 @@ def zipFeedback(student_dir: str, data: list) -> None:
             if student["student_id"] not in studentDict:
                 studentDict[student["student_id"]] = []
             studentDict[student["student_id"]].append(student["path"])
-    # zip files into studentID/zip/feedback.zip
-    for studentID in studentDict:
-        zipPath = os.path.join(student_dir, studentID, "zip")
-        os.makedirs(zipPath, exist_ok=True)
-        with zipfile.ZipFile(os.path.join(zipPath, "feedback.zip"), 'w') as z:
-            for f in studentDict[studentID]:
+    # remove archives of students without any feedback
+    for student in applyFuncDirectory(returnPath, student_dir, "zip", "feedback.zip", None):
+        if student["student_id"] not in studentDict:
+            removeZips(student["path"], student["student_id"])
+    # zip files into studentID/zip/feedback.zip (zlib releases the GIL so threads compress in parallel)
+    zipPaths = [os.path.join(student_dir, studentID, "zip", "feedback.zip") for studentID in studentDict]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        rebuilt = list(executor.map(zipStudentFeedback, zipPaths, studentDict.values(), itertools.repeat(compress_level)))
+    print("Rebuilt %s of %s feedback.zip files (others unchanged)" %(sum(rebuilt), len(rebuilt)))
+
+def zipStudentFeedback(zipPath: str, files: list, compress_level: int = 6) -> bool:
+    # zipPath is <student_dir>/<student_id>/zip/feedback.zip
+    with profileStudent(os.path.basename(os.path.dirname(os.path.dirname(zipPath))), *files):
+        return writeFeedbackZip(zipPath, files, compress_level)
+
+def writeFeedbackZip(zipPath: str, files: list, compress_level: int = 6) -> bool:
+    import zipfile
+    # the archive comment holds a manifest of member hashes, the archive is only rebuilt if it doesn't match
+    manifest = {"compress_level": compress_level, "members": [[os.path.basename(f), hashFile(f)] for f in files]}
+    comment = json.dumps(manifest, separators=(',', ':')).encode("utf8")
+    if len(comment) > 65535:
+        comment = b""
+    try:
+        with zipfile.ZipFile(zipPath, "r") as z:
+            if comment != b"" and z.comment == comment:
+                return False
+    except (OSError, zipfile.BadZipFile):
+        pass
+    os.makedirs(os.path.dirname(zipPath), exist_ok=True)
+    tmpPath = "%s.%s-%s.tmp" %(zipPath, os.getpid(), threading.get_ident())
+    try:
+        with profilePhase("writeZip"), zipfile.ZipFile(tmpPath, "w", zipfile.ZIP_DEFLATED, compresslevel=compress_level) as z:
+            for f in files:
                 z.write(f, os.path.basename(f))
+            z.comment = comment
+        os.replace(tmpPath, zipPath)
+    except:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        raise
+    return True
 
 def chmod(fullPath: str, studentID: str, permission: str) -> None:
     octal = eval("0o" + permission)
@@ -864,6 +2208,41 @@ def chmod(fullPath: str, studentID: str, permission: str) -> None:
         if new_permission[-len(permission):] != permission:
             print("Could not change permissions for %s: %s" %(studentID, fullPath))
 
+def readGradebook(db_path: str, assign_name: str) -> dict:
+    import pathlib
+    import sqlite3
+    # student_id -> submission timestamp, raw score (with extra credit), score (after late penalties), and score of each (notebook, grade_id)
+    connection = sqlite3.connect(pathlib.Path(os.path.abspath(db_path)).as_uri() + "?mode=ro", uri=True)
+    try:
+        tables = set(name for name, in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+        if "base_cells" in tables:
+            # nbgrader >= 0.6 splits cell names into base_cells
+            cell_join = "LEFT JOIN grade_cells gc ON gc.id = g.cell_id LEFT JOIN base_cells c ON c.id = gc.id"
+        else:
+            cell_join = "LEFT JOIN grade_cell c ON c.id = g.cell_id"
+        rows = connection.execute("SELECT sa.student_id, sa.timestamp, sn.id, n.name, c.name, g.auto_score, g.manual_score, g.extra_credit, sn.late_submission_penalty "
+                                  "FROM assignment a JOIN submitted_assignment sa ON sa.assignment_id = a.id "
+                                  "LEFT JOIN submitted_notebook sn ON sn.assignment_id = sa.id LEFT JOIN notebook n ON n.id = sn.notebook_id "
+                                  "LEFT JOIN grade g ON g.notebook_id = sn.id " + cell_join + " WHERE a.name = ?", (assign_name,)).fetchall()
+    finally:
+        connection.close()
+    grades = {}
+    penalties = {}
+    for student_id, timestamp, submitted_notebook, notebook, cell, auto_score, manual_score, extra_credit, penalty in rows:
+        if student_id not in grades:
+            grades[student_id] = {"timestamp": "" if timestamp is None else str(timestamp), "raw_score": 0.0, "score": 0.0, "cells": {}}
+            penalties[student_id] = {}
+        if submitted_notebook is not None:
+            penalties[student_id][submitted_notebook] = penalty or 0.0
+        if cell is not None:
+            score = (manual_score if manual_score is not None else auto_score) or 0.0
+            grades[student_id]["cells"][(notebook, cell)] = score
+            grades[student_id]["raw_score"] += score + (extra_credit or 0.0)
+    for student_id in grades:
+        # clamped like nbgrader's export so over-penalised late submissions aren't reported as mismatches
+        grades[student_id]["score"] = max(0.0, grades[student_id]["raw_score"] - sum(penalties[student_id].values()))
+    return grades
+
 def readTimestamps(fullPath: str, studentID: str):
     try:
         with open(fullPath, 'r', errors='ignore') as f:
@@ -875,9 +2254,956 @@ def readTimestamps(fullPath: str, studentID: str):
         timestamp = "ERROR"
     return {"student_id": studentID, "read_timestamp": timestamp}
 
+def backupObjectPath(backup_dir: str, file_hash: str) -> str:
+    return os.path.join(backup_dir, "objects", file_hash[:2], file_hash)
+
+def listSnapshots(backup_dir: str, nbgrader_step: typing.Union[str, None] = None) -> list:
+    # oldest first, by manifest mtime since mm-dd-hh-mm names don't sort across years
+    snapshot_dir = os.path.join(backup_dir, "snapshots")
+    if not os.path.isdir(snapshot_dir):
+        return []
+    snapshots = [entry for entry in os.scandir(snapshot_dir) if entry.name.endswith(".json")]
+    if nbgrader_step is not None:
+        snapshots = [entry for entry in snapshots if entry.name.startswith(nbgrader_step + "-")]
+    return [entry.path for entry in sorted(snapshots, key=lambda entry: entry.stat().st_mtime_ns)]
+
+def storeBackupObject(backup_dir: str, fullPath: str) -> str:
+    with profilePhase("storeBackupObject"):
+        return copyBackupObject(backup_dir, fullPath)
+
+def copyBackupObject(backup_dir: str, fullPath: str) -> str:
+    # hash while copying so each changed file is only read once
+    tmp_dir = os.path.join(backup_dir, "objects", "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, "%s-%s.tmp" %(os.getpid(), threading.get_ident()))
+    sha256 = hashlib.sha256()
+    try:
+        with open(fullPath, "rb") as src, open(tmp_path, "wb") as dst:
+            for chunk in iter(lambda: src.read(1 << 20), b""):
+                sha256.update(chunk)
+                dst.write(chunk)
+            dst.flush()
+            os.fsync(dst.fileno())
+        file_hash = sha256.hexdigest()
+        object_path = backupObjectPath(backup_dir, file_hash)
+        if os.path.exists(object_path):
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            os.replace(tmp_path, object_path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return file_hash
+
+def backupSnapshot(course_dir: str, nbgrader_step: str, student_dir: str, workers: int = 1) -> str:
+    import concurrent.futures
+    backup_dir = os.path.join(course_dir, "backups")
+    # files with the same size and mtime as the previous snapshot of this step are not read again
+    previous = {}
+    snapshots = listSnapshots(backup_dir, nbgrader_step)
+    if len(snapshots) > 0:
+        previous = readJson(snapshots[-1])["files"]
+    files = {}
+    changed = []
+    for root, dirs, names in os.walk(student_dir):
+        dirs.sort()
+        for name in sorted(names):
+            fullPath = os.path.join(root, name)
+            relPath = os.path.relpath(fullPath, student_dir).replace(os.sep, "/")
+            try:
+                stat = os.stat(fullPath)
+            except OSError:
+                print("Could not backup: " + fullPath)
+                continue
+            entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "mode": stat.st_mode & 0o777}
+            old_entry = previous.get(relPath)
+            if (old_entry is not None and old_entry["size"] == entry["size"] and old_entry["mtime_ns"] == entry["mtime_ns"]
+                    and os.path.exists(backupObjectPath(backup_dir, old_entry["sha256"]))):
+                entry["sha256"] = old_entry["sha256"]
+            else:
+                changed.append(relPath)
+            files[relPath] = entry
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        hashes = executor.map(storeBackupObject, itertools.repeat(backup_dir), [os.path.join(student_dir, f) for f in changed])
+        for relPath, file_hash in zip(changed, hashes):
+            files[relPath]["sha256"] = file_hash
+    snapshot_name = nbgrader_step + "-" + datetime.datetime.now().strftime("%m-%d-%H-%M")
+    snapshot_path = os.path.join(backup_dir, "snapshots", snapshot_name + ".json")
+    os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+    writeJson(snapshot_path, {"nbgrader_step": nbgrader_step, "source": os.path.abspath(student_dir), "time": datetime.datetime.now().isoformat(), "files": files})
+    print("Backed up %s files (%s new or changed) to snapshot %s" %(len(files), len(changed), snapshot_name))
+    return snapshot_path
+
+def verifyBackups(backup_dir: str, workers: int = 1) -> list:
+    import concurrent.futures
+    # every object referenced by any snapshot is rehashed once
+    referenced = {}
+    for snapshot_path in listSnapshots(backup_dir):
+        snapshot_name = os.path.splitext(os.path.basename(snapshot_path))[0]
+        try:
+            files = readJson(snapshot_path)["files"]
+        except Exception as e:
+            print("Could not read snapshot %s: %s" %(snapshot_name, e))
+            referenced.setdefault(None, []).append((snapshot_name, None))
+            continue
+        for relPath, entry in files.items():
+            referenced.setdefault(entry["sha256"], []).append((snapshot_name, relPath))
+    def checkObject(file_hash):
+        object_path = backupObjectPath(backup_dir, file_hash)
+        if not os.path.isfile(object_path):
+            return "missing"
+        return "ok" if hashFile(object_path) == file_hash else "corrupt"
+    object_hashes = [file_hash for file_hash in referenced if file_hash is not None]
+    problems = [{"snapshot": snapshot_name, "file": None, "sha256": None, "status": "unreadable"} for snapshot_name, _ in referenced.get(None, [])]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for file_hash, status in zip(object_hashes, executor.map(checkObject, object_hashes)):
+            if status != "ok":
+                for snapshot_name, relPath in referenced[file_hash]:
+                    print("%s object for %s in snapshot %s" %(status.capitalize(), relPath, snapshot_name))
+                    problems.append({"snapshot": snapshot_name, "file": relPath, "sha256": file_hash, "status": status})
+    print("Verified %s objects, %s problems found" %(len(object_hashes), len(problems)))
+    return problems
+
+
+def listBackups(backup_dir: str) -> dict:
+    # snapshot manifests and legacy <nbgrader_step-mm-dd-hh-mm>.zip archives -> [size, mtime_ns]
+    backups = {}
+    for path in listSnapshots(backup_dir):
+        stat = os.stat(path)
+        backups["snapshots/" + os.path.basename(path)] = [stat.st_size, stat.st_mtime_ns]
+    if os.path.isdir(backup_dir):
+        for entry in os.scandir(backup_dir):
+            if entry.is_file() and re.match(r"^.+-\d\d-\d\d-\d\d-\d\d\.zip$", entry.name):
+                stat = entry.stat()
+                backups[entry.name] = [stat.st_size, stat.st_mtime_ns]
+    return backups
+
+def addBackupVersion(tree: dict, relPath: str, version: dict) -> None:
+    # student -> assignment -> file -> versions (or assignment -> file -> versions for source and release)
+    parts = relPath.split("/")
+    for part in parts[:-1]:
+        tree = tree.setdefault(part, {})
+        if type(tree) != dict:
+            return
+    versions = tree.setdefault(parts[-1], [])
+    if type(versions) == list:
+        versions.append(version)
+        versions.sort(key=lambda v: (v["time"], v["backup"]))
+
+def indexBackup(index: dict, backup_dir: str, name: str) -> None:
+    import zipfile
+    path = os.path.join(backup_dir, name)
+    if name.startswith("snapshots/"):
+        snapshot = readJson(path)
+        tree = index["steps"].setdefault(snapshot["nbgrader_step"], {})
+        for relPath, entry in snapshot["files"].items():
+            addBackupVersion(tree, relPath, {"backup": name, "time": snapshot["time"], "size": entry["size"], "sha256": entry["sha256"], "mode": entry["mode"]})
+    else:
+        nbgrader_step = re.match(r"^(.+)-\d\d-\d\d-\d\d-\d\d\.zip$", name).groups()[0]
+        backup_time = datetime.datetime.fromtimestamp(os.stat(path).st_mtime).isoformat()
+        tree = index["steps"].setdefault(nbgrader_step, {})
+        # only the central directory is read, members are opened individually on restore
+        with zipfile.ZipFile(path, "r") as z:
+            for info in z.infolist():
+                if not info.is_dir():
+                    addBackupVersion(tree, info.filename, {"backup": name, "time": backup_time, "size": info.file_size, "member": info.filename, "crc": info.CRC})
+
+def readBackupIndex(backup_dir: str) -> dict:
+    # <course_dir>/backups/index.json is updated with new backups, rebuilt if any indexed backup changed or was removed
+    index_path = os.path.join(backup_dir, "index.json")
+    backups = listBackups(backup_dir)
+    try:
+        index = readJson(index_path)
+        if any(backups.get(name) != index["backups"][name] for name in index["backups"]):
+            raise Exception("Rebuild index")
+    except:
+        index = {"backups": {}, "steps": {}}
+    for name in sorted(set(backups) - set(index["backups"])):
+        try:
+            indexBackup(index, backup_dir, name)
+            index["backups"][name] = backups[name]
+        except Exception as e:
+            print("Could not index backup %s: %s" %(name, e))
+    if len(backups) > 0:
+        writeJson(index_path, index)
+    return index
+
+def findBackupVersions(index: dict, nbgrader_step: str, path: str) -> dict:
+    # path is relative to the nbgrader_step directory, a directory returns every file below it
+    tree = index["steps"].get(nbgrader_step, {})
+    parts = [part for part in path.replace(os.sep, "/").split("/") if part not in ["", "."]]
+    for part in parts:
+        if type(tree) != dict or part not in tree:
+            return {}
+        tree = tree[part]
+    found = {}
+    stack = [("/".join(parts), tree)]
+    while len(stack) > 0:
+        relPath, node = stack.pop()
+        if type(node) == list:
+            found[relPath] = node
+        else:
+            stack += [((relPath + "/" if relPath else "") + key, node[key]) for key in node]
+    return dict(sorted(found.items()))
+
+def restoreBackupVersion(backup_dir: str, version: dict, target: str) -> None:
+    import shutil
+    import zipfile
+    tmp_path = "%s.%s-%s.tmp" %(target, os.getpid(), threading.get_ident())
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        if "sha256" in version:
+            shutil.copyfile(backupObjectPath(backup_dir, version["sha256"]), tmp_path)
+            os.chmod(tmp_path, version["mode"])
+        else:
+            with zipfile.ZipFile(os.path.join(backup_dir, version["backup"]), "r") as z:
+                with z.open(version["member"]) as src, open(tmp_path, "wb") as dst:
+                    shutil.copyfileobj(src, dst, 1 << 20)
+        os.replace(tmp_path, target)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+####### Course API #######
+
+class Course:
+    # <course_dir> for scripting several steps in one process, notebooks and parser results are loaded on first use and reloaded when a file's mtime or size changes
+    # import nbhelper; course = nbhelper.Course("path/to/course"); course.assignment("a1").fix("nb1.ipynb"); course.assignment("a1").dist(); course.save()
+    PARSERS = {
+        "getAutogradedScore": (getAutogradedScore, False),
+        "getFeedbackScore": (getFeedbackScore, False),
+        "getQuestionAnswers": (getQuestionAnswers, True),
+        "quickInfo": (quickInfo, False)
+    }
+
+    def __init__(self, course_dir: str = ".", source_dir: typing.Union[str, None] = None, odir: typing.Union[str, None] = None, jobs: int = 1, use_cache: bool = True):
+        # course_dir can be None (eg. an invalid --cdir) when odir and source_dir are given, results are then not cached
+        self.course_dir = None if course_dir is None else os.path.normpath(course_dir)
+        if source_dir is not None:
+            self.source_dir = os.path.normpath(source_dir)
+        else:
+            self.source_dir = None if self.course_dir is None else os.path.join(self.course_dir, "source")
+        self.odir = odir
+        self.jobs = jobs
+        self.use_cache = use_cache and self.course_dir is not None
+        self.assignments = {}
+        self.notebooks = {} # path: (stamp, notebook)
+        self.caches = {} # parser name: result cache
+        self.parsers = {}
+
+    def stepDir(self, nbgrader_step: str) -> str:
+        # raises NotADirectoryError if missing
+        return getStudentFileDir(self.course_dir, self.odir, nbgrader_step)
+
+    def reportPath(self, assign_name: str, fname: str) -> str:
+        if self.course_dir is None:
+            raise NotADirectoryError("Invalid course directory, reports are written to <course_dir>/reports")
+        return os.path.join(self.course_dir, "reports", assign_name, fname)
+
+    def assignment(self, name: str) -> "Assignment":
+        if name not in self.assignments:
+            self.assignments[name] = Assignment(self, name)
+        return self.assignments[name]
+
+    def read(self, fullPath: str) -> dict:
+        # parsed notebook, shared between callers so copy it before modifying
+        stat = os.stat(fullPath)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        key = os.path.abspath(fullPath)
+        if key not in self.notebooks or self.notebooks[key][0] != stamp:
+            self.notebooks[key] = (stamp, readJson(fullPath))
+        return self.notebooks[key][1]
+
+    def parser(self, name: str):
+        # one of PARSERS wrapped with cacheResults, the cache is read from <course_dir>/.nbhelper-cache on first use
+        if name not in self.parsers:
+            func, by_hash = self.PARSERS[name]
+            self.caches[name] = readResultCache(self.course_dir, name) if self.use_cache else {}
+            self.parsers[name] = cacheResults(func, self.caches[name], CACHE_VERSIONS[name], by_hash=by_hash)
+        return self.parsers[name]
+
+    def save(self) -> None:
+        # write parser results used so far back to <course_dir>/.nbhelper-cache
+        if self.use_cache:
+            for name, cache in self.caches.items():
+                writeResultCache(self.course_dir, name, cache)
+
+    def invalidate(self) -> None:
+        # listings, notebooks and results check mtimes themselves, this forces a rescan (eg. on filesystems with coarse mtimes)
+        clearDirectoryIndex()
+        for assignment in self.assignments.values():
+            assignment.files.clear()
+
+    def zip(self, assign_names: list, compress_level: int = 6) -> None:
+        student_dir = self.stepDir("feedback")
+        # get list of students and files
+        data = []
+        for assign_name in assign_names:
+            data.append(applyFuncDirectory(returnPath, student_dir, assign_name, None, "html"))
+        zipFeedback(student_dir, data, compress_level, self.jobs)
+        self.invalidate()
+
+    def zipFiles(self, file_names: list, compress_level: int = 6) -> None:
+        student_dir = self.stepDir("feedback")
+        data = []
+        for f in file_names:
+            data.append(applyFuncFiles(returnPath, student_dir, f))
+        zipFeedback(student_dir, data, compress_level, self.jobs)
+        self.invalidate()
+
+    def backup(self, nbgrader_step: str) -> str:
+        return backupSnapshot(self.course_dir, nbgrader_step, self.stepDir(nbgrader_step), self.jobs)
+
+    def verify(self) -> list:
+        problems = verifyBackups(os.path.join(self.course_dir, "backups"), self.jobs)
+        if len(problems) > 0:
+            header = [["Snapshot", "File", "SHA256", "Status"]]
+            data = [[problem["snapshot"], problem["file"], problem["sha256"], problem["status"]] for problem in problems]
+            writeCsv(os.path.join(self.course_dir, "backups", "verify.csv"), header + data)
+            print("Problems written to " + os.path.join(self.course_dir, "backups", "verify.csv"))
+        return problems
+
+class Assignment:
+    def __init__(self, course: Course, name: str):
+        self.course = course
+        self.name = name
+        self.files = {} # file extension: (mtime of source/<name>, names in source)
+
+    def notebookNames(self, file_extension: str = "ipynb") -> list:
+        mtime = os.stat(os.path.join(self.course.source_dir, self.name)).st_mtime_ns
+        if file_extension not in self.files or self.files[file_extension][0] != mtime:
+            self.files[file_extension] = (mtime, getAssignmentFiles(self.course.source_dir, self.name, file_extension))
+        return self.files[file_extension][1]
+
+    def template(self, nb_name: str) -> dict:
+        return self.course.read(os.path.join(self.course.source_dir, self.name, nb_name))
+
+    def submissions(self, nb_name: str, nbgrader_step: str = "submitted") -> list:
+        return [Submission(self, submission["student_id"], submission["path"])
+                for submission in applyFuncDirectory(returnPath, self.course.stepDir(nbgrader_step), self.name, nb_name, None)]
+
+    def applyTemplate(self, func, nb_name: str, **kwargs) -> None:
+        # run a fixer on every submission of nb_name with the source notebook as the template
+        template_path = os.path.join(self.course.source_dir, self.name, nb_name)
+        applyTemplateSubmissions(func, template_path, self.course.stepDir("submitted"), nb_name, self.name, delete="n", jobs=self.course.jobs, **kwargs)
+
+    def add(self, nb_name: str) -> None:
+        self.applyTemplate(addNbgraderCell, nb_name)
+
+    def fix(self, nb_name: str) -> None:
+        self.applyTemplate(updateTestCells, nb_name)
+
+    def meta(self, nb_name: str) -> None:
+        self.applyTemplate(updateCellsMeta, nb_name)
+
+    def sortcells(self, nb_name: str) -> None:
+        self.applyTemplate(sortStudentCells, nb_name)
+
+    def rmcells(self, nb_name: str) -> None:
+        self.applyTemplate(removeNonEssentialCells, nb_name)
+
+    def pipeline(self, steps: list, nb_name: str) -> None:
+        self.applyTemplate(applyPipeline, nb_name, steps=parsePipelineSteps(",".join(steps)))
+
+    def info(self, nb_name: str) -> list:
+        header = [["Student ID", "File Size", "Cell Count", "Total Execution Count", "[grade id : execution count]"]]
+        data = applyFuncDirectory(self.course.parser("quickInfo"), self.course.stepDir("submitted"), self.name, nb_name, None)
+        writeCsv(self.course.reportPath(self.name, "info-" + os.path.splitext(nb_name)[0] + ".csv"), header + data)
+        return data
+
+    def dist(self, nb_name: str) -> ScoreMatrix:
+        # test cells passed (0 or 1) per student from autograded notebooks, printed and written to reports
+        student_dir = self.course.stepDir("autograded")
+        getScore = self.course.parser("getAutogradedScore")
+        print("Distribution for " + nb_name)
+        # Init variables
+        source_path = os.path.join(self.course.source_dir, self.name, nb_name)
+        source_score = getScore(source_path, "instructor")
+        grade_id_list = source_score["grade_id_list"]
+        grade_points = source_score["points_list"]
+        # passes (0 or 1) per test cell
+        matrix = ScoreMatrix(grade_id_list, [1] * len(grade_points))
+        error_list = [[] for i in range(len(grade_points))]
+        data = [["Test Cell"] + [i for i in range(1,len(grade_points)+1)]]
+        data.append(["Cell ID"] + grade_id_list)
+        data.append(["Points"] + grade_points)
+        # Get grades
+        grades = applyFuncDirectory(getScore, student_dir, self.name, nb_name, None)
+        # getAutogradedScore().keys() -> ["student_id", "pass_list", "points_list", "error_list", "grade_id_list"]
+        # Get distribution
+        for student in grades:
+            # check order
+            if grade_id_list != student["grade_id_list"]:
+                if set(grade_id_list) == set(student["grade_id_list"]):
+                    student = sortStudentGradeIds(student, grade_id_list)
+                    print("Grade IDs were out of order for: " + student["student_id"])
+            # check if grade ids match now
+            if grade_id_list == student["grade_id_list"]:
+                data.append([student["student_id"]] + student["pass_list"])
+                matrix.add(student["student_id"], student["pass_list"])
+                for i in range(len(grade_points)):
+                    error_list[i].append(student["error_list"][i])
+            else:
+                # still something wrong
+                print(student["student_id"] + " has something wrong with their notebook")
+                print(student)
+        print("Total students: " + str(len(matrix.student_ids)))
+        grade_dist = matrix.sums()
+        for i in range(len(grade_points)):
+            cellnum = "{:<5}".format(str(i+1))
+            gp = "{:<4}".format(str(grade_points[i]))
+            gd = "{:<4}".format(str(int(grade_dist[i])))
+            print("Test Cell: %s Points: %s Total passes: %s" %(cellnum, gp, gd))
+        print("")
+        for i in range(len(grade_points)):
+            print("Errors for test cell: %s" %(i+1))
+            print(collections.Counter(error_list[i]))
+            print("")
+        print("Test cells passed per student:")
+        printHistogram(matrix)
+        print("")
+        writeCsv(self.course.reportPath(self.name, "dist-" + os.path.splitext(nb_name)[0] + ".csv"), data)
+        writeItemAnalysis(self.course.reportPath(self.name, "items-dist-" + os.path.splitext(nb_name)[0] + ".csv"), matrix)
+        exportScoreMatrix(self.course.course_dir, "dist", self.name, os.path.splitext(nb_name)[0], matrix)
+        return matrix
+
+    def fdist(self, nb_name: str) -> ScoreMatrix:
+        # points per test cell from feedback (including manual grades), nb_name without .html, printed and written to reports
+        student_dir = self.course.stepDir("feedback")
+        getScore = self.course.parser("getFeedbackScore")
+        print("Distribution for " + nb_name + ".html")
+        # Init variables
+        source_path = os.path.join(self.course.source_dir, self.name, nb_name + ".ipynb")
+        source_score = getAutogradedScore(source_path, "instructor")
+        grade_id_list = source_score["grade_id_list"]
+        grade_points = source_score["points_list"]
+        matrix = ScoreMatrix(grade_id_list, grade_points)
+        data = [["Test Cell"] + [i for i in range(1,len(grade_points)+1)]]
+        data.append(["Cell ID"] + grade_id_list)
+        data.append(["Points"] + grade_points)
+        # Get grades
+        grades = applyFuncDirectory(getScore, student_dir, self.name, nb_name + ".html", None)
+        # getFeedbackScore().keys() -> ["student_id", "total_score", "score_list", "score_totals", "grade_id_list"]
+        # Get distribution
+        for student in grades:
+            # check order
+            if grade_id_list != student["grade_id_list"]:
+                if set(grade_id_list) == set(student["grade_id_list"]):
+                    student = sortStudentGradeIds(student, grade_id_list)
+                    print("Grade IDs were out of order for: " + student["student_id"])
+            # check if grade ids match now and for other possible errors
+            if grade_id_list == student["grade_id_list"] and grade_points == student["score_totals"] and student["total_score"] is not None and abs(student["total_score"] - sum(student["score_list"])) < 0.1:
+                data.append([student["student_id"]] + student["score_list"])
+                matrix.add(student["student_id"], student["score_list"])
+            else:
+                print(student["student_id"] + " has something wrong with their feedback")
+                print(student)
+        print("Total students: " + str(len(grades)))
+        grade_dist = matrix.sums()
+        for i in range(len(grade_points)):
+            cellnum = "{:<5}".format(str(i+1))
+            gp = "{:<4}".format(str(grade_points[i]))
+            gd = "{:<4}".format(str(grade_dist[i]))
+            print("Test Cell: %s Points: %s Total points: %s" %(cellnum, gp, gd))
+        print("")
+        print("Total scores:")
+        printHistogram(matrix)
+        print("")
+        writeCsv(self.course.reportPath(self.name, "fdist-" + nb_name + ".csv"), data)
+        writeItemAnalysis(self.course.reportPath(self.name, "items-fdist-" + nb_name + ".csv"), matrix)
+        exportScoreMatrix(self.course.course_dir, "fdist", self.name, nb_name, matrix)
+        return matrix
+
+    def zip(self, compress_level: int = 6) -> None:
+        self.course.zip([self.name], compress_level)
+
+class Submission:
+    def __init__(self, assignment: Assignment, student_id: str, path: str):
+        self.assignment = assignment
+        self.student_id = student_id
+        self.path = path
+
+    def __repr__(self) -> str:
+        return "Submission(%r, %r)" %(self.student_id, self.path)
+
+    @property
+    def notebook(self) -> dict:
+        return self.assignment.course.read(self.path)
+
+    def autogradedScore(self) -> dict:
+        return self.assignment.course.parser("getAutogradedScore")(self.path, self.student_id)
+
+    def feedbackScore(self) -> dict:
+        return self.assignment.course.parser("getFeedbackScore")(self.path, self.student_id)
+
+    def info(self) -> list:
+        return self.assignment.course.parser("quickInfo")(self.path, self.student_id)
+
+    def answers(self) -> dict:
+        return self.assignment.course.parser("getQuestionAnswers")(self.path, self.student_id)
+
+    def apply(self, func, **kwargs) -> None:
+        # run one fixer on this submission only
+        applyTemplate(func, self.assignment.template(os.path.basename(self.path)), self.path, self.student_id, **kwargs)
 
 ####### Main #######
 
+def commandGetMoss(args: argparse.Namespace, course: Course) -> None:
+    import urllib.request
+    req = urllib.request.urlopen("http://moss.stanford.edu/general/scripts/mossnet")
+    moss_script = req.read().decode()
+    userid = input("Enter your moss userid: ")
+    moss_script = moss_script.replace("$userid=987654321;", "$userid=%s;" %(userid))
+    os.makedirs(os.path.join(course.course_dir, "moss"), exist_ok=True)
+    if os.name == "nt":
+        with open(os.path.join(course.course_dir, "moss", "moss.pl"), "w") as f:
+            f.write(moss_script)
+    else:
+        with os.fdopen(os.open(os.path.join(course.course_dir, "moss", "moss.pl"), os.O_CREAT | os.O_RDWR, 0o700), "w") as f:
+            f.write(moss_script)
+
+def commandAdd(args: argparse.Namespace, course: Course) -> None:
+    assign_name, nb_name = args.add
+    course.assignment(assign_name).add(nb_name)
+    print("Done")
+
+def commandFix(args: argparse.Namespace, course: Course) -> None:
+    assign_name, nb_name = args.fix
+    course.assignment(assign_name).fix(nb_name)
+    print("Done")
+
+def commandMeta(args: argparse.Namespace, course: Course) -> None:
+    assign_name, nb_name = args.meta
+    course.assignment(assign_name).meta(nb_name)
+    print("Done")
+
+def commandForceGrade(args: argparse.Namespace, course: Course) -> None:
+    assign_name, nb_name = args.forcegrade
+    template_path = os.path.join(course.source_dir, assign_name, nb_name)
+    student_dir = course.stepDir("submitted")
+    # if args.offline:
+    #     delete = input("Delete other files (!=NbName.ipynb) from submission folder (y/N)? ")
+    # else:
+    #     delete = "n"
+    # remove merged notebooks from earlier runs so only students merged in this run are executed and reported
+    import glob
+    for stale_path in glob.glob(os.path.join(glob.escape(os.path.join(course.course_dir, "nbhelper-autograde")), "*", glob.escape(assign_name), glob.escape(nb_name))):
+        os.remove(stale_path)
+        if os.path.isfile(stale_path + ".log"):
+            os.remove(stale_path + ".log")
+    applyTemplateSubmissions(forceAutograde, template_path, student_dir, nb_name, assign_name, delete="n", jobs=args.jobs, course_dir = course.course_dir, AssignName = assign_name, NbNameipynb = nb_name, execute = False)
+    # execute merged notebooks concurrently
+    jobs = []
+    for submission in applyFuncDirectory(returnPath, student_dir, assign_name, nb_name, None):
+        new_path = os.path.join(course.course_dir, "nbhelper-autograde", submission["student_id"], assign_name, nb_name)
+        if os.path.isfile(new_path):
+            jobs.append({"student_id": submission["student_id"], "path": new_path})
+        else:
+            print("Not executed (merge failed): " + submission["student_id"])
+    if args.warmkernels:
+        try:
+            results = runKernelJobs(jobs, args.jobs, args.timeout)
+        except ImportError:
+            print("jupyter_client is not installed, executing with jupyter nbconvert instead")
+            results = runExecutionJobs(jobs, args.jobs, args.timeout, args.memlimit)
+    else:
+        results = runExecutionJobs(jobs, args.jobs, args.timeout, args.memlimit)
+    # summary
+    status_count = collections.Counter(result["status"] for result in results)
+    print("Executed %s notebooks: %s ok, %s failed, %s timed out" %(len(results), status_count["ok"], status_count["failed"], status_count["timeout"]))
+    for result in results:
+        if result["status"] != "ok":
+            print("%s: %s (exit code %s, see %s.log)" %(result["status"].upper(), result["student_id"], result["returncode"], nb_name))
+    header = [["Student ID", "Status", "Exit Code", "Seconds", "File Size"]]
+    data = [[result["student_id"], result["status"], result["returncode"], result["seconds"], result["size"]] for result in results]
+    writeCsv(os.path.join(course.course_dir, "reports", assign_name, "forcegrade-" + os.path.splitext(nb_name)[0] + ".csv"), header + data)
+    print("Done")
+
+def commandSortCells(args: argparse.Namespace, course: Course) -> None:
+    assign_name, nb_name = args.sortcells
+    course.assignment(assign_name).sortcells(nb_name)
+    print("Done")
+
+def commandRmCells(args: argparse.Namespace, course: Course) -> None:
+    assign_name, nb_name = args.rmcells
+    course.assignment(assign_name).rmcells(nb_name)
+    print("Done")
+
+def commandPipeline(args: argparse.Namespace, course: Course) -> None:
+    steps, assign_name, nb_name = args.pipeline
+    course.assignment(assign_name).pipeline(parsePipelineSteps(steps), nb_name)
+    print("Done")
+
+def commandMakeNotebook(args: argparse.Namespace, course: Course) -> None:
+    assign_name, nb_name, fname = args.mknb
+    template_path = os.path.join(course.source_dir, assign_name, nb_name)
+    student_dir = course.stepDir("submitted")
+    data = applyFuncDirectory(makeNotebook, student_dir, assign_name, fname, None, template_path)
+    clearDirectoryIndex()
+    writeCsv(os.path.join(course.course_dir, "reports", assign_name, "mknb-" + os.path.splitext(nb_name)[0] + ".csv"), data)
+    print("Done")
+
+def commandInfo(args: argparse.Namespace, course: Course) -> None:
+    assignment = course.assignment(args.info)
+    for nb_name in assignment.notebookNames():
+        assignment.info(nb_name)
+    course.save()
+    print("Done")
+
+def commandChmod(args: argparse.Namespace, course: Course) -> None:
+    assign_name = args.chmod[1]
+    nb_names = getAssignmentFiles(course.source_dir, assign_name, "ipynb")
+    student_dir = course.stepDir("submitted")
+    for nb_name in nb_names:
+        applyFuncDirectory(chmod, student_dir, assign_name, nb_name, None, args.chmod[0])
+    print("Done")
+
+def commandMoss(args: argparse.Namespace, course: Course) -> None:
+    import concurrent.futures
+    import subprocess
+    assign_name = args.moss
+    student_dir = course.stepDir("submitted")
+    # extract code from student notebooks by question and construct base files
+    getAnswers = course.parser("getQuestionAnswers")
+    questions = writeMossFiles(course.source_dir, student_dir, assign_name, os.path.join(course.course_dir, "moss"), getAnswers)
+    course.save()
+    # prepare to submit to MOSS, one comparison per question
+    commands = []
+    for question, questionDir, baseFile in questions:
+        codeFiles = os.path.relpath(questionDir, os.path.join(course.course_dir, "moss")).replace(os.sep, "/") + "/*.py"
+        if baseFile is None:
+            commands.append((question, "moss.pl -l python " + codeFiles))
+        else:
+            commands.append((question, "moss.pl -l python -b %s %s" %(os.path.relpath(baseFile, os.path.join(course.course_dir, "moss")).replace(os.sep, "/"), codeFiles)))
+    if os.name != "nt":
+        commands = [(question, "./" + command) for question, command in commands]
+    for question, command in commands:
+        print(command)
+    # execute commands
+    if os.name == "nt":
+        submit = input("execute %s commands (y/N/wsl)? " %(len(commands)))
+        if submit.lower() == "wsl":
+            commands = [(question, "bash -c \"./%s\"" %(command)) for question, command in commands]
+    else:
+        submit = input("execute %s commands (y/N)? " %(len(commands)))
+    if submit.lower() in ["y", "wsl"]:
+        def runMoss(question_command):
+            question, command = question_command
+            result = subprocess.run(command, shell=True, cwd=os.path.join(course.course_dir, "moss"), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+            output = result.stdout.strip().splitlines()
+            return question, result.returncode, output
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+            for question, returncode, output in executor.map(runMoss, commands):
+                if returncode == 0 and len(output) > 0:
+                    print("%s: %s" %(question, output[-1]))
+                else:
+                    print("%s: moss failed (exit code %s)" %(question, returncode))
+                    print("\n".join(output))
+    print("Done")
+
+def commandDist(args: argparse.Namespace, course: Course) -> None:
+    assignment = course.assignment(args.dist)
+    for nb_name in assignment.notebookNames():
+        assignment.dist(nb_name)
+    course.save()
+    print("Done")
+
+def commandFeedbackDist(args: argparse.Namespace, course: Course) -> None:
+    assignment = course.assignment(args.fdist)
+    for nb_name in assignment.notebookNames():
+        assignment.fdist(os.path.splitext(nb_name)[0])
+    course.save()
+    print("Done")
+
+def commandCheckGrades(args: argparse.Namespace, course: Course) -> None:
+    import glob
+    import sqlite3
+    assign_name = args.ckgrades
+    student_dir = course.stepDir("submitted")
+    def emptyGrade(timestamp = "", raw_score = 0, score = 0, cells = None) -> dict:
+        return {"timestamp": timestamp, "read_timestamp": "", "raw_score": raw_score, "score": score, "dist_score": 0, "fdist_score": 0, "cells": cells}
+    grade_dict = {}
+    # check nbgrader grades, straight from gradebook.db if possible, otherwise from 'nbgrader export'
+    gradebook_path = os.path.join(course.course_dir, "gradebook.db")
+    try:
+        for student_id, grade in readGradebook(gradebook_path, assign_name).items():
+            grade_dict[student_id] = emptyGrade(grade["timestamp"], grade["raw_score"], grade["score"], grade["cells"])
+        print("Read grades from " + gradebook_path)
+    except sqlite3.Error as e:
+        print("Could not read %s (%s), using grades.csv from 'nbgrader export' instead" %(gradebook_path, e))
+        nbgrader_grades = readCsv(os.path.join(course.course_dir, "grades.csv"))
+        for row in nbgrader_grades:
+            if row[0] == assign_name:
+                grade_dict[row[3]] = emptyGrade(row[2], float(row[7]), float(row[9]))
+    # check timestamps
+    timestamps = applyFuncDirectory(readTimestamps, student_dir, assign_name, "timestamp.txt", None)
+    for ts in timestamps:
+        if ts["student_id"] not in grade_dict:
+            print(ts["student_id"] + " has a submission timestamp but no recorded grade????")
+            grade_dict[ts["student_id"]] = emptyGrade()
+        grade_dict[ts["student_id"]]["read_timestamp"] = ts["read_timestamp"]
+    # check dist (grades obtained from autograded notebooks)
+    for nb in glob.glob(os.path.join(course.course_dir, "reports", assign_name, "dist-*.csv")):
+        nb = readCsv(nb)
+        points = nb[2]
+        for row in nb[3:]:
+            if row[0] not in grade_dict:
+                grade_dict[row[0]] = emptyGrade()
+            grade_dict[row[0]]["dist_score"] += sum([float(i) * float(j) for i, j in zip(points[1:], row[1:])])
+    # check fdist (grades obtained from generated feedback), cell by cell when grades came from gradebook.db
+    cell_errors = {}
+    for nb_path in glob.glob(os.path.join(course.course_dir, "reports", assign_name, "fdist-*.csv")):
+        nb_name = os.path.splitext(os.path.basename(nb_path))[0][len("fdist-"):]
+        nb = readCsv(nb_path)
+        grade_ids = nb[1]
+        for row in nb[3:]:
+            if row[0] not in grade_dict:
+                grade_dict[row[0]] = emptyGrade()
+            grade_dict[row[0]]["fdist_score"] += sum([float(i) for i in row[1:]])
+            if grade_dict[row[0]]["cells"] is not None:
+                for grade_id, score in zip(grade_ids[1:], row[1:]):
+                    if abs(grade_dict[row[0]]["cells"].get((nb_name, grade_id), 0.0) - float(score)) > 1e-6:
+                        cell_errors.setdefault(row[0], []).append("%s %s: gradebook %s feedback %s" %(nb_name, grade_id, grade_dict[row[0]]["cells"].get((nb_name, grade_id)), score))
+    for student_id in grade_dict:
+        _ = grade_dict[student_id].pop("cells")
+        grade_dict[student_id]["cell_errors"] = cell_errors.get(student_id, [])
+    # compare and export grades
+    grade_list = [["student_id", assign_name, "timestamp"]]
+    for student_id in grade_dict.keys():
+        if (abs(grade_dict[student_id]["raw_score"] - grade_dict[student_id]["dist_score"]) > 1e-6 or
+            abs(grade_dict[student_id]["score"] - grade_dict[student_id]["fdist_score"]) > 1e-6 or
+            len(grade_dict[student_id]["cell_errors"]) > 0):
+            # I think raw_score is purely autograded and score reflects manual grading, but could be wrong and they both reflect manual
+            print(student_id + " grades don't match: " + str(grade_dict[student_id]))
+            grade_list.append([student_id, grade_dict[student_id]["score"], grade_dict[student_id]["timestamp"], "ERROR", str(grade_dict[student_id])])
+        elif (grade_dict[student_id]["timestamp"] is not None and 
+              len(str(grade_dict[student_id]["timestamp"])) > 0 and
+              str(grade_dict[student_id]["timestamp"]).strip() != str(grade_dict[student_id]["read_timestamp"]).strip()):
+            print(student_id + " timestamps don't match: " + str(grade_dict[student_id]))
+            grade_list.append([student_id, grade_dict[student_id]["score"], grade_dict[student_id]["timestamp"], "ERROR", str(grade_dict[student_id])])
+        else:
+            grade_list.append([student_id, grade_dict[student_id]["score"], grade_dict[student_id]["timestamp"]])
+    writeCsv(os.path.join(course.course_dir, "reports", assign_name, "ckdgrades.csv"), grade_list)
+    print("Done")
+
+def commandEmail(args: argparse.Namespace, course: Course) -> None:
+    import concurrent.futures
+    assign_name, nb_name = args.email
+    student_dir = course.stepDir("feedback")
+    for key in EMAIL_CONFIG:
+        if EMAIL_CONFIG[key] is None:
+            EMAIL_CONFIG[key] = input("Enter value for %s: " %(key))
+            # replace blank entries with None
+            if EMAIL_CONFIG[key].strip() == "":
+                EMAIL_CONFIG[key] = None
+    if EMAIL_CONFIG["CC_ADDRESS"] == "SELF":
+        EMAIL_CONFIG["CC_ADDRESS"] = EMAIL_CONFIG["MY_EMAIL_ADDRESS"]
+    # send over a few reused connections, EMAIL_DELAY is enforced as an average rate across all of them
+    smtp_connections = max(int(EMAIL_CONFIG["SMTP_CONNECTIONS"]), 1)
+    smtp_server = SmtpPool(EMAIL_CONFIG["MY_SMTP_SERVER"], EMAIL_CONFIG["MY_SMTP_USERNAME"], EMAIL_CONFIG["MY_SMTP_PASSWORD"],
+                           smtp_connections, int(EMAIL_CONFIG["SMTP_PORT"]), EMAIL_CONFIG["SMTP_STARTTLS"])
+    email_delay = float(EMAIL_CONFIG["EMAIL_DELAY"] or 0)
+    rate_limiter = TokenBucket(1 / email_delay if email_delay > 0 else 0)
+    # skip students who were already sent this exact file (rerun after an interrupted run)
+    journal = EmailJournal(os.path.join(course.course_dir, "reports", assign_name, "email-" + nb_name + ".journal"))
+    submissions = applyFuncDirectory(returnPath, student_dir, assign_name, nb_name, None)
+    pending = []
+    for submission in submissions:
+        submission["sha256"] = hashFile(submission["path"])
+        if not args.resend and journal.delivered(submission["student_id"], submission["sha256"]):
+            print("Already sent to: " + submission["student_id"] + EMAIL_CONFIG["STUDENT_MAIL_DOMAIN"])
+        else:
+            pending.append(submission)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=smtp_connections) as executor:
+        _ = list(executor.map(emailSubmission, pending, itertools.repeat(smtp_server), itertools.repeat(rate_limiter), itertools.repeat(journal)))
+    smtp_server.quit()
+    header = [["Student ID", "Email Sent"]]
+    log = [[submission["student_id"], "1" if journal.delivered(submission["student_id"], submission["sha256"]) else "0"] for submission in submissions]
+    writeCsv(os.path.join(course.course_dir, "reports", assign_name, "email-" + nb_name + "-" + datetime.datetime.now().strftime("%m-%d-%H-%M") + ".csv"), header + log)
+    print("Done")
+
+def commandCheckDir(args: argparse.Namespace, course: Course) -> None:
+    assign_name, nb_name = args.ckdir
+    student_dir = course.stepDir("feedback")
+    none_list = applyFuncDirectory(printFileNames, student_dir, assign_name, nb_name, None)
+    print("Found %s files" %(len(none_list)))
+    print("Done")
+
+def commandCheckDuplicates(args: argparse.Namespace, course: Course) -> None:
+    student_dir = course.stepDir("submitted")
+    applyFuncFiles(checkDuplicates, student_dir, args.ckdup)
+    print("Done")
+
+def commandAvenueCollect(args: argparse.Namespace, course: Course) -> None:
+    import glob
+    import shutil
+    zip_file, assign_name = args.avenue_collect
+    student_dir = course.stepDir("submitted")
+    tmp_dir = os.path.join(course.course_dir, "nbhelper-avenue-tmp")
+    classlist = os.path.join(course.course_dir, "classlist.csv")
+    assignment_notebooks = glob.glob(os.path.join(course.source_dir, assign_name, "*.ipynb"))
+
+    # create lookup dictionary for students
+    # use same column names as 'nbgrader db student import' (requires id, first_name, last_name)
+    import csv
+    student_dictionary = {}
+    with open(classlist, "r") as f:
+        classlist = list(csv.reader(f))
+    index_id = classlist[0].index("id")
+    index_first_name = classlist[0].index("first_name")
+    index_last_name = classlist[0].index("last_name")
+    for row in classlist[1:]:
+        student_name = " ".join([row[index_first_name], row[index_last_name]])
+        student_id = str(row[index_id])
+        student_dictionary[student_name] = student_id
+
+    # rename and move submissions
+    log = []
+    shutil.unpack_archive(zip_file, tmp_dir)
+    submission_list = os.listdir(tmp_dir)
+    for submission in submission_list:
+        try:
+            log.append([submission])
+            student_name = submission.split(" - ")[1]
+            student_id = student_dictionary[student_name]
+            if len(assignment_notebooks) == 1 and os.path.splitext(submission)[-1] == ".ipynb":
+                file_name = os.path.basename(assignment_notebooks[0])
+            else:
+                file_name = submission.split(" - ")[-1]
+            current_path = os.path.join(tmp_dir, submission)
+            new_path = os.path.join(student_dir, student_id, assign_name, file_name)
+            if not os.path.isdir(os.path.dirname(new_path)):
+                os.makedirs(os.path.dirname(new_path))
+            shutil.move(current_path, new_path)
+            # time_stamp_path = os.path.join(student_dir, student_id, assign_name, "timestamp.txt")
+            # with open(time_stamp_path, "w") as f:
+            #     f.write("1970-01-01 00:00:00.000000 UTC")
+            log[-1] += [student_id, file_name, "SUCCESS"]
+        except:
+            log[-1] += ["","","FAILURE"]
+    clearDirectoryIndex()
+
+    writeCsv(os.path.join(course.course_dir, "reports", assign_name, "avenue-collect-" + datetime.datetime.now().strftime("%m-%d-%H-%M") + ".csv"), log)
+    print("Done")
+
+def commandZip(args: argparse.Namespace, course: Course) -> None:
+    course.zip(args.zip, args.ziplevel)
+    print("Done")
+
+def commandZipFiles(args: argparse.Namespace, course: Course) -> None:
+    course.zipFiles(args.zipfiles, args.ziplevel)
+    print("Done")
+
+def commandBackup(args: argparse.Namespace, course: Course) -> None:
+    # snapshot into the content addressed store
+    course.backup(args.backup)
+    print("Done")
+
+def commandVerify(args: argparse.Namespace, course: Course) -> None:
+    course.verify()
+    print("Done")
+
+def commandVersions(args: argparse.Namespace, course: Course) -> None:
+    nbgrader_step, path = args.versions
+    found = findBackupVersions(readBackupIndex(os.path.join(course.course_dir, "backups")), nbgrader_step, path)
+    if len(found) == 0:
+        print("No backups found for %s in %s" %(path, nbgrader_step))
+    for relPath, versions in found.items():
+        print(relPath)
+        for version in versions:
+            print("    %s  %s  %10s bytes  %s" %(version["time"][:19], os.path.basename(version["backup"]), version["size"], version.get("sha256", "crc32 %08x" %(version.get("crc", 0)))[:16]))
+    print("Done")
+
+def commandRestore(args: argparse.Namespace, course: Course) -> None:
+    if len(args.restore) < 2:
+        sys.exit("--restore requires nbgrader_step and at least one path")
+    backup_dir = os.path.join(course.course_dir, "backups")
+    index = readBackupIndex(backup_dir)
+    nbgrader_step = args.restore[0]
+    student_dir = os.path.join(course.course_dir, nbgrader_step) if args.odir is None else os.path.normpath(args.odir)
+    for path in args.restore[1:]:
+        found = findBackupVersions(index, nbgrader_step, path)
+        if len(found) == 0:
+            print("No backups found for %s in %s" %(path, nbgrader_step))
+        for relPath, versions in found.items():
+            if args.snapshot is not None:
+                versions = [version for version in versions if os.path.splitext(os.path.basename(version["backup"]))[0] == os.path.splitext(args.snapshot)[0]]
+                if len(versions) == 0:
+                    print("%s is not in backup %s" %(relPath, args.snapshot))
+                    continue
+            version = versions[-1]
+            try:
+                restoreBackupVersion(backup_dir, version, os.path.join(student_dir, *relPath.split("/")))
+            except Exception as e:
+                # missing object, bad zip member, etc., keep restoring the other paths
+                print("could not restore %s: %s" %(relPath, repr(e)))
+                continue
+            print("Restored %s from %s" %(relPath, os.path.basename(version["backup"])))
+    print("Done")
+
+def commandSimCheck(args: argparse.Namespace, course: Course) -> None:
+    assign_name = args.simcheck
+    student_dir = course.stepDir("submitted")
+    getAnswers = course.parser("getQuestionAnswers")
+    questions = writeMossFiles(course.source_dir, student_dir, assign_name, os.path.join(course.course_dir, "moss"), getAnswers)
+    course.save()
+    term = args.term if args.term is not None else os.path.basename(os.path.abspath(course.course_dir))
+    database_path = SIMCHECK_CONFIG["DATABASE"] if SIMCHECK_CONFIG["DATABASE"] is not None else os.path.join(course.course_dir, "moss", "fingerprints.db")
+    database = FingerprintDatabase(database_path, SIMCHECK_CONFIG["KGRAM"], SIMCHECK_CONFIG["WINDOW"])
+    fingerprints = fingerprintMossFiles(questions, args.jobs, database, term, assign_name)
+    # this cohort, question by question
+    pairs = checkSimilarity(fingerprints, args.jobs)
+    header = [["Question", "Student ID A", "Student ID B", "Shared Fingerprints", "Percent of A", "Percent of B", "Lines in A", "Lines in B"]]
+    data = [[pair["question"], pair["student_a"], pair["student_b"], pair["shared"], pair["percent_a"], pair["percent_b"], pair["lines_a"], pair["lines_b"]] for pair in pairs]
+    writeCsv(os.path.join(course.course_dir, "reports", assign_name, "simcheck.csv"), header + data)
+    for pair in pairs[:10]:
+        print("%s %s - %s: %s%% / %s%% (%s shared)" %(pair["question"], pair["student_a"], pair["student_b"], pair["percent_a"], pair["percent_b"], pair["shared"]))
+    print("%s similar pairs written to %s" %(len(pairs), os.path.join(course.course_dir, "reports", assign_name, "simcheck.csv")))
+    # other assignments and terms in the database
+    matches = rankHistoryMatches(database, term, assign_name, fingerprints, SIMCHECK_CONFIG["MAX_HISTORY"], SIMCHECK_CONFIG["MIN_SHARED"])
+    database.close()
+    header = [["Question", "Student ID", "Term", "AssignName", "Matched Question", "Matched Student ID", "Shared Fingerprints", "Percent of Student", "Lines", "Matched Lines"]]
+    data = [[match["question"], match["student_id"], match["term"], match["assignment"], match["match_question"], match["match_student_id"], match["shared"], match["percent"], match["lines"], match["match_lines"]] for match in matches]
+    writeCsv(os.path.join(course.course_dir, "reports", assign_name, "simcheck-history.csv"), header + data)
+    for match in matches[:10]:
+        print("%s %s - %s %s %s %s: %s%% (%s shared)" %(match["question"], match["student_id"], match["term"], match["assignment"], match["match_question"], match["match_student_id"], match["percent"], match["shared"]))
+    print("%s matches with other assignments or terms written to %s" %(len(matches), os.path.join(course.course_dir, "reports", assign_name, "simcheck-history.csv")))
+    print("Done")
+
+# dest of each command line flag: (handler, position of AssignName in its arguments or None), run in this order by main()
+COMMANDS = {
+    "getmoss": (commandGetMoss, None),
+    "add": (commandAdd, 0),
+    "fix": (commandFix, 0),
+    "meta": (commandMeta, 0),
+    "forcegrade": (commandForceGrade, 0),
+    "sortcells": (commandSortCells, 0),
+    "rmcells": (commandRmCells, 0),
+    "pipeline": (commandPipeline, 1),
+    "mknb": (commandMakeNotebook, 0),
+    "info": (commandInfo, 0),
+    "chmod": (commandChmod, 1),
+    "moss": (commandMoss, 0),
+    "dist": (commandDist, 0),
+    "fdist": (commandFeedbackDist, 0),
+    "ckgrades": (commandCheckGrades, 0),
+    "email": (commandEmail, 0),
+    "ckdir": (commandCheckDir, 0),
+    "ckdup": (commandCheckDuplicates, None),
+    "avenue_collect": (commandAvenueCollect, 1),
+    "zip": (commandZip, 0),
+    "zipfiles": (commandZipFiles, None),
+    "backup": (commandBackup, None),
+    "verify": (commandVerify, None),
+    "versions": (commandVersions, None),
+    "restore": (commandRestore, None),
+    "simcheck": (commandSimCheck, 0)
+}
+
 def main():
     readme = ("A collection of helpful functions for use with jupyter nbgrader. "
               "Designed to be placed in <course_dir>/nbhelper.py by default with the structure: "
@@ -909,6 +3235,24 @@ def main():
                         help="Sort cells of student notebooks to match order of source, matches based on grade_id")
     group2.add_argument("--rmcells", type=str, metavar=("AssignName", "NbName.ipynb"), nargs=2,
                         help="MAKE SURE YOU BACKUP FIRST - Removes all student cells that do not have a grade_id that matches the source notebook (and sorts the ones that do) - this function is destructive and should be used as a last resort")
+    group1.add_argument("--jobs", type=int, metavar="N", default=1, dest="jobs",
+                        help="Number of worker processes to use for notebook fixes, --forcegrade, and --zip (default: 1)")
+    group1.add_argument("--no-cache", action="store_true", dest="no_cache",
+                        help="Ignore and do not update cached results in <course_dir>/.nbhelper-cache (used by --dist, --fdist, --info, --moss, and --simcheck)")
+    group1.add_argument("--timeout", type=float, metavar="seconds", default=600, dest="timeout",
+                        help="Wall clock limit for executing each notebook with --forcegrade (default: 600)")
+    group1.add_argument("--memlimit", type=int, metavar="MB", default=None, dest="memlimit",
+                        help="Memory limit for executing each notebook with --forcegrade (linux only)")
+    group1.add_argument("--warmkernels", action="store_true",
+                        help="Execute --forcegrade notebooks in a pool of warm kernels (one per job, see KERNEL_CONFIG in script) instead of starting jupyter nbconvert for each student (requires jupyter_client, --memlimit is not applied)")
+    group1.add_argument("--resend", action="store_true",
+                        help="Email every student again with --email, even those the journal in <course_dir>/reports/<AssignName> shows already received the same file")
+    group1.add_argument("--term", type=str, metavar="name",
+                        help="Term that --simcheck submissions are stored under in the fingerprint database (default: name of <course_dir>)")
+    group1.add_argument("--snapshot", type=str, metavar="name",
+                        help="Restore from this backup (eg. submitted-mm-dd-hh-mm) instead of the latest one for --restore")
+    group1.add_argument("--profile", action="store_true",
+                        help="Time each phase (directory scan, json reads and writes, parsing, fixes, zipping, sending email) and each student, prints a summary and writes a trace to <course_dir>/reports/<AssignName>/profile-<command>.json")
     group1.add_argument("--select", type=str, metavar="StudentID", nargs="+", default=None,
                         help="Select specific students to fix their notebooks without having to run on the entire class (WARNING: moves student(s) to <course_dir>/nbhelper-select-tmp then moves back unless an error was encountered)")
     group5.add_argument("--info", type=str, metavar="AssignName",
@@ -916,21 +3260,25 @@ def main():
     group5.add_argument("--mknb", type=str, metavar=("AssignName", "NbName.ipynb", "FileName.extension"), nargs=3,
                         help="Try and make an autogradable notebook from a plain source code file by cramming everything in the first answer cell then appending all the test cells")
     group3.add_argument("--moss", type=str, metavar="AssignName",
-                        help="Exports student answer cells as files and optionally check with moss using <course_dir>/moss/moss.pl")
+                        help="Exports student answer cells as one file per question (grade_id) with the starter code as a base file (moss -b) and optionally check each question with moss using <course_dir>/moss/moss.pl")
+    group3.add_argument("--simcheck", type=str, metavar="AssignName",
+                        help="Exports student answer cells like --moss and compares them offline with winnowed fingerprints (starter code removed), ranked pairs are written to <course_dir>/reports/AssignName/simcheck.csv and matches with other assignments or terms in <course_dir>/moss/fingerprints.db to simcheck-history.csv")
     group3.add_argument("--getmoss", action="store_true",
                         help="Downloads moss script with your userid to <course_dir>/moss/moss.pl then removes it after use")
     group3.add_argument("--dist", type=str, metavar="AssignName",
-                        help="Gets distribution of scores across test cells from autograded notebooks and writes each student's results to <course_dir>/reports/<AssignName>/dist-<NbName>.csv")
+                        help="Gets distribution of scores across test cells from autograded notebooks and writes each student's results to <course_dir>/reports/<AssignName>/dist-<NbName>.csv, item analysis to items-dist-<NbName>.csv, and scores for all assignments to <course_dir>/reports/scores.csv")
     group3.add_argument("--fdist", type=str, metavar="AssignName",
-                        help="Gets distribution of scores across test cells from feedback (factoring in manual grading) and writes each student's results to <course_dir>/reports/<AssignName>/fdist-<NbName>.csv")
+                        help="Gets distribution of scores across test cells from feedback (factoring in manual grading) and writes each student's results to <course_dir>/reports/<AssignName>/fdist-<NbName>.csv, item analysis to items-fdist-<NbName>.csv, and scores for all assignments to <course_dir>/reports/scores.csv")
     group4.add_argument("--email", type=str, metavar=("AssignName|zip", "NbName.html|feedback.zip"), nargs=2,
-                        help="Email feedback to students (see EMAIL_CONFIG in script, prompts for unset fields)")
+                        help="Email feedback to students (see EMAIL_CONFIG in script, prompts for unset fields), reruns skip students who already received the same file")
     group3.add_argument("--ckdir", type=str, metavar=("AssignName", "NbName.extension"), nargs=2,
                         help="Check <course_dir>/feedback directory (change with --odir) by printing studentIDs and matching files to make sure it is structured properly")
     group3.add_argument("--ckgrades", type=str, metavar="AssignName",
-                        help="Checks for consistency between 'nbgrader export', 'dist', and 'fdist', and writes grades to <course_dir>/reports/<AssignName>/grades-<NbName>.csv")
+                        help="Checks for consistency between nbgrader grades (read from <course_dir>/gradebook.db, or grades.csv from 'nbgrader export' if it can't be read), 'dist', and 'fdist', and writes grades to <course_dir>/reports/<AssignName>/ckdgrades.csv")
     group5.add_argument("--ckdup", type=str, metavar="NbName.extension",
                         help="Checks all submitted directories for NbName.extension and reports subfolders containing multiple files of the same extension")
+    group2.add_argument("--pipeline", type=str, metavar=("add,fix,meta,sortcells", "AssignName", "NbName.ipynb"), nargs=3,
+                        help="Run several of add, fix, meta, sortcells, rmcells (comma separated, in order) on each submission with a single read and write per notebook")
     group2.add_argument("--chmod", type=str, metavar=("rwx", "AssignName"), nargs=2,
                         help="Run chmod rwx on all submissions for an assignment (linux only)")
     group4.add_argument("--avenue-collect", dest="avenue_collect", type=str, metavar=("submissions.zip", "AssignName"), nargs=2,
@@ -939,9 +3287,27 @@ def main():
                         help="Combine multiple feedbacks into <course_dir>/feedback/<student_id>/zip/feedback.zip")
     group4.add_argument("--zipfiles", type=str, metavar="NbName.html", nargs="+",
                         help="Same as zip but matches files instead of assignment folders")
+    group4.add_argument("--ziplevel", type=int, metavar="0-9", default=6, choices=range(10),
+                        help="Compression level for --zip and --zipfiles (default: 6), archives are only rebuilt when feedback or this level changes")
     group4.add_argument("--backup", type=str, metavar="nbgrader_step", choices=["autograded","feedback","release","source","submitted"],
-                        help="Backup nbgrader_step directory to <course_dir>/backups/<nbgrader_step-mm-dd-hh-mm>.zip")
+                        help="Snapshot nbgrader_step directory to <course_dir>/backups/snapshots/<nbgrader_step-mm-dd-hh-mm>.json, each unique file is stored once in <course_dir>/backups/objects and only new or changed files are copied")
+    group4.add_argument("--verify", action="store_true",
+                        help="Check every backup snapshot against <course_dir>/backups/objects, problems are written to <course_dir>/backups/verify.csv")
+    group4.add_argument("--restore", type=str, nargs="+", metavar=("nbgrader_step", "path"),
+                        help="Restore the latest backed up version of each path (relative to nbgrader_step directory, eg. StudentID/AssignName/NbName.ipynb or StudentID/AssignName) from snapshots or zip backups, uses <course_dir>/backups/index.json")
+    group4.add_argument("--versions", type=str, nargs=2, metavar=("nbgrader_step", "path"),
+                        help="List every backed up version of each file under path (relative to nbgrader_step directory)")
     args = parser.parse_args()
+    # before --select moves any students
+    if args.pipeline is not None:
+        try:
+            parsePipelineSteps(args.pipeline[0])
+        except ValueError as e:
+            parser.error(str(e))
+
+    global PROFILER
+    if args.profile:
+        PROFILER = PhaseProfiler()
 
     SCRIPT_DIR = os.getcwd()
     if os.path.isdir(args.cdir):
@@ -960,474 +3326,49 @@ def main():
     if args.nbhelp:
         print(NB_HELP)
 
-    if args.select is not None:
-        original_student_dir = getStudentFileDir(COURSE_DIR, args.odir, "submitted")
-        args.odir = os.path.join(COURSE_DIR, "nbhelper-select-tmp")
-        os.mkdir(args.odir)
-        for student in args.select:
-            shutil.move(os.path.join(original_student_dir, student), os.path.join(args.odir, student))
-
-    if args.getmoss == True:
-        req = urllib.request.urlopen("http://moss.stanford.edu/general/scripts/mossnet")
-        moss_script = req.read().decode()
-        userid = input("Enter your moss userid: ")
-        moss_script = moss_script.replace("$userid=987654321;", "$userid=%s;" %(userid))
-        os.makedirs(os.path.join(COURSE_DIR, "moss"), exist_ok=True)
-        if os.name == "nt":
-            with open(os.path.join(COURSE_DIR, "moss", "moss.pl"), "w") as f:
-                f.write(moss_script)
-        else:
-            with os.fdopen(os.open(os.path.join(COURSE_DIR, "moss", "moss.pl"), os.O_CREAT | os.O_RDWR, 0o700), "w") as f:
-                f.write(moss_script)
-
-    if args.add is not None:
-        assign_name, nb_name = args.add
-        template_path = os.path.join(SOURCE_DIR, assign_name, nb_name)
-        student_dir = getStudentFileDir(COURSE_DIR, args.odir, "submitted")
-        # if args.offline:
-        #     delete = input("Delete other files (!=NbName.ipynb) from submission folder (y/N)? ")
-        # else:
-        #     delete = "n"
-        applyTemplateSubmissions(addNbgraderCell, template_path, student_dir, nb_name, assign_name, delete="n")
-        print("Done")
-
-    if args.fix is not None:
-        assign_name, nb_name = args.fix
-        template_path = os.path.join(SOURCE_DIR, assign_name, nb_name)
-        student_dir = getStudentFileDir(COURSE_DIR, args.odir, "submitted")
-        # if args.offline:
-        #     delete = input("Delete other files (!=NbName.ipynb) from submission folder (y/N)? ")
-        # else:
-        #     delete = "n"
-        applyTemplateSubmissions(updateTestCells, template_path, student_dir, nb_name, assign_name, delete="n")
-        print("Done")
-
-    if args.meta is not None:
-        assign_name, nb_name = args.meta
-        template_path = os.path.join(SOURCE_DIR, assign_name, nb_name)
-        student_dir = getStudentFileDir(COURSE_DIR, args.odir, "submitted")
-        # if args.offline:
-        #     delete = input("Delete other files (!=NbName.ipynb) from submission folder (y/N)? ")
-        # else:
-        #     delete = "n"
-        applyTemplateSubmissions(updateCellsMeta, template_path, student_dir, nb_name, assign_name, delete="n")
-        print("Done")
-
-    if args.forcegrade is not None:
-        assign_name, nb_name = args.forcegrade
-        template_path = os.path.join(SOURCE_DIR, assign_name, nb_name)
-        student_dir = getStudentFileDir(COURSE_DIR, args.odir, "submitted")
-        # if args.offline:
-        #     delete = input("Delete other files (!=NbName.ipynb) from submission folder (y/N)? ")
-        # else:
-        #     delete = "n"
-        applyTemplateSubmissions(forceAutograde, template_path, student_dir, nb_name, assign_name, delete="n", course_dir = COURSE_DIR, AssignName = assign_name, NbNameipynb = nb_name)
-        print("Done")
-
-    if args.sortcells is not None:
-        assign_name, nb_name = args.sortcells
-        template_path = os.path.join(SOURCE_DIR, assign_name, nb_name)
-        student_dir = getStudentFileDir(COURSE_DIR, args.odir, "submitted")
-        # if args.offline:
-        #     delete = input("Delete other files (!=NbName.ipynb) from submission folder (y/N)? ")
-        # else:
-        #     delete = "n"
-        applyTemplateSubmissions(sortStudentCells, template_path, student_dir, nb_name, assign_name, delete="n")
-        print("Done")
-
-    if args.rmcells is not None:
-        assign_name, nb_name = args.rmcells
-        template_path = os.path.join(SOURCE_DIR, assign_name, nb_name)
-        student_dir = getStudentFileDir(COURSE_DIR, args.odir, "submitted")
-        # if args.offline:
-        #     delete = input("Delete other files (!=NbName.ipynb) from submission folder (y/N)? ")
-        # else:
-        #     delete = "n"
-        applyTemplateSubmissions(removeNonEssentialCells, template_path, student_dir, nb_name, assign_name, delete="n")
-        print("Done")
-
-    if args.mknb is not None:
-        assign_name, nb_name, fname = args.mknb
-        template_path = os.path.join(SOURCE_DIR, assign_name, nb_name)
-        student_dir = getStudentFileDir(COURSE_DIR, args.odir, "submitted")
-        data = applyFuncDirectory(makeNotebook, student_dir, assign_name, fname, None, template_path)
-        writeCsv(os.path.join(COURSE_DIR, "reports", assign_name, "mknb-" + os.path.splitext(nb_name)[0] + ".csv"), data)
-        print("Done")
-
-    if args.info is not None:
-        assign_name = args.info
-        nb_names = getAssignmentFiles(SOURCE_DIR, assign_name, "ipynb")
-        student_dir = getStudentFileDir(COURSE_DIR, args.odir, "submitted")
-        for nb_name in nb_names:
-            header = [["Student ID", "File Size", "Cell Count", "Total Execution Count", "[grade id : execution count]"]]
-            data = applyFuncDirectory(quickInfo, student_dir, assign_name, nb_name, None)
-            writeCsv(os.path.join(COURSE_DIR, "reports", assign_name, "info-" + os.path.splitext(nb_name)[0] + ".csv"), header + data)
-        print("Done")
-
-    if args.chmod is not None:
-        assign_name = args.chmod[1]
-        nb_names = getAssignmentFiles(SOURCE_DIR, assign_name, "ipynb")
-        student_dir = getStudentFileDir(COURSE_DIR, args.odir, "submitted")
-        for nb_name in nb_names:
-            applyFuncDirectory(chmod, student_dir, assign_name, nb_name, None, args.chmod[0])
-        print("Done")
-
-    if args.moss is not None:
-        assign_name = args.moss
-        nb_names = getAssignmentFiles(SOURCE_DIR, assign_name, "ipynb")
-        student_dir = getStudentFileDir(COURSE_DIR, args.odir, "submitted")
-        # prep directory
-        assignment = assign_name.replace(" ", "_")
-        codeDir = os.path.join(COURSE_DIR, "moss", assignment)
-        os.makedirs(codeDir, exist_ok=True)
-        # extract code from student notebooks
-        data = []
-        for nb_name in nb_names:
-            data.append(applyFuncDirectory(getAnswerCells, student_dir, assign_name, nb_name, None))
-        clean_data = concatNotebookAnswerCells(data)
-        writeAnswerCells(clean_data, codeDir)
-        # prepare to submit to MOSS
-        command = "moss.pl -l python " + assignment + "/*.py"
-        # construct base file
-        try:
-            data = []
-            for nb_name in nb_names:
-                template = os.path.join(SOURCE_DIR, assign_name, nb_name)
-                data.append([getAnswerCells(template, "instructor")])
-            clean_data = concatNotebookAnswerCells(data)
-            baseCode = clean_data["instructor"]
-            # remove solution blocks
-            baseCodeClean = []
-            nonSolution = True
-            for line in baseCode:
-                if "### BEGIN SOLUTION" in line:
-                    nonSolution = False
-                elif "### END SOLUTION" in line:
-                    nonSolution = True
-                elif nonSolution:
-                    baseCodeClean.append(line)
-            baseFile = os.path.join(COURSE_DIR, "moss", assignment + "-base.py")
-            with open(baseFile, "w", encoding="utf8", errors="backslashreplace") as f:
-                f.writelines(baseCodeClean)
-            command = "moss.pl -l python -b %s %s/*.py" %(assignment + "-base.py", assignment)
-        except:
-            print("Failed to construct base file")
-        # execute command
-        os.chdir(os.path.join(COURSE_DIR, "moss"))
-        if os.name == "nt":
-            wslCommand = "bash -c \"./%s\"" %(command)
-            print(command)
-            submit = input("execute command (y/N/wsl)? ")
-            if submit.lower() == "y":
-                os.system(command)
-            elif submit.lower() == "wsl":
-                os.system(wslCommand)
-        else:
-            command = "./" + command
-            print(command)
-            submit = input("execute command (y/N)? ")
-            if submit.lower() == "y":
-                os.system(command)
-        os.chdir(SCRIPT_DIR)
-        print("Done")
-
-    if args.dist is not None:
-        assign_name = args.dist
-        nb_names = getAssignmentFiles(SOURCE_DIR, assign_name, "ipynb")
-        student_dir = getStudentFileDir(COURSE_DIR, args.odir, "autograded")
-        for nb_name in nb_names:
-            print("Distribution for " + nb_name)
-            # Init variables
-            source_path = os.path.join(SOURCE_DIR, assign_name, nb_name)
-            grade_id_list = getAutogradedScore(source_path, "instructor")["grade_id_list"]
-            grade_points = getAutogradedScore(source_path, "instructor")["points_list"]
-            grade_dist = [0] * len(grade_points)
-            error_list = [[] for i in range(len(grade_points))]
-            data = [["Test Cell"] + [i for i in range(1,len(grade_points)+1)]]
-            data.append(["Cell ID"] + grade_id_list)
-            data.append(["Points"] + grade_points)
-            # Get grades
-            grades = applyFuncDirectory(getAutogradedScore, student_dir, assign_name, nb_name, None)
-            # getAutogradedScore().keys() -> ["student_id", "pass_list", "points_list", "error_list", "grade_id_list"]
-            # Get distribution
-            for student in grades:
-                # check order
-                if grade_id_list != student["grade_id_list"]:
-                    a, b = grade_id_list, student["grade_id_list"]
-                    if all([i in a and j in b for i in b for j in a]):
-                        student = sortStudentGradeIds(student, grade_id_list)
-                        print("Grade IDs were out of order for: " + student["student_id"])
-                # check if grade ids match now
-                if grade_id_list == student["grade_id_list"]:
-                    data.append([student["student_id"]] + student["pass_list"])
-                    for i in range(len(grade_points)):
-                        grade_dist[i] += student["pass_list"][i]
-                        error_list[i].append(student["error_list"][i])
-                else:
-                    # still something wrong
-                    print(student["student_id"] + " has something wrong with their notebook")
-                    print(student)
-            print("Total students: " + str(len(error_list[0])))
-            for i in range(len(grade_points)):
-                cellnum = "{:<5}".format(str(i+1))
-                gp = "{:<4}".format(str(grade_points[i]))
-                gd = "{:<4}".format(str(grade_dist[i]))
-                print("Test Cell: %s Points: %s Total passes: %s" %(cellnum, gp, gd))
-            print("")
-            for i in range(len(grade_points)):
-                print("Errors for test cell: %s" %(i+1))
-                print(collections.Counter(error_list[i]))
-                print("")
-            writeCsv(os.path.join(COURSE_DIR, "reports", assign_name, "dist-" + os.path.splitext(nb_name)[0] + ".csv"), data)
-        print("Done")
-
-    if args.fdist is not None:
-        assign_name = args.fdist
-        nb_names = getAssignmentFiles(SOURCE_DIR, assign_name, "ipynb", "")
-        student_dir = getStudentFileDir(COURSE_DIR, args.odir, "feedback")
-        for nb_name in nb_names:
-            print("Distribution for " + nb_name + ".html")
-            # Init variables
-            source_path = os.path.join(SOURCE_DIR, assign_name, nb_name + ".ipynb")
-            grade_id_list = getAutogradedScore(source_path, "instructor")["grade_id_list"]
-            grade_points = getAutogradedScore(source_path, "instructor")["points_list"]
-            grade_dist = [0.0] * len(grade_points)
-            data = [["Test Cell"] + [i for i in range(1,len(grade_points)+1)]]
-            data.append(["Cell ID"] + grade_id_list)
-            data.append(["Points"] + grade_points)
-            # Get grades
-            grades = applyFuncDirectory(getFeedbackScore, student_dir, assign_name, nb_name + ".html", None)
-            # getFeedbackScore().keys() -> ["student_id", "total_score", "score_list", "score_totals", "grade_id_list"]
-            # Get distribution
-            for student in grades:
-                # check order
-                if grade_id_list != student["grade_id_list"]:
-                    a, b = grade_id_list, student["grade_id_list"]
-                    if all([i in a and j in b for i in b for j in a]):
-                        student = sortStudentGradeIds(student, grade_id_list)
-                        print("Grade IDs were out of order for: " + student["student_id"])
-                # check if grade ids match now and for other possible errors
-                if grade_id_list == student["grade_id_list"] and grade_points == student["score_totals"] and abs(student["total_score"] - sum(student["score_list"])) < 0.1:
-                    data.append([student["student_id"]] + student["score_list"])
-                    for i in range(len(grade_points)):
-                        grade_dist[i] += student["score_list"][i]
-                else:
-                    print(student["student_id"] + " has something wrong with their feedback")
-                    print(student)
-            print("Total students: " + str(len(grades)))
-            for i in range(len(grade_points)):
-                cellnum = "{:<5}".format(str(i+1))
-                gp = "{:<4}".format(str(grade_points[i]))
-                gd = "{:<4}".format(str(grade_dist[i]))
-                _ad = "{:<4}".format(str(grade_dist[i]/len(grades)))
-                print("Test Cell: %s Points: %s Total points: %s" %(cellnum, gp, gd))
-            print("")
-            writeCsv(os.path.join(COURSE_DIR, "reports", assign_name, "fdist-" + nb_name + ".csv"), data)
-        print("Done")
-
-    if args.ckgrades is not None:
-        assign_name = args.ckgrades
-        student_dir = getStudentFileDir(COURSE_DIR, args.odir, "submitted")
-        grade_dict = {}
-        # check nbgrader grades
-        nbgrader_grades = readCsv(os.path.join(COURSE_DIR, "grades.csv"))
-        for row in nbgrader_grades:
-            if row[0] == assign_name:
-                student_id = row[3]
-                grade_dict[student_id] = {
-                    "timestamp": row[2],
-                    "read_timestamp": "",
-                    "raw_score": float(row[7]),
-                    "score": float(row[9]),
-                    "dist_score": 0,
-                    "fdist_score": 0
-                }
-        # check timestamps
-        timestamps = applyFuncDirectory(readTimestamps, student_dir, assign_name, "timestamp.txt", None)
-        for ts in timestamps:
-            if ts["student_id"] not in grade_dict:
-                print(ts["student_id"] + " has a submission timestamp but no recorded grade????")
-                grade_dict[student_id] = {
-                    "timestamp": "",
-                    "read_timestamp": "",
-                    "raw_score": 0,
-                    "score": 0,
-                    "dist_score": 0,
-                    "fdist_score": 0
-                }
-            grade_dict[ts["student_id"]]["read_timestamp"] = ts["read_timestamp"]
-        # check dist (grades obtained from autograded notebooks)
-        for nb in glob.glob(os.path.join(COURSE_DIR, "reports", assign_name, "dist-*.csv")):
-            nb = readCsv(nb)
-            points = nb[2]
-            for row in nb[3:]:
-                if row[0] not in grade_dict:
-                    grade_dict[student_id] = {
-                        "timestamp": "",
-                        "read_timestamp": "",
-                        "raw_score": 0,
-                        "score": 0,
-                        "dist_score": 0,
-                        "fdist_score": 0
-                    }
-                grade_dict[row[0]]["dist_score"] += sum([float(i) * float(j) for i, j in zip(points[1:], row[1:])])
-        # check fdist (grades obtained from generated feedback)
-        for nb in glob.glob(os.path.join(COURSE_DIR, "reports", assign_name, "fdist-*.csv")):
-            nb = readCsv(nb)
-            points = nb[2]
-            for row in nb[3:]:
-                if row[0] not in grade_dict:
-                    grade_dict[student_id] = {
-                        "timestamp": "",
-                        "read_timestamp": "",
-                        "raw_score": 0,
-                        "score": 0,
-                        "dist_score": 0,
-                        "fdist_score": 0
-                    }
-                grade_dict[row[0]]["fdist_score"] += sum([float(i) for i in row[1:]])
-        # compare and export grades
-        grade_list = [["student_id", assign_name, "timestamp"]]
-        for student_id in grade_dict.keys():
-            if (grade_dict[student_id]["raw_score"] != grade_dict[student_id]["dist_score"] or
-                grade_dict[student_id]["score"] != grade_dict[student_id]["fdist_score"]):
-                # I think raw_score is purely autograded and score reflects manual grading, but could be wrong and they both reflect manual
-                print(student_id + " grades don't match: " + str(grade_dict[student_id]))
-                grade_list.append([student_id, grade_dict[student_id]["score"], grade_dict[student_id]["timestamp"], "ERROR", str(grade_dict[student_id])])
-            elif (grade_dict[student_id]["timestamp"] is not None and 
-                  len(str(grade_dict[student_id]["timestamp"])) > 0 and
-                  str(grade_dict[student_id]["timestamp"]).strip() != str(grade_dict[student_id]["read_timestamp"]).strip()):
-                print(student_id + " timestamps don't match: " + str(grade_dict[student_id]))
-                grade_list.append([student_id, grade_dict[student_id]["score"], grade_dict[student_id]["timestamp"], "ERROR", str(grade_dict[student_id])])
-            else:
-                grade_list.append([student_id, grade_dict[student_id]["score"], grade_dict[student_id]["timestamp"]])
-        writeCsv(os.path.join(COURSE_DIR, "reports", assign_name, "ckdgrades.csv"), grade_list)
-        print("Done")
-
-    if args.email is not None:
-        assign_name, nb_name = args.email
-        student_dir = getStudentFileDir(COURSE_DIR, args.odir, "feedback")
-        for key in EMAIL_CONFIG:
-            if EMAIL_CONFIG[key] is None:
-                EMAIL_CONFIG[key] = input("Enter value for %s: " %(key))
-                # replace blank entries with None
-                if EMAIL_CONFIG[key].strip() == "":
-                    EMAIL_CONFIG[key] = None
-        if EMAIL_CONFIG["CC_ADDRESS"] == "SELF":
-            EMAIL_CONFIG["CC_ADDRESS"] = EMAIL_CONFIG["MY_EMAIL_ADDRESS"]
-        # smtp_server = smtplib.SMTP(EMAIL_CONFIG["MY_SMTP_SERVER"], port=587)
-        # smtp_server.ehlo()
-        # smtp_server.starttls()
-        # smtp_server.login(myUser, myPwd)
-        # EMAIL_CONFIG["MY_SMTP_SERVER"] = smtp_server
-        log = applyFuncDirectory(emailFeedback, student_dir, assign_name, nb_name, None)
-        # smtp_server.quit()
-        header = [["Student ID", "Email Sent"]]
-        writeCsv(os.path.join(COURSE_DIR, "reports", assign_name, "email-" + nb_name + "-" + datetime.datetime.now().strftime("%m-%d-%H-%M") + ".csv"), header + log)
-        print("Done")
-
-    if args.ckdir is not None:
-        assign_name, nb_name = args.ckdir
-        student_dir = getStudentFileDir(COURSE_DIR, args.odir, "feedback")
-        none_list = applyFuncDirectory(printFileNames, student_dir, assign_name, nb_name, None)
-        print("Found %s files" %(len(none_list)))
-        print("Done")
-
-    if args.ckdup is not None:
-        student_dir = getStudentFileDir(COURSE_DIR, args.odir, "submitted")
-        applyFuncFiles(checkDuplicates, student_dir, args.ckdup)
-        print("Done")
-
-    if args.avenue_collect is not None:
-        zip_file, assign_name = args.avenue_collect
-        student_dir = getStudentFileDir(COURSE_DIR, args.odir, "submitted")
-        tmp_dir = os.path.join(COURSE_DIR, "nbhelper-avenue-tmp")
-        classlist = os.path.join(COURSE_DIR, "classlist.csv")
-        assignment_notebooks = glob.glob(os.path.join(SOURCE_DIR, assign_name, "*.ipynb"))
-
-        # create lookup dictionary for students
-        # use same column names as 'nbgrader db student import' (requires id, first_name, last_name)
-        import csv
-        student_dictionary = {}
-        with open(classlist, "r") as f:
-            classlist = list(csv.reader(f))
-        index_id = classlist[0].index("id")
-        index_first_name = classlist[0].index("first_name")
-        index_last_name = classlist[0].index("last_name")
-        for row in classlist[1:]:
-            student_name = " ".join([row[index_first_name], row[index_last_name]])
-            student_id = str(row[index_id])
-            student_dictionary[student_name] = student_id
-
-        # rename and move submissions
-        log = []
-        shutil.unpack_archive(zip_file, tmp_dir)
-        submission_list = os.listdir(tmp_dir)
-        for submission in submission_list:
-            try:
-                log.append([submission])
-                student_name = submission.split(" - ")[1]
-                student_id = student_dictionary[student_name]
-                if len(assignment_notebooks) == 1 and os.path.splitext(submission)[-1] == ".ipynb":
-                    file_name = os.path.basename(assignment_notebooks[0])
-                else:
-                    file_name = submission.split(" - ")[-1]
-                current_path = os.path.join(tmp_dir, submission)
-                new_path = os.path.join(student_dir, student_id, assign_name, file_name)
-                if not os.path.isdir(os.path.dirname(new_path)):
-                    os.makedirs(os.path.dirname(new_path))
-                shutil.move(current_path, new_path)
-                # time_stamp_path = os.path.join(student_dir, student_id, assign_name, "timestamp.txt")
-                # with open(time_stamp_path, "w") as f:
-                #     f.write("1970-01-01 00:00:00.000000 UTC")
-                log[-1] += [student_id, file_name, "SUCCESS"]
-            except:
-                log[-1] += ["","","FAILURE"]
-
-        writeCsv(os.path.join(COURSE_DIR, "reports", assign_name, "avenue-collect-" + datetime.datetime.now().strftime("%m-%d-%H-%M") + ".csv"), log)
-        print("Done")
-
-    if args.zip is not None:
-        student_dir = getStudentFileDir(COURSE_DIR, args.odir, "feedback")
-        # get list of students and files
-        data = []
-        for assign_name in args.zip:
-            data.append(applyFuncDirectory(returnPath, student_dir, assign_name, None, "html"))
-        # use zip function
-        applyFuncDirectory(removeZips, student_dir, "zip", "feedback.zip", None)
-        zipFeedback(student_dir, data)
-        print("Done")
-
-    if args.zipfiles is not None:
-        student_dir = getStudentFileDir(COURSE_DIR, args.odir, "feedback")
-        # get list of students and files
-        data = []
-        for f in args.zipfiles:
-            data.append(applyFuncFiles(returnPath, student_dir, f))
-        # use zip function
-        applyFuncDirectory(removeZips, student_dir, "zip", "feedback.zip", None)
-        zipFeedback(student_dir, data)
-        print("Done")
-        
-    if args.backup is not None:
-        student_dir = getStudentFileDir(COURSE_DIR, args.odir, args.backup)
-        # prep backup
-        backup_dir = os.path.join(COURSE_DIR, "backups")
-        os.makedirs(backup_dir, exist_ok=True)
-        zip_name = args.backup + "-" + datetime.datetime.now().strftime("%m-%d-%H-%M")
-        backup_name = os.path.join(backup_dir, zip_name)
-        # backup
-        shutil.make_archive(backup_name, "zip", student_dir)
-        print("Done")
+    # missing directories raise NotADirectoryError, exit with the message like the console script expects
+    try:
+        if args.select is not None:
+            import shutil
+            original_student_dir = getStudentFileDir(COURSE_DIR, args.odir, "submitted")
+            args.odir = os.path.join(COURSE_DIR, "nbhelper-select-tmp")
+            os.mkdir(args.odir)
+            for student in args.select:
+                shutil.move(os.path.join(original_student_dir, student), os.path.join(args.odir, student))
+
+        course = Course(COURSE_DIR, SOURCE_DIR, args.odir, args.jobs, not args.no_cache)
+
+        for command, (handler, _) in COMMANDS.items():
+            if getattr(args, command) not in [None, False]:
+                handler(args, course)
+    except NotADirectoryError as e:
+        sys.exit(str(e))
 
     if args.getmoss == True:
         os.remove(os.path.join(COURSE_DIR, "moss", "moss.pl"))
 
     if args.select is not None:
+        import shutil
         for student in args.select:
             shutil.move(os.path.join(args.odir, student), os.path.join(original_student_dir, student))
         os.rmdir(args.odir)
 
+    if PROFILER is not None:
+        commands = [command for command in COMMANDS if getattr(args, command) not in [None, False]]
+        summary = PROFILER.summary(commands)
+        printProfile(summary)
+        if len(commands) > 0 and COURSE_DIR is not None:
+            value, position = getattr(args, commands[0]), COMMANDS[commands[0]][1]
+            if position is None:
+                assign_name = None
+            else:
+                assign_name = value if type(value) == str else value[position]
+            report_dir = os.path.join(COURSE_DIR, "reports") if assign_name is None else os.path.join(COURSE_DIR, "reports", assign_name)
+            os.makedirs(report_dir, exist_ok=True)
+            with open(os.path.join(report_dir, "profile-%s.json" %(commands[0])), "w") as f:
+                json.dump(summary, f, indent=1)
+            print("Profile written to " + os.path.join(report_dir, "profile-%s.json" %(commands[0])))
+
 if __name__ == "__main__":
     sys.exit(main())
 
@@ -1,12 +1,16 @@
+import re
 import setuptools
-import nbhelper
+
+# read VERSION without importing nbhelper
+with open("nbhelper.py", "r") as fh:
+    version = re.search(r'^VERSION = "([^"]+)"', fh.read(), re.M).group(1)
 
 with open("README.md", "r") as fh:
     long_description = fh.read()
 
 setuptools.setup(
     name="nbhelper",
-    version=nbhelper.VERSION,
+    version=version,
     description="A collection of helpful functions for use with jupyter nbgrader",
     long_description=long_description,
     long_description_content_type="text/markdown",